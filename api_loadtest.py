@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+from benchmark import FIRST_NAMES, LAST_NAMES, STATUSES, summarize, write_roster
+
+# Share of each kind of request in the mix
+MIX = [
+    ("get_student", 50),
+    ("get_student_cached", 15),
+    ("search", 15),
+    ("attendance_page", 10),
+    ("add_attendance", 7),
+    ("add_payment", 3),
+]
+
+
+class Client:
+    """One keep-alive HTTP/1.1 connection, one request at a time."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(data)}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        length = int(response_headers.get("content-length", 0))
+        payload = await self.reader.readexactly(length) if length else b""
+        return status, response_headers, payload
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def run_client(client, plan, samples, counts, etags):
+    for kind, method, path, body in plan:
+        headers = {}
+        if kind == "get_student_cached" and path in etags:
+            headers["If-None-Match"] = etags[path]
+        start = time.perf_counter()
+        status, response_headers, _ = await client.request(method, path, body, headers)
+        samples.setdefault(kind, []).append(time.perf_counter() - start)
+        counts[status] = counts.get(status, 0) + 1
+        if "etag" in response_headers:
+            etags[path] = response_headers["etag"]
+    client.close()
+
+
+def make_plan(count, requests, seed=0):
+    rng = random.Random(seed)
+    kinds = [kind for kind, share in MIX for _ in range(share)]
+    plan = []
+    for _ in range(requests):
+        kind = rng.choice(kinds)
+        student = f"/students/S{rng.randint(1, count):07d}"
+        if kind in ("get_student", "get_student_cached"):
+            plan.append((kind, "GET", student, None))
+        elif kind == "search":
+            query = rng.choice(FIRST_NAMES + LAST_NAMES)[:rng.randint(3, 6)].lower()
+            plan.append((kind, "GET", f"/students?q={quote(query)}&limit=20", None))
+        elif kind == "attendance_page":
+            plan.append((kind, "GET", student + "/attendance?limit=20", None))
+        elif kind == "add_attendance":
+            plan.append((kind, "POST", student + "/attendance",
+                         {"date": "2024-11-04", "status": rng.choice(STATUSES)}))
+        else:
+            plan.append((kind, "POST", student + "/payments",
+                         {"amount": 500, "date": "2024-11-05", "description": "Monthly fee"}))
+    return plan
+
+
+async def load(host, port, plan, clients):
+    samples, counts, etags = {}, {}, {}
+    # Warms the cache so the conditional requests have tags to send
+    warm = Client(host, port)
+    for kind, method, path, body in plan:
+        if kind == "get_student_cached" and path not in etags:
+            _, headers, _ = await warm.request(method, path)
+            etags[path] = headers.get("etag")
+    warm.close()
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(Client(host, port), plan[i::clients], samples, counts, etags)
+                           for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(plan),
+        "clients": clients,
+        "elapsed_s": elapsed,
+        "requests_per_s": len(plan) / elapsed,
+        "statuses": {str(k): v for k, v in sorted(counts.items())},
+        "operations": {kind: summarize(s) for kind, s in samples.items()},
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("API server exited during startup")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("API server did not start")
+
+
+def run_local(count, requests, clients, backend="json", attendance=10, payments=3):
+    # Starts a server on a generated roster in a separate process, then loads it
+    workdir = tempfile.mkdtemp(prefix="omna-api-")
+    try:
+        path = os.path.join(workdir, "students.json")
+        write_roster(path, count, attendance, payments)
+        if backend == "sqlite":
+            from sqlite_model import migrate_json_to_sqlite
+            migrate_json_to_sqlite(path, os.path.join(workdir, "students.db"))
+            path = os.path.join(workdir, "students.db")
+        port = free_port()
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                "api_server.py"),
+                                   "--backend", backend, "--data", path, "--port", str(port)],
+                                  stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port, server)
+            return asyncio.run(load("127.0.0.1", port, make_plan(count, requests), clients))
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_results(results):
+    print(f"{results['requests']} requests from {results['clients']} clients in "
+          f"{results['elapsed_s']:.2f}s: {results['requests_per_s']:.0f} requests/s")
+    print("statuses: " + ", ".join(f"{k}: {v}" for k, v in results["statuses"].items()))
+    print(f"{'request':<20}{'p50 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}")
+    for kind, stats in results["operations"].items():
+        print(f"{kind:<20}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the HTTP API")
+    parser.add_argument("--students", type=int, default=10000, help="roster size (default: 10000)")
+    parser.add_argument("--requests", type=int, default=5000, help="requests to send (default: 5000)")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent connections (default: 32)")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--port", type=int,
+                        help="load a server already running on this local port, with IDs up to --students")
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    args = parser.parse_args()
+
+    if args.port:
+        results = asyncio.run(load("127.0.0.1", args.port, make_plan(args.students, args.requests),
+                                   args.clients))
+    else:
+        results = run_local(args.students, args.requests, args.clients, args.backend)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
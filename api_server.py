@@ -0,0 +1,449 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from columnar import STATUSES
+from model import ALLOWED_LEVELS, STUDENT_FIELDS, ConflictError, clean_student, open_model
+from stats import current_month
+
+DEFAULT_PORT = 8000
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_BATCH = 100
+MAX_BODY = 16 * 2 ** 20
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def profile(student):
+    # What the API shows of a student: no histories, no internal fields.
+    # student is a copy from get_student_profiles, the write thread may be
+    # changing the model's own dicts meanwhile.
+    data = {k: v for k, v in student.items()
+            if k != "attendance" and k != "payments" and not k.startswith("_")}
+    data["version"] = student.get("_version", 1)
+    return data
+
+
+def page(query):
+    try:
+        offset = max(0, int(query.get("offset", 0)))
+        limit = max(1, min(MAX_PAGE_SIZE, int(query.get("limit", PAGE_SIZE))))
+    except ValueError:
+        raise ApiError(400, "offset and limit must be numbers")
+    return offset, limit
+
+
+def etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+class ApiServer:
+    """HTTP/JSON front of a student model, for the website, kiosks and scripts.
+
+    Requests are parsed on an asyncio loop. Model calls run on threads so a
+    slow one never holds up the loop: reads on a small pool, writes one at a
+    time on a single thread, in the order they arrived.
+    """
+
+    def __init__(self, model, read_workers=4):
+        self.model = model
+        self.reads = ThreadPoolExecutor(read_workers, thread_name_prefix="api-read")
+        self.writes = ThreadPoolExecutor(1, thread_name_prefix="api-write")
+        # (method, path pattern, handler, is a write)
+        self.routes = [
+            ("GET", r"/students", self.list_students, False),
+            ("POST", r"/students", self.add_student, True),
+            ("GET", r"/students/([^/]+)", self.get_student, False),
+            ("PATCH", r"/students/([^/]+)", self.update_student, True),
+            ("PUT", r"/students/([^/]+)", self.update_student, True),
+            ("DELETE", r"/students/([^/]+)", self.delete_student, True),
+            ("GET", r"/students/([^/]+)/attendance", self.get_attendance, False),
+            ("POST", r"/students/([^/]+)/attendance", self.add_attendance, True),
+            ("GET", r"/students/([^/]+)/payments", self.get_payments, False),
+            ("POST", r"/students/([^/]+)/payments", self.add_payment, True),
+            ("GET", r"/students/([^/]+)/balance", self.get_balance, False),
+            ("GET", r"/attendance", self.get_attendance_by_date, False),
+            ("POST", r"/attendance", self.add_attendance_bulk, True),
+            ("GET", r"/stats", self.get_stats, False),
+            ("GET", r"/fees", self.get_fees, False),
+            ("PUT", r"/fees", self.set_fees, True),
+            ("POST", r"/charges", self.post_charges, True),
+            ("GET", r"/arrears", self.get_arrears, False),
+        ]
+        self.routes = [(m, re.compile(p + "/?"), h, w) for m, p, h, w in self.routes]
+        # GET handlers whose ETag is known before the response is built
+        self.tags = {self.get_student: self.student_tag, self.get_attendance: self.student_tag,
+                     self.get_payments: self.student_tag}
+
+    # Handlers run on the executor threads, they return (status, payload)
+
+    def list_students(self, query, body):
+        offset, limit = page(query)
+        level = query.get("level")
+        if query.get("q"):
+            ids = self.model.search_student_ids(query["q"])
+            if level:
+                ids = [s["id"] for s in self.model.get_student_summaries(ids)
+                       if s and s.get("level") == level]
+        else:
+            ids = self.model.list_student_ids(level or None)
+        students = self.model.get_student_profiles(ids[offset:offset + limit])
+        return 200, {"total": len(ids), "offset": offset, "limit": limit,
+                     "items": [profile(s) for s in students if s]}
+
+    def _profile(self, student_id):
+        student = self.model.get_student_profiles([student_id])[0]
+        if not student:
+            raise ApiError(404, f"No student {student_id}")
+        return profile(student)
+
+    def student_tag(self, query, body, student_id):
+        # ETag of the student's resources, from its version and record
+        # counts, so a "not modified" answer reads none of the records
+        version = self.model.student_version(student_id)
+        if version is None:
+            return None
+        return etag(json.dumps([student_id, version, query], sort_keys=True).encode())
+
+    def get_student(self, query, body, student_id):
+        version = self.model.student_version(student_id)
+        data = self._profile(student_id)
+        if version is not None:
+            data["attendance_count"], data["payment_count"] = version[1:]
+        return 200, data
+
+    def _history(self, query, student_id, key):
+        offset, limit = page(query)
+        if query.get("from") or query.get("to"):
+            # Date range, in date order
+            try:
+                window = self.model.get_history_window(student_id, key, query.get("from"), query.get("to"))
+            except ValueError as e:
+                raise ApiError(400, str(e))
+            if window is None:
+                raise ApiError(404, f"No student {student_id}")
+            total, records = len(window["records"]), window["records"][offset:offset + limit]
+        else:
+            found = self.model.get_history_page(student_id, key, offset, limit)
+            if found is None:
+                raise ApiError(404, f"No student {student_id}")
+            total, records = found
+        return 200, {"total": total, "offset": offset, "limit": limit, "items": records}
+
+    def get_attendance(self, query, body, student_id):
+        return self._history(query, student_id, "attendance")
+
+    def get_payments(self, query, body, student_id):
+        return self._history(query, student_id, "payments")
+
+    def get_stats(self, query, body):
+        return 200, self.model.dashboard_stats()
+
+    def add_student(self, query, body):
+        try:
+            student = clean_student(body or {})
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        if student.get("id") and self.model.get_student_profiles([student["id"]])[0]:
+            raise ApiError(409, f"ID {student['id']} already exists")
+        try:
+            student_id = self.model.add_student(student)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        return 201, self._profile(student_id)
+
+    def update_student(self, query, body, student_id):
+        body = body or {}
+        # version is the one the change was made from, see StudentModel.update_student
+        version = body.get("version")
+        if version is not None and (isinstance(version, bool) or not isinstance(version, int)):
+            raise ApiError(400, "version must be a number")
+        data = {k: str(v).strip() for k, v in body.items() if k in STUDENT_FIELDS}
+        if data.get("level") and data["level"] not in ALLOWED_LEVELS:
+            raise ApiError(400, f"Unknown level '{data['level']}'")
+        new_id = data.get("id", student_id)
+        if new_id != student_id and new_id and self.model.get_student_profiles([new_id])[0]:
+            raise ApiError(409, f"ID {new_id} already exists")
+        try:
+            updated = self.model.update_student(student_id, data, expected_version=version)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        if not updated:
+            raise ApiError(404, f"No student {student_id}")
+        return 200, self._profile(data.get("id") or student_id)
+
+    def delete_student(self, query, body, student_id):
+        if not self.model.delete_student(student_id):
+            raise ApiError(404, f"No student {student_id}")
+        return 204, None
+
+    def _attendance_fields(self, record):
+        status = record.get("status")
+        if status not in STATUSES:
+            raise ApiError(400, f"status must be one of {', '.join(STATUSES)}")
+        return str(record.get("date") or date.today().isoformat()), status, str(record.get("notes") or "")
+
+    def add_attendance(self, query, body, student_id):
+        if not self.model.add_attendance(student_id, *self._attendance_fields(body or {})):
+            raise ApiError(404, f"No student {student_id}")
+        return 201, {"id": student_id}
+
+    def get_attendance_by_date(self, query, body):
+        # Everyone's attendance from "from" to "to" (one day without "to"), optionally one status
+        if not query.get("from"):
+            raise ApiError(400, "from is required")
+        offset, limit = page(query)
+        try:
+            rows = self.model.attendance_by_date(query["from"], query.get("to"), query.get("status"))
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        return 200, {"total": len(rows), "offset": offset, "limit": limit,
+                     "items": [{"date": day, "id": student_id, "status": status}
+                               for day, student_id, status in rows[offset:offset + limit]]}
+
+    def add_attendance_bulk(self, query, body):
+        # {"date": ..., "marks": {student_id: status or [status, notes]}}, one write for the class
+        body = body or {}
+        day = str(body.get("date") or date.today().isoformat())
+        marks = {}
+        for student_id, mark in (body.get("marks") or {}).items():
+            status, notes = (mark, "") if isinstance(mark, str) else (list(mark) + [""])[:2]
+            _, status, notes = self._attendance_fields({"status": status, "notes": notes})
+            marks[student_id] = (status, notes)
+        return 201, {"recorded": self.model.add_attendance_bulk(day, marks)}
+
+    def add_payment(self, query, body, student_id):
+        body = body or {}
+        amount = body.get("amount")
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)) or amount <= 0:
+            raise ApiError(400, "amount must be a positive number")
+        # Stored as a float, as the window does
+        if not self.model.add_payment(student_id, float(amount), str(body.get("date") or date.today().isoformat()),
+                                      str(body.get("description") or "")):
+            raise ApiError(404, f"No student {student_id}")
+        return 201, {"id": student_id}
+
+    def get_balance(self, query, body, student_id):
+        balance = self.model.balance(student_id)
+        if balance is None:
+            raise ApiError(404, f"No student {student_id}")
+        return 200, balance
+
+    def get_fees(self, query, body):
+        return 200, {"fees": self.model.fee_schedule(), "posted": self.model.posted_periods()}
+
+    def set_fees(self, query, body):
+        if not isinstance(body, dict):
+            raise ApiError(400, "Expected an object mapping levels to fees")
+        try:
+            self.model.set_fee_schedule(body)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        return 200, {"fees": self.model.fee_schedule()}
+
+    def post_charges(self, query, body):
+        period = (body or {}).get("period") or current_month()
+        try:
+            count = self.model.post_charges(period)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        return 201, {"period": period, "charged": count}
+
+    def get_arrears(self, query, body):
+        # Students owing money, largest debt first
+        offset, limit = page(query)
+        items = self.model.arrears(offset + limit)[offset:]
+        return 200, {"total": self.model.arrears_count(), "offset": offset, "limit": limit,
+                     "items": [{"id": student_id, "owed": owed} for student_id, owed in items]}
+
+    # Dispatch
+
+    def _route(self, method, path):
+        allowed = False
+        for route_method, pattern, handler, write in self.routes:
+            match = pattern.fullmatch(path)
+            if match:
+                if route_method == method:
+                    return handler, write, [unquote(g) for g in match.groups()]
+                allowed = True
+        raise ApiError(405 if allowed else 404, f"{method} {path} is not supported")
+
+    async def dispatch(self, method, target, body):
+        # (status, payload) of one request, also used for each part of a batch
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if body is not None and not isinstance(body, dict):
+            return 400, {"error": "Body must be a JSON object"}
+        try:
+            if method == "POST" and url.path.rstrip("/") == "/batch":
+                return 200, await self.batch(body)
+            handler, write, args = self._route(method, url.path)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.writes if write else self.reads,
+                                              handler, query, body, *args)
+        except ApiError as e:
+            return e.status, {"error": str(e)}
+        except ConflictError as e:
+            return 409, {"error": str(e), "fields": e.fields, "current": profile(e.current)}
+        except Exception as e:
+            traceback.print_exc()
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    async def batch(self, body):
+        # {"requests": [{"method", "path", "body"}]}, run in order over one round trip
+        requests = (body or {}).get("requests")
+        if not isinstance(requests, list) or len(requests) > MAX_BATCH:
+            raise ApiError(400, f"requests must be a list of at most {MAX_BATCH} requests")
+        responses = []
+        for request in requests:
+            method = str(request.get("method", "GET")).upper()
+            path = str(request.get("path", ""))
+            if urlsplit(path).path.rstrip("/") == "/batch":
+                responses.append({"status": 400, "body": {"error": "Batches can't be nested"}})
+                continue
+            status, payload = await self.dispatch(method, path, request.get("body"))
+            responses.append({"status": status, "body": payload})
+        return {"responses": responses}
+
+    async def tag(self, target):
+        # ETag of a GET taken before doing the work, None if the route has none
+        url = urlsplit(target)
+        try:
+            handler, _, args = self._route("GET", url.path)
+        except ApiError:
+            return None
+        if handler not in self.tags:
+            return None
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.reads, self.tags[handler], query, None, *args)
+        except Exception:
+            # The request itself reports the error
+            return None
+
+    async def respond(self, method, target, headers, raw_body):
+        # Status, body bytes and extra headers of an HTTP request
+        body = None
+        if raw_body:
+            try:
+                body = json.loads(raw_body)
+            except ValueError:
+                return 400, json.dumps({"error": "Body is not valid JSON"}).encode(), {}
+        candidates = [t.strip().removeprefix("W/") for t in headers.get("if-none-match", "").split(",")]
+        tag = await self.tag(target) if method == "GET" else None
+        if tag is not None and (tag in candidates or "*" in candidates):
+            return 304, b"", {"ETag": tag}
+        status, payload = await self.dispatch(method, target, body)
+        data = b"" if payload is None else json.dumps(payload, ensure_ascii=False,
+                                                     separators=(",", ":")).encode("utf-8")
+        extra = {}
+        if method == "GET" and status == 200:
+            # Taken before the response was built, so it may be older than
+            # the data but never newer: the next request gets the changes
+            extra["ETag"] = tag = tag or etag(data)
+            if tag in candidates or "*" in candidates:
+                return 304, b"", extra
+        return status, data, extra
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    self._send(writer, 400, json.dumps({"error": "Bad request line"}).encode(), {}, False)
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self._send(writer, 400, json.dumps({"error": "Bad Content-Length"}).encode(), {}, False)
+                    break
+                if length > MAX_BODY:
+                    self._send(writer, 413, json.dumps({"error": "Body too large"}).encode(), {}, False)
+                    break
+                raw_body = await reader.readexactly(length) if length else b""
+                status, data, extra = await self.respond(method.upper(), target, headers, raw_body)
+                self._send(writer, status, data, extra, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _send(self, writer, status, data, extra, keep_alive):
+        head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+                f"Content-Length: {len(data)}",
+                "Connection: " + ("keep-alive" if keep_alive else "close")]
+        if data:
+            head.append("Content-Type: application/json; charset=utf-8")
+        head += [f"{name}: {value}" for name, value in extra.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+
+    async def start(self, host="127.0.0.1", port=DEFAULT_PORT):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        self.reads.shutdown()
+        self.writes.shutdown()
+
+
+async def serve(server, host, port):
+    listener = await server.start(host, port)
+    print(f"Serving on http://{host}:{listener.sockets[0].getsockname()[1]}", file=sys.stderr)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP/JSON API over the student data")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json",
+                        help="storage backend (default: json)")
+    parser.add_argument("--data", help="data file (default: students.json or students.db)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    model = open_model(args.backend, args.data)
+    server = ApiServer(model)
+    try:
+        asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        model.close()
+
+
+if __name__ == "__main__":
+    main()
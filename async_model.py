@@ -0,0 +1,98 @@
+import queue
+import threading
+import tkinter as tk
+
+import instrumentation
+
+
+class AsyncModel:
+    """Runs model calls on a worker thread and hands the results back to Tk.
+
+    Calls are executed one at a time in submission order. Reads run in order
+    on a second thread, so they don't wait behind a long write such as an
+    import, and the Tk thread never waits on the model lock. Callbacks run
+    on the Tk thread, picked up by polling with root.after, so they can touch
+    widgets freely.
+    """
+
+    def __init__(self, root, factory, on_load=None, on_error=None, on_busy=None, poll_ms=50):
+        self.root = root
+        self.model = None
+        self.on_error = on_error
+        self.on_busy = on_busy
+        self.poll_ms = poll_ms
+        self.pending = 0
+        self._tasks = queue.Queue()
+        self._reads = queue.Queue()
+        self._results = queue.Queue()
+        self._worker = threading.Thread(target=self._run, args=(self._tasks,), daemon=True)
+        self._worker.start()
+        self._reader = threading.Thread(target=self._run, args=(self._reads,), daemon=True)
+        self._reader.start()
+        self.submit(self._load, factory, callback=on_load)
+        self.root.after(self.poll_ms, self._poll)
+
+    def _load(self, factory):
+        self.model = factory()
+        return self.model
+
+    def submit(self, fn, *args, callback=None, errback=None, quiet=False, **kwargs):
+        # Quiet tasks, such as background polls, don't show the busy indicator
+        if not quiet:
+            self.pending += 1
+            if self.pending == 1 and self.on_busy:
+                self.on_busy(True)
+        self._tasks.put((fn, args, kwargs, callback, errback, quiet))
+
+    def call(self, method, *args, callback=None, errback=None, quiet=False, **kwargs):
+        # The model is looked up when the call runs, so calls can be queued during the load
+        self.submit(lambda: getattr(self.model, method)(*args, **kwargs),
+                    callback=callback, errback=errback, quiet=quiet)
+
+    def read(self, method, *args, callback=None, errback=None, **kwargs):
+        # A model read on the reader thread, without the busy indicator
+        self._reads.put((lambda: getattr(self.model, method)(*args, **kwargs), (), {}, callback, errback, True))
+
+    def post(self, callback, *args):
+        # From any thread, callback(*args) then runs on the Tk thread at the next poll
+        self._results.put((lambda _: callback(*args), None, None, None, True))
+
+    def close(self, callback=None):
+        self._reads.put(None)
+        self.submit(lambda: self.model and self.model.close(), callback=callback)
+        self._tasks.put(None)
+
+    def _run(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            fn, args, kwargs, callback, errback, quiet = task
+            try:
+                with instrumentation.profiling():
+                    result = fn(*args, **kwargs)
+                self._results.put((callback, result, None, errback, quiet))
+            except Exception as e:
+                self._results.put((None, None, e, errback, quiet))
+
+    def _poll(self):
+        while True:
+            try:
+                callback, result, error, errback, quiet = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if not quiet:
+                self.pending -= 1
+                if self.pending == 0 and self.on_busy:
+                    self.on_busy(False)
+            if error is not None:
+                handler = errback or self.on_error
+                if handler:
+                    handler(error)
+            elif callback:
+                callback(result)
+        try:
+            self.root.after(self.poll_ms, self._poll)
+        except tk.TclError:
+            # The window was closed by one of the callbacks
+            pass
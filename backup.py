@@ -0,0 +1,303 @@
+import argparse
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import tarfile
+import time
+from datetime import datetime
+
+from journal import Journal
+
+# Full backups are taken at the first compaction this long after the last one
+FULL_EVERY = 24 * 3600
+# Full backups kept, with the deltas that follow them
+KEEP_FULL = 7
+# Fast compression: backups run alongside the operators' work
+COMPRESS_LEVEL = 1
+
+
+class BackupError(Exception):
+    pass
+
+
+def default_directory(data_file):
+    return os.path.splitext(data_file)[0] + ".backups"
+
+
+class BackupStore:
+    """Compressed full snapshots plus every journal record written since.
+
+    A full backup packs a snapshot and its history file. A delta holds the
+    journal records of a sequence range, so backing up costs as much as
+    what changed. The manifest lists every file with its checksum, checked
+    before anything is restored. Writers hold the model's compaction lock.
+    """
+
+    MANIFEST = "manifest.jsonl"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._entries = None
+
+    def entries(self):
+        # Manifest lines in the order written, a torn last line is ignored
+        if self._entries is None:
+            self._entries = []
+            try:
+                with open(os.path.join(self.directory, self.MANIFEST), "rb") as f:
+                    for line in f:
+                        try:
+                            self._entries.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            break
+            except FileNotFoundError:
+                pass
+        return self._entries
+
+    def reload(self):
+        # Another process may have added backups
+        self._entries = None
+        return self.entries()
+
+    def last_seq(self):
+        return max((entry["last_seq"] for entry in self.entries()), default=0)
+
+    def last_full_time(self):
+        return max((entry["time"] for entry in self.entries() if entry["kind"] == "full"), default=0)
+
+    def full_due(self, now=None):
+        return (now or time.time()) - self.last_full_time() >= FULL_EVERY
+
+    def _store(self, name, data, entry):
+        # File first, then its manifest line, each synced, so the manifest never
+        # lists a file that isn't complete
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        entry.update(file=name, size=len(data), sha256=hashlib.sha256(data).hexdigest())
+        with open(os.path.join(self.directory, self.MANIFEST), "ab") as f:
+            f.write(json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries().append(entry)
+        return entry
+
+    def save_delta(self, records):
+        # Journal records not backed up yet, returns the entry or None
+        last = self.last_seq()
+        records = [r for r in records if r.get("seq", 0) > last]
+        if not records:
+            return None
+        lines = b"".join(json.dumps(r, separators=(",", ":")).encode("utf-8") + b"\n" for r in records)
+        first_seq, last_seq = records[0]["seq"], records[-1]["seq"]
+        return self._store(f"delta-{first_seq:012d}-{last_seq:012d}.jsonl.gz",
+                           gzip.compress(lines, COMPRESS_LEVEL),
+                           {"kind": "delta", "first_seq": first_seq, "last_seq": last_seq,
+                            "time": max(r.get("time", 0) for r in records)})
+
+    def save_full(self, snapshot, history_path, seq):
+        # snapshot is the text of the data file, history_path the side file it names
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz", compresslevel=COMPRESS_LEVEL) as tar:
+            info = tarfile.TarInfo("snapshot.json")
+            info.size = len(snapshot)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(snapshot))
+            if history_path:
+                tar.add(history_path, arcname=os.path.basename(history_path))
+        entry = self._store(f"full-{seq:012d}-{time.time_ns():x}.tar.gz", buffer.getvalue(),
+                            {"kind": "full", "first_seq": seq, "last_seq": seq, "time": time.time()})
+        self.prune()
+        return entry
+
+    def prune(self, keep=KEEP_FULL):
+        # Drops the oldest full backups and the deltas only they lead to
+        fulls = [entry for entry in self.entries() if entry["kind"] == "full"]
+        if len(fulls) <= keep:
+            return []
+        newer = fulls[-keep:]
+        kept = [entry for entry in self.entries()
+                if entry in newer or (entry["kind"] == "delta" and entry["last_seq"] > newer[0]["last_seq"])]
+        dropped = [entry for entry in self.entries() if entry not in kept]
+        manifest = os.path.join(self.directory, self.MANIFEST)
+        with open(manifest + ".tmp", "wb") as f:
+            for entry in kept:
+                f.write(json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + ".tmp", manifest)
+        self._entries = kept
+        for entry in dropped:
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except OSError:
+                pass
+        return dropped
+
+    def _read(self, entry):
+        path = os.path.join(self.directory, entry["file"])
+        with open(path, "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            raise BackupError(f"Checksum mismatch in {entry['file']}")
+        return data
+
+    def verify(self):
+        # Files missing or damaged, empty when every backup reads back
+        problems = []
+        for entry in self.entries():
+            try:
+                self._read(entry)
+            except (OSError, BackupError) as e:
+                problems.append(f"{entry['file']}: {e}")
+        return problems
+
+    def _delta_records(self, after_seq, skipped):
+        # Records of the deltas following after_seq, in order, up to the first damaged one
+        for entry in sorted((e for e in self.entries() if e["kind"] == "delta" and e["last_seq"] > after_seq),
+                            key=lambda e: e["first_seq"]):
+            try:
+                lines = gzip.decompress(self._read(entry)).splitlines()
+            except (OSError, EOFError, BackupError) as e:
+                skipped.append(f"{entry['file']}: {e}")
+                return
+            for line in lines:
+                yield json.loads(line)
+
+    def restore(self, data_file, until=None, journal=()):
+        """Writes data_file, its history file and journal as they were at
+        time until (seconds since 1970, None for the latest known).
+
+        Starts from the last full backup that reads back, then replays the
+        deltas that follow it and finally the given journal records, up to
+        the first gap in the sequence. Returns a summary of what was restored.
+        """
+        fulls = [entry for entry in self.entries() if entry["kind"] == "full"
+                 and (until is None or entry["time"] <= until)]
+        skipped = []
+        for base in reversed(fulls):
+            try:
+                archive = self._read(base)
+                break
+            except (OSError, BackupError) as e:
+                skipped.append(f"{base['file']}: {e}")
+        else:
+            raise BackupError("No usable full backup" + (": " + "; ".join(skipped) if skipped else ""))
+
+        seq = base["last_seq"]
+        records = []
+        # A damaged full backup is replaced by an older one, a damaged delta loses records
+        complete = True
+        damaged_fulls = len(skipped)
+        for record in itertools.chain(self._delta_records(seq, skipped), journal):
+            if record.get("seq", 0) <= seq:
+                continue
+            if until is not None and record.get("time", 0) > until:
+                break
+            if record["seq"] != seq + 1:
+                # Records missing, nothing after them can be applied
+                complete = False
+                break
+            records.append(record)
+            seq += 1
+
+        stem = os.path.splitext(data_file)[0]
+        files = []
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar:
+            snapshot = tar.extractfile("snapshot.json").read()
+            for member in tar.getmembers():
+                if member.name == "snapshot.json":
+                    continue
+                # Only the history file, named after the data file it is
+                # written next to, so the saves of another data file in the
+                # same directory don't take it for one of theirs
+                name = os.path.basename(stem) + ".history-" + member.name.rsplit(".history-", 1)[-1]
+                files.append((os.path.join(os.path.dirname(stem), name), tar.extractfile(member).read()))
+                if name != member.name:
+                    from model import seal_snapshot
+                    data = json.loads(snapshot)
+                    data.pop("checksum", None)
+                    data["history_file"] = name
+                    snapshot = seal_snapshot(json.dumps(data, separators=(",", ":")))
+        files.append((stem + ".journal", b"".join(
+            json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n" for record in records)))
+        # The data file goes last, it is what points at the others
+        files.append((data_file, snapshot))
+        _replace_all(files)
+        if os.path.exists(stem + ".journal.old"):
+            os.remove(stem + ".journal.old")
+        return {"full": base["file"], "seq": seq, "records": len(records),
+                "complete": complete and len(skipped) == damaged_fulls, "skipped": skipped}
+
+
+def _replace_all(files):
+    # Every (path, content) is written to a temporary file first and the
+    # files are only swapped in once all of them are on disk. If one can't
+    # be written, none of the existing files is touched.
+    written = []
+    try:
+        for path, data in files:
+            with open(path + ".tmp", "wb") as f:
+                written.append(path + ".tmp")
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+    except OSError:
+        for tmp_path in written:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        raise
+    for path, _ in files:
+        os.replace(path + ".tmp", path)
+
+
+def parse_time(value):
+    # "2024-11-04 18:30" (local time) or seconds since 1970
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backups of students.json")
+    parser.add_argument("command", choices=["now", "list", "verify", "restore"])
+    parser.add_argument("--data", default="students.json", help="data file (default: students.json)")
+    parser.add_argument("--dir", help="backup directory (default: next to the data file)")
+    parser.add_argument("--to", help="restore into this data file, which must not exist yet")
+    parser.add_argument("--until", type=parse_time,
+                        help="restore the data as it was at this time, e.g. '2024-11-04 18:30'")
+    args = parser.parse_args()
+    store = BackupStore(args.dir or default_directory(args.data))
+
+    if args.command == "now":
+        from model import StudentModel
+        model = StudentModel(args.data)
+        print(model.backup(full=True))
+        model.close()
+    elif args.command == "list":
+        for entry in store.entries():
+            stamp = datetime.fromtimestamp(entry["time"]).isoformat(" ", "seconds") if entry["time"] else "-"
+            print(f"{entry['kind']:<6}{entry['first_seq']:>10}{entry['last_seq']:>10}  {stamp}  {entry['file']}")
+    elif args.command == "verify":
+        problems = store.verify()
+        print("\n".join(problems) or f"{len(store.entries())} backups OK")
+        sys.exit(1 if problems else 0)
+    else:
+        if not args.to:
+            parser.error("restore needs --to")
+        if os.path.exists(args.to):
+            parser.error(f"{args.to} already exists")
+        # What was written since the last backup is still in the journal
+        journal = Journal(os.path.splitext(args.data)[0] + ".journal").records()
+        print(store.restore(args.to, args.until, journal))
@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from columnar import np
+from history import AttendanceHistory
+from model import StudentModel
+from sqlite_model import SQLiteStudentModel, migrate_json_to_sqlite
+
+FIRST_NAMES = ["Ayman", "Salma", "Youssef", "Imane", "Omar", "Khadija", "Mehdi", "Sara",
+               "Hamza", "Fatima", "Amine", "Hajar", "Anas", "Meryem", "Zakaria", "Nour"]
+LAST_NAMES = ["Amine", "Benali", "El Idrissi", "Alaoui", "Bennani", "Tazi", "Chraibi",
+              "Fassi", "Berrada", "Lahlou", "Ouazzani", "Sebti", "Kettani", "Naciri"]
+LEVELS = ["1ere TSDI", "2eme TSDI", "1ere TSGE", "2eme TSGE", "1ere TGI", "2eme TGI", "1ere OPS"]
+STATUSES = ["Present", "Present", "Present", "Absent", "Late"]
+MONTHLY_FEES = {level: 400.0 + 50 * (i % 3) for i, level in enumerate(LEVELS)}
+SCHOOL_START = date(2024, 9, 2)
+
+BACKENDS = {
+    "json": (StudentModel, "students.json"),
+    "sqlite": (SQLiteStudentModel, "students.db"),
+}
+# Operations whose p50 may grow by this factor before --baseline reports them
+REGRESSION_FACTOR = 1.5
+
+
+def school_days(count):
+    days = []
+    day = SCHOOL_START
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day.isoformat())
+        day += timedelta(days=1)
+    return days
+
+
+def generate_students(count, attendance=2, payments=1, seed=0):
+    # attendance and payments are averages, each student gets between none and twice as many
+    rng = random.Random(seed)
+    days = school_days(2 * attendance)
+    months = [f"{2024 + (8 + m) // 12}-{(8 + m) % 12 + 1:02d}" for m in range(2 * payments)]
+    for i in range(count):
+        level = rng.choice(LEVELS)
+        present_days = days[:rng.randint(0, 2 * attendance)]
+        paid_months = months[:rng.randint(0, 2 * payments)]
+        yield {
+            "id": f"S{i + 1:07d}",
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(LAST_NAMES),
+            "dob": f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(1998, 2007)}",
+            "gender": rng.choice(["Masculin", "Feminin"]),
+            "address": "Hay Salam",
+            "phone": f"06{rng.randint(0, 99999999):08d}",
+            "level": level,
+            "reg_date": "02/09/2024",
+            "attendance": [{"date": day, "status": rng.choice(STATUSES),
+                            "notes": "", "timestamp": f"{day}T08:30:00"}
+                           for day in present_days],
+            "payments": [{"date": f"{month}-05", "amount": MONTHLY_FEES[level],
+                          "description": "Monthly fee", "timestamp": f"{month}-05T09:00:00"}
+                         for month in paid_months]
+        }
+
+
+def write_roster(path, count, attendance=2, payments=1, seed=0):
+    # Streamed so the roster never has to fit in memory twice
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"format":2,"seq":0,"students":[')
+        for i, student in enumerate(generate_students(count, attendance, payments, seed)):
+            if i:
+                f.write(",")
+            f.write(json.dumps(student, separators=(",", ":")))
+        f.write("]}")
+
+
+def percentile(sorted_samples, fraction):
+    # Nearest rank
+    index = max(0, min(len(sorted_samples) - 1, int(round(fraction * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "calls": len(samples),
+        "total_s": total,
+        "ops_per_s": len(samples) / total if total else None,
+        "mean_ms": total / len(samples) * 1000,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def sample(fn, args_list):
+    # One latency per call
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_operations(model, count, repeat, seed=1):
+    rng = random.Random(seed)
+    ids = [f"S{rng.randint(1, count):07d}" for _ in range(repeat)]
+    queries = [rng.choice(FIRST_NAMES + LAST_NAMES)[:rng.randint(3, 6)].lower()
+               for _ in range(repeat)]
+    samples = {}
+    samples["get_student_by_id"] = sample(model.get_student_by_id, [(i,) for i in ids])
+    samples["search_students"] = sample(model.search_students, [(q, 50) for q in queries])
+    samples["add_student"] = sample(
+        model.add_student,
+        [({"first_name": "Bench", "last_name": f"Mark{n}", "level": "1ere OPS"},) for n in range(repeat)])
+    samples["add_attendance"] = sample(
+        model.add_attendance, [(i, "2024-11-04", rng.choice(STATUSES)) for i in ids])
+    samples["add_payment"] = sample(
+        model.add_payment, [(i, 500.0, "2024-11-05", "Monthly fee") for i in ids])
+    # Distinct students, all of them still there
+    doomed = rng.sample(range(1, count + 1), min(repeat, count))
+    samples["delete_student"] = sample(model.delete_student, [(f"S{n:07d}",) for n in doomed])
+    return samples
+
+
+def measure_memory(factory):
+    # Peak during the load, and what the loaded model keeps
+    tracemalloc.start()
+    try:
+        model = factory()
+        current, peak = tracemalloc.get_traced_memory()
+        model.close()
+    finally:
+        tracemalloc.stop()
+    return {"load_peak_bytes": peak, "resident_bytes": current}
+
+
+def history_memory(rows=100000):
+    # Bytes per attendance row as parsed dicts and as a compact history
+    days = school_days(800)
+    lines = [json.dumps({"date": days[i % len(days)], "status": STATUSES[i % len(STATUSES)], "notes": "",
+                         "timestamp": f"{days[i % len(days)]}T08:{i % 60:02d}:00.{i % 999999:06d}"})
+             for i in range(rows)]
+    results = {}
+    for name, build in (("dict", lambda: [json.loads(line) for line in lines]),
+                        ("compact", lambda: AttendanceHistory(json.loads(line) for line in lines))):
+        tracemalloc.start()
+        try:
+            kept = build()
+            results[f"{name}_bytes_per_row"] = tracemalloc.get_traced_memory()[0] / rows
+        finally:
+            tracemalloc.stop()
+        del kept
+    results["reduction"] = results["dict_bytes_per_row"] / results["compact_bytes_per_row"]
+    return results
+
+
+def bench_backend(backend, path, count, repeat, slow_repeat, memory):
+    cls = BACKENDS[backend][0]
+    samples = {"load_data": []}
+    for _ in range(slow_repeat):
+        start = time.perf_counter()
+        model = cls(path)
+        samples["load_data"].append(time.perf_counter() - start)
+        model.close()
+
+    model = cls(path)
+    try:
+        samples.update(run_operations(model, count, repeat))
+        if hasattr(model, "save_data"):
+            # Waits for a compaction the writes above may have started
+            model.compact(wait=True)
+            samples["save_data"] = sample(model.save_data, [()] * slow_repeat)
+    finally:
+        model.close()
+
+    results = {"operations": {name: summarize(s) for name, s in samples.items()}}
+    if memory:
+        results["memory"] = measure_memory(lambda: cls(path))
+    return results
+
+
+def run_suite(sizes, repeat=100, slow_repeat=3, backends=("json", "sqlite"),
+              attendance=10, payments=3, memory=True, progress=None):
+    report = {"meta": environment(), "config": {
+        "repeat": repeat, "slow_repeat": slow_repeat, "attendance": attendance,
+        "payments": payments, "backends": list(backends)}, "results": {}}
+    for count in sizes:
+        workdir = tempfile.mkdtemp(prefix="omna-bench-")
+        try:
+            json_file = os.path.join(workdir, BACKENDS["json"][1])
+            start = time.perf_counter()
+            write_roster(json_file, count, attendance, payments)
+            results = {"generate_s": time.perf_counter() - start,
+                       "roster_bytes": os.path.getsize(json_file)}
+            for backend in backends:
+                if progress:
+                    progress(f"{count} students: {backend}")
+                # Every backend starts from the same pristine roster
+                path = os.path.join(workdir, backend, BACKENDS[backend][1])
+                os.makedirs(os.path.dirname(path))
+                start = time.perf_counter()
+                if backend == "sqlite":
+                    migrate_json_to_sqlite(json_file, path)
+                else:
+                    # Saved once so the roster is in the current snapshot format
+                    shutil.copyfile(json_file, path)
+                    model = StudentModel(path)
+                    model.save_data()
+                    model.close()
+                results.setdefault("prepare_s", {})[backend] = time.perf_counter() - start
+                results[backend] = bench_backend(backend, path, count, repeat, slow_repeat, memory)
+            report["results"][str(count)] = results
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if memory:
+        report["history_memory"] = history_memory()
+    return report
+
+
+def environment():
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__ if np is not None else None,
+    }
+
+
+def compare_reports(baseline, report, factor=REGRESSION_FACTOR):
+    # Operations whose p50 got slower than factor times the baseline
+    regressions = []
+    for count, results in report["results"].items():
+        for backend in report["config"]["backends"]:
+            old = baseline.get("results", {}).get(count, {}).get(backend, {}).get("operations", {})
+            for name, stats in results[backend]["operations"].items():
+                if name in old and stats["p50_ms"] > factor * old[name]["p50_ms"]:
+                    regressions.append((count, backend, name, old[name]["p50_ms"], stats["p50_ms"]))
+    return regressions
+
+
+def print_report(report):
+    backends = report["config"]["backends"]
+    history = report.get("history_memory")
+    if history:
+        print(f"Attendance row: {history['dict_bytes_per_row']:.0f} bytes as a dict, "
+              f"{history['compact_bytes_per_row']:.0f} bytes compact ({history['reduction']:.1f}x smaller)")
+    for count, results in report["results"].items():
+        print(f"\n{count} students ({results['roster_bytes'] / 2 ** 20:.1f} MB of JSON)")
+        print(f"{'operation':<20}" + "".join(f"{b + ' p50/p99 (ms)':>28}{'ops/s':>10}" for b in backends))
+        names = list(results[backends[0]]["operations"])
+        for backend in backends[1:]:
+            names += [n for n in results[backend]["operations"] if n not in names]
+        for name in names:
+            line = f"{name:<20}"
+            for backend in backends:
+                stats = results[backend]["operations"].get(name)
+                if stats is None:
+                    line += f"{'-':>28}{'-':>10}"
+                else:
+                    line += f"{stats['p50_ms']:>17.3f} / {stats['p99_ms']:<8.3f}{stats['ops_per_s']:>10.0f}"
+            print(line)
+        for backend in backends:
+            memory = results[backend].get("memory")
+            if memory:
+                print(f"{backend}: load peak {memory['load_peak_bytes'] / 2 ** 20:.1f} MB, "
+                      f"resident {memory['resident_bytes'] / 2 ** 20:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless benchmark of the storage backends")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma separated roster sizes (default: 1000,10000,100000,1000000)")
+    parser.add_argument("--backends", default="json,sqlite", help="comma separated backends to run")
+    parser.add_argument("--repeat", type=int, default=100, help="calls per timed operation")
+    parser.add_argument("--slow-repeat", type=int, default=3, help="calls of load_data and save_data")
+    parser.add_argument("--attendance", type=int, default=10,
+                        help="average attendance records per student")
+    parser.add_argument("--payments", type=int, default=3, help="average payments per student")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to check for regressions")
+    args = parser.parse_args()
+
+    report = run_suite([int(s) for s in args.sizes.split(",")], args.repeat, args.slow_repeat,
+                       [b for b in args.backends.split(",") if b], args.attendance, args.payments,
+                       memory=not args.no_memory,
+                       progress=lambda message: print(message, file=sys.stderr))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_reports(json.load(f), report)
+        for count, backend, name, old, new in regressions:
+            print(f"REGRESSION {count} {backend} {name}: p50 {old:.3f} ms -> {new:.3f} ms")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,223 @@
+import argparse
+import csv
+import os
+import re
+import zipfile
+from datetime import date, timedelta
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from history import HistoryFile
+from model import STUDENT_FIELDS, open_model
+
+SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+HEADER_ALIASES = {
+    "student_id": "id",
+    "date_of_birth": "dob",
+    "birth_date": "dob",
+    "registration_date": "reg_date",
+}
+# Spreadsheet cells that hold dates, stored by Excel as a day count
+DATE_FIELDS = ("dob", "reg_date")
+EXCEL_EPOCH = date(1899, 12, 30)
+
+EXPORTS = {
+    "students": STUDENT_FIELDS,
+    "attendance": ("student_id", "date", "status", "notes", "timestamp"),
+    "payments": ("student_id", "date", "amount", "description", "timestamp"),
+}
+
+
+def header_key(name):
+    key = re.sub(r"[\s\-]+", "_", str(name or "").strip().lower())
+    return HEADER_ALIASES.get(key, key)
+
+
+def read_csv(path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        # Excel saves CSV with ";" in French locales
+        try:
+            dialect = csv.Sniffer().sniff(f.read(4096), delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        reader = csv.reader(f, dialect)
+        header = [header_key(h) for h in next(reader, [])]
+        for values in reader:
+            if any(v.strip() for v in values):
+                yield dict(zip(header, values))
+
+
+def _column_index(ref):
+    index = 0
+    for c in ref:
+        if not c.isalpha():
+            break
+        index = index * 26 + ord(c.upper()) - ord("A") + 1
+    return index - 1
+
+
+def read_xlsx(path):
+    # Streams the first worksheet row by row, only the shared strings are held in memory
+    with zipfile.ZipFile(path) as book:
+        shared = []
+        if "xl/sharedStrings.xml" in book.namelist():
+            with book.open("xl/sharedStrings.xml") as f:
+                for _, elem in ElementTree.iterparse(f):
+                    if elem.tag == SHEET_NS + "si":
+                        shared.append("".join(t.text or "" for t in elem.iter(SHEET_NS + "t")))
+                        elem.clear()
+        sheet = sorted(n for n in book.namelist() if n.startswith("xl/worksheets/sheet"))[0]
+        header = None
+        with book.open(sheet) as f:
+            for _, elem in ElementTree.iterparse(f):
+                if elem.tag != SHEET_NS + "row":
+                    continue
+                values = {}
+                column = 0
+                for cell in elem.iter(SHEET_NS + "c"):
+                    kind = cell.get("t")
+                    if kind == "inlineStr":
+                        value = "".join(t.text or "" for t in cell.iter(SHEET_NS + "t"))
+                    else:
+                        v = cell.find(SHEET_NS + "v")
+                        value = v.text if v is not None and v.text is not None else ""
+                        if kind == "s":
+                            value = shared[int(value)]
+                    # The cell reference is optional, cells then follow each other
+                    if cell.get("r"):
+                        column = _column_index(cell.get("r"))
+                    values[column] = value
+                    column += 1
+                elem.clear()
+                row = [values.get(i, "") for i in range(max(values) + 1)] if values else []
+                if header is None:
+                    header = [header_key(h) for h in row]
+                    continue
+                if not any(str(v).strip() for v in row):
+                    continue
+                record = dict(zip(header, row))
+                for field in DATE_FIELDS:
+                    value = record.get(field, "")
+                    if re.fullmatch(r"\d+(\.0+)?", value):
+                        day = EXCEL_EPOCH + timedelta(days=int(float(value)))
+                        record[field] = day.strftime("%d/%m/%Y")
+                yield record
+
+
+def read_rows(path):
+    if os.path.splitext(path)[1].lower() == ".xlsx":
+        return read_xlsx(path)
+    return read_csv(path)
+
+
+def export_rows(model, kind):
+    # Streamed a batch at a time, the histories are only read for their own exports
+    for batch in model.report_batches(histories=kind != "students"):
+        for profile, _, history in batch:
+            if kind == "students":
+                yield [profile[field] for field in STUDENT_FIELDS]
+                continue
+            # An encoded line from the JSON backend, record lists from SQLite
+            attendance, payments = HistoryFile.decode(history) if isinstance(history, bytes) else history
+            for record in attendance if kind == "attendance" else payments:
+                yield [profile["id"]] + [record.get(field, "") for field in EXPORTS[kind][1:]]
+
+
+def write_csv(path, header, rows):
+    count = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def _xlsx_cell(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f"<c><v>{value}</v></c>"
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>'
+
+
+def write_xlsx(path, header, rows, sheet_name="Sheet1"):
+    # Minimal single-sheet workbook, rows are streamed into the archive
+    count = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as book:
+        book.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'))
+        book.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'))
+        book.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(sheet_name)}" sheetId="1" r:id="rId1"/></sheets></workbook>'))
+        book.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'))
+        with book.open("xl/worksheets/sheet1.xml", "w") as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            f.write(("<row>" + "".join(_xlsx_cell(h) for h in header) + "</row>").encode("utf-8"))
+            for row in rows:
+                f.write(("<row>" + "".join(_xlsx_cell(v) for v in row) + "</row>").encode("utf-8"))
+                count += 1
+            f.write(b"</sheetData></worksheet>")
+    return count
+
+
+def export_data(model, kind, path):
+    # Returns the number of rows written
+    header = EXPORTS[kind]
+    rows = export_rows(model, kind)
+    if os.path.splitext(path)[1].lower() == ".xlsx":
+        return write_xlsx(path, header, rows, sheet_name=kind.title())
+    return write_csv(path, header, rows)
+
+
+def import_file(model, path, progress=None):
+    return model.import_students(read_rows(path), progress=progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import and export of student data")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json",
+                        help="storage backend (default: json)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="import students from a .csv or .xlsx file")
+    import_parser.add_argument("file")
+    export_parser = commands.add_parser("export", help="export data to a .csv or .xlsx file")
+    export_parser.add_argument("kind", choices=sorted(EXPORTS))
+    export_parser.add_argument("file")
+    args = parser.parse_args()
+
+    model = open_model(args.backend)
+    try:
+        if args.command == "import":
+            summary = import_file(model, args.file,
+                                  progress=lambda s: print(f"{s['imported']} imported...", end="\r"))
+            print(f"Imported {summary['imported']} students, skipped {summary['duplicates']} duplicates.")
+            for line, message in summary["errors"]:
+                print(f"Line {line}: {message}")
+        else:
+            count = export_data(model, args.kind, args.file)
+            print(f"Exported {count} rows to {args.file}")
+    finally:
+        model.close()
+
+
+if __name__ == "__main__":
+    main()
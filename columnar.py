@@ -0,0 +1,300 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import repeat
+
+try:
+    import numpy as np
+except ImportError:
+    # Reports fall back to plain loops over the same buffers
+    np = None
+
+STATUSES = ["Present", "Absent", "Late"]
+ABSENT = STATUSES.index("Absent")
+
+
+def date_key(date):
+    # "2024-10-07" -> 20241007, 0 when the date can't be read
+    try:
+        return int(date[0:4]) * 10000 + int(date[5:7]) * 100 + int(date[8:10])
+    except (TypeError, ValueError):
+        return 0
+
+
+def day_label(key):
+    return f"{key // 10000:04d}-{key // 100 % 100:02d}-{key % 100:02d}"
+
+
+def month_label(month_key):
+    return f"{month_key // 100:04d}-{month_key % 100:02d}"
+
+
+def to_cents(amount):
+    try:
+        return int(round(float(amount) * 100))
+    except (TypeError, ValueError):
+        return 0
+
+
+def status_table(labels, groups, status_names):
+    # One row of status counts per label, with the attendance rate
+    table = {}
+    for label, counts in zip(labels, groups):
+        total = sum(counts)
+        if not total:
+            continue
+        row = {name: int(count) for name, count in zip(status_names, counts)}
+        row["total"] = int(total)
+        # Late students were there, only absences count against the rate
+        row["rate"] = (total - counts[ABSENT]) / total
+        table[label] = row
+    return table
+
+
+class HistoryColumns:
+    """Attendance and payment history of every student as flat typed columns.
+
+    Rows point at a student slot rather than an ID. Deleted students keep
+    their slot and are masked out of the reports. With NumPy installed the
+    reports run vectorized over zero-copy views of the buffers.
+    """
+
+    def __init__(self):
+        self.slot_of = {}
+        self.student_ids = []
+        self.level_names = []
+        self._level_codes = {}
+        self.levels = array("h")
+        self.alive = array("b")
+        self.status_names = list(STATUSES)
+        self._status_codes = {name: code for code, name in enumerate(STATUSES)}
+
+        self.att_student = array("i")
+        self.att_date = array("i")
+        self.att_status = array("b")
+        self.pay_student = array("i")
+        self.pay_date = array("i")
+        self.pay_cents = array("q")
+        # Attendance rows by date key, and the sorted keys, built on the
+        # first date query
+        self._by_date = None
+        self._dates = None
+
+    def build(self, students):
+        for student in students:
+            slot = self.add_student(student)
+            attendance = student.get("attendance", [])
+            payments = student.get("payments", [])
+            if hasattr(attendance, "report_columns"):
+                # Compact histories hand over whole columns
+                dates, statuses = attendance.report_columns()
+                self.att_student.extend(repeat(slot, len(dates)))
+                self.att_date.extend(dates)
+                self.att_status.extend(map(self._status_code, statuses))
+                dates, cents = payments.report_columns()
+                self.pay_student.extend(repeat(slot, len(dates)))
+                self.pay_date.extend(dates)
+                self.pay_cents.extend(cents)
+                continue
+            for record in attendance:
+                self._add_attendance(slot, record)
+            for record in payments:
+                self._add_payment(slot, record)
+
+    def copy(self):
+        # Detached copy the reports can run over without the model lock,
+        # without the date index
+        columns = HistoryColumns()
+        columns.slot_of = dict(self.slot_of)
+        columns.student_ids = self.student_ids[:]
+        columns.level_names = self.level_names[:]
+        columns._level_codes = dict(self._level_codes)
+        columns.status_names = self.status_names[:]
+        columns._status_codes = dict(self._status_codes)
+        for name in ("levels", "alive", "att_student", "att_date", "att_status", "pay_student", "pay_date",
+                     "pay_cents"):
+            setattr(columns, name, getattr(self, name)[:])
+        return columns
+
+    def _level_code(self, level):
+        code = self._level_codes.get(level)
+        if code is None:
+            code = self._level_codes[level] = len(self.level_names)
+            self.level_names.append(level)
+        return code
+
+    def _status_code(self, status):
+        code = self._status_codes.get(status)
+        if code is None:
+            code = self._status_codes[status] = len(self.status_names)
+            self.status_names.append(status)
+        return code
+
+    def add_student(self, student):
+        slot = len(self.student_ids)
+        self.slot_of[student.get("id")] = slot
+        self.student_ids.append(student.get("id"))
+        self.levels.append(self._level_code(student.get("level") or ""))
+        self.alive.append(1)
+        return slot
+
+    def remove_student(self, student_id):
+        slot = self.slot_of.pop(student_id, None)
+        if slot is not None:
+            self.alive[slot] = 0
+
+    def update_student(self, old_id, student):
+        slot = self.slot_of.pop(old_id, None)
+        if slot is None:
+            return
+        self.slot_of[student.get("id")] = slot
+        self.student_ids[slot] = student.get("id")
+        self.levels[slot] = self._level_code(student.get("level") or "")
+
+    def _add_attendance(self, slot, record):
+        key = date_key(record.get("date"))
+        if self._by_date is not None:
+            if key not in self._by_date:
+                self._by_date[key] = array("i")
+                insort(self._dates, key)
+            self._by_date[key].append(len(self.att_date))
+        self.att_student.append(slot)
+        self.att_date.append(key)
+        self.att_status.append(self._status_code(record.get("status")))
+
+    def _date_index(self):
+        if self._by_date is None:
+            by_date = {}
+            if np is not None:
+                dates = np.frombuffer(self.att_date, dtype=np.int32)
+                order = np.argsort(dates, kind="stable")
+                keys, starts = np.unique(dates[order], return_index=True)
+                bounds = starts.tolist() + [len(order)]
+                for i, key in enumerate(keys.tolist()):
+                    by_date[key] = array("i", order[bounds[i]:bounds[i + 1]].astype(np.int32).tobytes())
+            else:
+                for row, key in enumerate(self.att_date):
+                    by_date.setdefault(key, array("i")).append(row)
+            self._dates = sorted(by_date)
+            self._by_date = by_date
+        return self._by_date
+
+    def attendance_between(self, start, end, status=None):
+        # (date, student id, status) of the attendance dated start to end
+        # (yyyymmdd keys, both included), by date then in the order recorded
+        by_date = self._date_index()
+        code = None if status is None else self._status_codes.get(status, -1)
+        rows = []
+        for key in self._dates[bisect_left(self._dates, max(start, 1)):bisect_right(self._dates, end)]:
+            label = day_label(key)
+            for row in by_date[key]:
+                slot = self.att_student[row]
+                if self.alive[slot] and (code is None or self.att_status[row] == code):
+                    rows.append((label, self.student_ids[slot], self.status_names[self.att_status[row]]))
+        return rows
+
+    def _add_payment(self, slot, record):
+        self.pay_student.append(slot)
+        self.pay_date.append(date_key(record.get("date")))
+        self.pay_cents.append(to_cents(record.get("amount")))
+
+    def add_attendance(self, student_id, record):
+        self._add_attendance(self.slot_of[student_id], record)
+
+    def add_payment(self, student_id, record):
+        self._add_payment(self.slot_of[student_id], record)
+
+    def attendance_by_level(self):
+        n_status = len(self.status_names)
+        n_levels = len(self.level_names)
+        if np is not None:
+            student = np.frombuffer(self.att_student, dtype=np.int32)
+            mask = np.frombuffer(self.alive, dtype=np.int8)[student].astype(bool)
+            level = np.frombuffer(self.levels, dtype=np.int16)[student[mask]].astype(np.int64)
+            status = np.frombuffer(self.att_status, dtype=np.int8)[mask]
+            counts = np.bincount(level * n_status + status, minlength=n_levels * n_status)
+            groups = counts.reshape(n_levels, n_status).tolist()
+        else:
+            groups = [[0] * n_status for _ in range(n_levels)]
+            for slot, status in zip(self.att_student, self.att_status):
+                if self.alive[slot]:
+                    groups[self.levels[slot]][status] += 1
+        return status_table(self.level_names, groups, self.status_names)
+
+    def attendance_by_month(self):
+        n_status = len(self.status_names)
+        if np is not None:
+            student = np.frombuffer(self.att_student, dtype=np.int32)
+            mask = np.frombuffer(self.alive, dtype=np.int8)[student].astype(bool)
+            month = np.frombuffer(self.att_date, dtype=np.int32)[mask] // 100
+            status = np.frombuffer(self.att_status, dtype=np.int8)[mask]
+            months, inverse = np.unique(month, return_inverse=True)
+            counts = np.bincount(inverse * n_status + status, minlength=len(months) * n_status)
+            months = months.tolist()
+            groups = counts.reshape(len(months), n_status).tolist()
+        else:
+            by_month = {}
+            for slot, date, status in zip(self.att_student, self.att_date, self.att_status):
+                if self.alive[slot]:
+                    by_month.setdefault(date // 100, [0] * n_status)[status] += 1
+            months = sorted(by_month)
+            groups = [by_month[m] for m in months]
+        # Month 0 holds the records whose date could not be read
+        return status_table([month_label(m) for m in months if m],
+                            [g for m, g in zip(months, groups) if m], self.status_names)
+
+    def absentee_leaderboard(self, limit=10):
+        if np is not None:
+            student = np.frombuffer(self.att_student, dtype=np.int32)
+            absent = np.frombuffer(self.att_status, dtype=np.int8) == ABSENT
+            counts = np.bincount(student[absent], minlength=len(self.student_ids))
+            counts = counts * np.frombuffer(self.alive, dtype=np.int8)
+            top = np.argsort(-counts, kind="stable")[:limit]
+            return [(self.student_ids[s], int(counts[s])) for s in top.tolist() if counts[s]]
+        counts = {}
+        for slot, status in zip(self.att_student, self.att_status):
+            if status == ABSENT and self.alive[slot]:
+                counts[slot] = counts.get(slot, 0) + 1
+        top = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(self.student_ids[slot], count) for slot, count in top]
+
+    def revenue_by_month(self):
+        if np is not None:
+            student = np.frombuffer(self.pay_student, dtype=np.int32)
+            mask = np.frombuffer(self.alive, dtype=np.int8)[student].astype(bool)
+            month = np.frombuffer(self.pay_date, dtype=np.int32)[mask] // 100
+            cents = np.frombuffer(self.pay_cents, dtype=np.int64)[mask]
+            months, inverse = np.unique(month, return_inverse=True)
+            totals = np.bincount(inverse, weights=cents, minlength=len(months))
+            by_month = dict(zip(months.tolist(), totals.tolist()))
+        else:
+            by_month = {}
+            for slot, date, cents in zip(self.pay_student, self.pay_date, self.pay_cents):
+                if self.alive[slot]:
+                    by_month[date // 100] = by_month.get(date // 100, 0) + cents
+        return {month_label(m): round(by_month[m]) / 100 for m in sorted(by_month) if m}
+
+    def outstanding_balances(self, monthly_fees, months):
+        # What each student still owes for the given "YYYY-MM" months, largest first
+        month_keys = {int(m[0:4]) * 100 + int(m[5:7]) for m in months}
+        fee_cents = [to_cents(monthly_fees.get(level, 0)) * len(month_keys)
+                     for level in self.level_names]
+        if np is not None:
+            student = np.frombuffer(self.pay_student, dtype=np.int32)
+            month = np.frombuffer(self.pay_date, dtype=np.int32) // 100
+            in_period = np.isin(month, list(month_keys))
+            paid = np.bincount(student[in_period],
+                               weights=np.frombuffer(self.pay_cents, dtype=np.int64)[in_period],
+                               minlength=len(self.student_ids))
+            due = np.array(fee_cents, dtype=np.int64)[np.frombuffer(self.levels, dtype=np.int16)]
+            owed = (due - paid) * np.frombuffer(self.alive, dtype=np.int8)
+            order = np.argsort(-owed, kind="stable")
+            return [(self.student_ids[s], round(owed[s]) / 100)
+                    for s in order.tolist() if owed[s] > 0]
+        paid = [0] * len(self.student_ids)
+        for slot, date, cents in zip(self.pay_student, self.pay_date, self.pay_cents):
+            if date // 100 in month_keys:
+                paid[slot] += cents
+        owed = [(self.student_ids[slot], fee_cents[self.levels[slot]] - paid[slot])
+                for slot in range(len(self.student_ids)) if self.alive[slot]]
+        owed.sort(key=lambda item: -item[1])
+        return [(student_id, cents / 100) for student_id, cents in owed if cents > 0]
@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """Advisory lock shared by every process opening the same lock file.
+
+    Nested acquires from the thread holding it only count, so code that
+    already holds it can call code that takes it again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._depth = 0
+        self._owner = threading.RLock()
+
+    def acquire(self, blocking=True):
+        if not self._owner.acquire(blocking):
+            return False
+        if self._depth == 0:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "a+b")
+                locked = self._lock(blocking)
+            except BaseException:
+                self._owner.release()
+                raise
+            if not locked:
+                self._owner.release()
+                return False
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._unlock()
+        self._owner.release()
+
+    def _lock(self, blocking):
+        fd = self._file.fileno()
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+        # msvcrt locks bytes from the current position and never waits for long
+        self._file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+
+    def _unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def close(self):
+        with self._owner:
+            if self._file is not None and self._depth == 0:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SharedCounter:
+    """Number kept in a small file, read and written in place.
+
+    Written under a FileLock, read by other processes without it to find
+    out cheaply whether anything changed.
+    """
+
+    WIDTH = 20
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            # Created empty if needed, then rewritten in place
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            self._file = os.fdopen(fd, "r+b", buffering=0)
+        return self._file
+
+    def read(self):
+        f = self._open()
+        f.seek(0)
+        value = f.read(self.WIDTH)
+        # Empty, or caught halfway through a write
+        return int(value) if len(value) == self.WIDTH and value.isdigit() else 0
+
+    def write(self, value):
+        f = self._open()
+        f.seek(0)
+        f.write(b"%0*d" % (self.WIDTH, value))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,460 @@
+import json
+import os
+import sys
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+
+from columnar import STATUSES, date_key, to_cents
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+# Profile values shared by many students
+INTERNED_FIELDS = ("level", "gender", "reg_date", "address")
+
+# Status codes are shared by every history, new statuses are appended
+STATUS_NAMES = list(STATUSES)
+_status_codes = {name: code for code, name in enumerate(STATUS_NAMES)}
+# Stands for a key the original record did not have
+MISSING = object()
+# Largest amount whose cents are exact in a float
+MAX_AMOUNT = 2 ** 53 / 100
+
+
+# Dates repeat across students, conversions are cached
+_ordinals = {}
+_iso_days = {}
+_date_keys = {}
+
+
+def day_ordinal(value):
+    # "2024-10-07" -> date ordinal, None for anything that wouldn't read back the same
+    ordinal = _ordinals.get(value)
+    if ordinal is not None:
+        return ordinal
+    if isinstance(value, str) and len(value) == 10 and value[4] == "-" and value[7] == "-":
+        try:
+            ordinal = date.fromisoformat(value).toordinal()
+        except ValueError:
+            return None
+        _ordinals[value] = ordinal
+        _iso_days[ordinal] = value
+        return ordinal
+    return None
+
+
+def day_iso(ordinal):
+    # Rows whose date was kept aside have ordinal 0
+    value = _iso_days.get(ordinal)
+    if value is None:
+        value = _iso_days[ordinal] = date.fromordinal(ordinal).isoformat() if ordinal else ""
+    return value
+
+
+def check_day(value):
+    # Date given to a query, raises ValueError unless it reads as YYYY-MM-DD
+    if day_ordinal(value) is None:
+        raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD")
+    return value
+
+
+def bound_ordinal(value, default):
+    # Bound of a date range, default when open
+    if value is None or value == "":
+        return default
+    return day_ordinal(check_day(value))
+
+
+def stamp_micros(value):
+    # Naive ISO timestamp -> microseconds since 1970, None when it wouldn't round-trip
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None and len(value) == (26 if moment.microsecond else 19) and value[10] == "T":
+        return (moment - EPOCH) // MICROSECOND
+    return None
+
+
+def status_code(status):
+    code = _status_codes.get(status)
+    if code is None:
+        code = _status_codes[status] = len(STATUS_NAMES)
+        STATUS_NAMES.append(status)
+    return code
+
+
+class History(ABC):
+    """Compact list of history records, one typed column per field.
+
+    Dates are kept as day ordinals, timestamps as microseconds and free text
+    as interned strings. Values that wouldn't round-trip through a column,
+    and keys the columns don't know, are kept aside per row, so every record
+    reads back exactly as it was added. Indexing and iterating hand out the
+    records as plain dicts built on the fly.
+    """
+
+    __slots__ = ("days", "values", "texts", "stamps", "odd", "_in_order")
+    # Subclasses name their fields as (date, value, text, timestamp)
+    FIELDS = ()
+    VALUE_TYPE = "q"
+
+    def __init__(self, records=()):
+        self.days = array("i")
+        self.values = array(self.VALUE_TYPE)
+        self.texts = []
+        self.stamps = array("q")
+        # row -> {key: raw value}, only for the rows that need it
+        self.odd = None
+        # Whether the rows are in date order, None until checked again
+        self._in_order = None
+        self.extend(records)
+
+    @abstractmethod
+    def _encode(self, value):
+        # Column value, or None when it has to be kept aside
+        pass
+
+    @abstractmethod
+    def _decode(self, code):
+        pass
+
+    @abstractmethod
+    def _decoded_values(self):
+        pass
+
+    def copy(self):
+        # Detached copy of the columns, for a save encoding it without the model lock
+        history = type(self)()
+        history.days = self.days[:]
+        history.values = self.values[:]
+        history.texts = self.texts[:]
+        history.stamps = self.stamps[:]
+        if self.odd is not None:
+            history.odd = {index: dict(odd) for index, odd in self.odd.items()}
+        history._in_order = self._in_order
+        return history
+
+    def append(self, record):
+        self.extend((record,))
+
+    def extend(self, records):
+        width = len(self.FIELDS)
+        split = self._split
+        intern = sys.intern
+        days, values, texts, stamps = (self.days.append, self.values.append,
+                                       self.texts.append, self.stamps.append)
+        self._in_order = None
+        for record in records:
+            day, value, text, stamp = split(record)
+            if day is None or value is None or text.__class__ is not str or stamp is None \
+                    or len(record) != width:
+                day, value, text, stamp = self._set_aside(record, day, value, text, stamp)
+            days(day)
+            values(value)
+            texts(intern(text))
+            stamps(stamp)
+
+    def _split(self, record):
+        # Column values of a record, None where the raw value can't be stored
+        date_key, value_key, text_key, stamp_key = self.FIELDS
+        date_value = record.get(date_key)
+        return (_ordinals.get(date_value) or day_ordinal(date_value),
+                self._encode(record.get(value_key, MISSING)),
+                record.get(text_key, MISSING),
+                stamp_micros(record.get(stamp_key)))
+
+    def _set_aside(self, record, day, value, text, stamp, index=None):
+        # Keeps what the columns can't hold, the columns get placeholders
+        date_key, value_key, text_key, stamp_key = self.FIELDS
+        odd = {}
+        if day is None:
+            day = 0
+            odd[date_key] = record.get(date_key, MISSING)
+        if value is None:
+            value = 0
+            odd[value_key] = record.get(value_key, MISSING)
+        if text.__class__ is not str:
+            odd[text_key] = text
+            text = ""
+        if stamp is None:
+            stamp = 0
+            odd[stamp_key] = record.get(stamp_key, MISSING)
+        odd.update((key, record[key]) for key in record if key not in self.FIELDS)
+        if odd:
+            if self.odd is None:
+                self.odd = {}
+            self.odd[len(self.days) if index is None else index] = odd
+        return day, value, text, stamp
+
+    def to_columns(self):
+        # What the snapshot stores: one list per field, rows with values set aside in full
+        date_key, value_key, text_key, stamp_key = self.FIELDS
+        columns = {date_key: self.days.tolist(), value_key: self.values.tolist(),
+                   text_key: self.texts, stamp_key: self.stamps.tolist()}
+        if self.odd is not None:
+            columns["odd"] = {str(i): self.record(i) for i in self.odd}
+        return columns
+
+    @classmethod
+    def from_columns(cls, columns):
+        date_key, value_key, text_key, stamp_key = cls.FIELDS
+        history = cls()
+        history.days = array("i", columns[date_key])
+        history.values = array(cls.VALUE_TYPE, history._import_values(columns))
+        history.texts = list(map(sys.intern, columns[text_key]))
+        history.stamps = array("q", columns[stamp_key])
+        for index, record in columns.get("odd", {}).items():
+            history._set_aside(record, *history._split(record), index=int(index))
+        return history
+
+    def _import_values(self, columns):
+        return columns[self.FIELDS[1]]
+
+    def field(self, index, key, default=None):
+        if self.odd is not None and index in self.odd and key in self.odd[index]:
+            value = self.odd[index][key]
+            return default if value is MISSING else value
+        date_key, value_key, text_key, stamp_key = self.FIELDS
+        if key == date_key:
+            return day_iso(self.days[index])
+        if key == value_key:
+            return self._decode(self.values[index])
+        if key == text_key:
+            return self.texts[index]
+        if key == stamp_key:
+            return (EPOCH + timedelta(microseconds=self.stamps[index])).isoformat()
+        return default
+
+    def _keys(self, index):
+        odd = self.odd.get(index, {}) if self.odd is not None else {}
+        keys = [key for key in self.FIELDS if odd.get(key) is not MISSING]
+        return keys + [key for key in odd if key not in self.FIELDS]
+
+    def record(self, index):
+        return {key: self.field(index, key) for key in self._keys(index)}
+
+    def to_list(self):
+        date_key, value_key, text_key, stamp_key = self.FIELDS
+        iso = _iso_days.get
+        epoch = EPOCH
+        rows = [{date_key: iso(day) or day_iso(day), value_key: value, text_key: text,
+                 stamp_key: (epoch + timedelta(0, 0, stamp)).isoformat()}
+                for day, value, text, stamp in zip(self.days, self._decoded_values(), self.texts, self.stamps)]
+        if self.odd is not None:
+            for index in self.odd:
+                rows[index] = self.record(index)
+        return rows
+
+    def __len__(self):
+        return len(self.days)
+
+    def _rows_between(self, first, last):
+        # Row numbers dated first to last (day ordinals), in date order. Rows
+        # are usually added in date order, then it is two bisects.
+        days = self.days
+        if self._in_order is None:
+            self._in_order = all(days[i] <= days[i + 1] for i in range(len(days) - 1))
+        if self._in_order:
+            return range(bisect_left(days, first), bisect_right(days, last))
+        return sorted((i for i, day in enumerate(days) if first <= day <= last), key=days.__getitem__)
+
+    def between(self, start=None, end=None):
+        # Records dated start to end ("YYYY-MM-DD", both included, None for
+        # open), in date order. Records with an unreadable date only come
+        # with an open start.
+        rows = self._rows_between(bound_ordinal(start, 0), bound_ordinal(end, sys.maxsize))
+        return [self.record(i) for i in rows]
+
+    def date_span(self):
+        # Dates of the first and last records, None for an empty history
+        # Only rows with a date set aside have day 0
+        days = self.days if self.odd is None else [day for day in self.days if day]
+        if not days:
+            return None, None
+        return day_iso(min(days)), day_iso(max(days))
+
+    def window(self, start=None, end=None):
+        # One page of the history by date, with what is needed to move between pages
+        first, last = self.date_span()
+        return {"records": self.between(start, end), "first": first, "last": last, "total": len(self)}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.record(i) for i in range(*index.indices(len(self.days)))]
+        if index < 0:
+            index += len(self.days)
+        if not 0 <= index < len(self.days):
+            raise IndexError("history index out of range")
+        return self.record(index)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __reversed__(self):
+        return reversed(self.to_list())
+
+    def report_columns(self):
+        # (yyyymmdd date keys, report values) of every row, for HistoryColumns
+        keys = _date_keys
+        dates = [keys.get(day) or keys.setdefault(day, date_key(day_iso(day))) for day in self.days]
+        values = self._report_values()
+        if self.odd is not None:
+            for index in self.odd:
+                record = self.record(index)
+                dates[index] = date_key(record.get(self.FIELDS[0]))
+                values[index] = self._report_value(record.get(self.FIELDS[1]))
+        return dates, values
+
+    def __eq__(self, other):
+        if isinstance(other, History):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_list()!r})"
+
+
+class AttendanceHistory(History):
+    __slots__ = ()
+    FIELDS = ("date", "status", "notes", "timestamp")
+    VALUE_TYPE = "h"
+
+    def _encode(self, status):
+        return status_code(status) if status.__class__ is str else None
+
+    def _decode(self, code):
+        return STATUS_NAMES[code]
+
+    def _decoded_values(self):
+        names = STATUS_NAMES
+        return [names[code] for code in self.values]
+
+    _report_values = _decoded_values
+
+    def _report_value(self, status):
+        return status
+
+    def to_columns(self):
+        columns = super().to_columns()
+        # Codes past the standard statuses depend on the order they were met in
+        if max(self.values, default=0) >= len(STATUSES):
+            columns["status_names"] = STATUS_NAMES[:]
+        return columns
+
+    def _import_values(self, columns):
+        if "status_names" not in columns:
+            return columns["status"]
+        return [status_code(columns["status_names"][code]) for code in columns["status"]]
+
+
+class PaymentHistory(History):
+    __slots__ = ()
+    FIELDS = ("date", "amount", "description", "timestamp")
+
+    def _encode(self, amount):
+        # Amounts are kept in cents. Ints, fractions of a cent and amounts
+        # out of range wouldn't read back the same, they are set aside.
+        if amount.__class__ is float and -MAX_AMOUNT < amount < MAX_AMOUNT:
+            cents = round(amount * 100)
+            if cents / 100 == amount:
+                return cents
+        return None
+
+    def _decode(self, cents):
+        return cents / 100
+
+    def _decoded_values(self):
+        return [cents / 100 for cents in self.values]
+
+    def _report_values(self):
+        return self.values.tolist()
+
+    def _report_value(self, amount):
+        return to_cents(amount)
+
+
+def intern_fields(student):
+    for key in INTERNED_FIELDS:
+        if isinstance(student.get(key), str):
+            student[key] = sys.intern(student[key])
+    return student
+
+
+def compact_student(student):
+    # Swaps the history lists (or snapshot columns) of a student dict for compact histories, in place
+    for key, cls in (("attendance", AttendanceHistory), ("payments", PaymentHistory)):
+        value = student.get(key)
+        if isinstance(value, dict):
+            student[key] = cls.from_columns(value)
+        elif not isinstance(value, History):
+            student[key] = cls(value or ())
+    return intern_fields(student)
+
+
+def plain(value):
+    # json.dumps default= hook for histories
+    if isinstance(value, History):
+        return value.to_columns()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class HistoryFile:
+    """Histories of every student, one JSON line each, read back by offset.
+
+    Written next to the snapshot, which keeps each student's offset, so a
+    history is only parsed when it is needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Opened right away, so the file can still be read once another
+        # process's save has removed it
+        self._file = open(path, "rb")
+        self._position = 0
+        stat = os.fstat(self._file.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+
+    def reader(self):
+        # Second handle on the same file, for a save copying from it without
+        # the model lock. None when the path now names another file.
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        stat = os.fstat(f.fileno())
+        if (stat.st_dev, stat.st_ino) != self.identity:
+            f.close()
+            return None
+        return f
+
+    def read_line(self, offset):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+            self._position = 0
+        # Reads in file order are the common case, they skip the seek
+        if offset != self._position:
+            self._file.seek(offset)
+        line = self._file.readline()
+        self._position = offset + len(line)
+        return line
+
+    def read(self, offset):
+        return self.decode(self.read_line(offset))
+
+    @staticmethod
+    def decode(line):
+        data = json.loads(line)
+        return (AttendanceHistory.from_columns(data["attendance"]),
+                PaymentHistory.from_columns(data["payments"]))
+
+    @staticmethod
+    def encode(attendance, payments):
+        return (json.dumps({"attendance": attendance.to_columns(), "payments": payments.to_columns()},
+                           separators=(",", ":")) + "\n").encode("utf-8")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
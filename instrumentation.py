@@ -0,0 +1,248 @@
+import cProfile
+import functools
+import json
+import math
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Read by the hot paths before doing any bookkeeping
+ENABLED = False
+# Top allocation sites written by a capture
+MEMORY_TOP = 50
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+# Histograms of durations, in seconds, the others count bytes or rows
+_timings = set()
+# (class, metric prefix, method names) of every instrumented class
+_classes = []
+_originals = {}
+_capture = None
+
+
+class Histogram:
+    """Count, total and a log-scale distribution of the values observed.
+
+    Buckets are a quarter of a power of two wide, so quantiles come out
+    within about 20% whatever the scale, from microseconds to megabytes.
+    """
+
+    STEPS = 4
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = math.floor(math.log2(value) * self.STEPS) if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the value at that rank
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: -math.inf if b is None else b):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket is None:
+                    return 0
+                return min(self.max, 2 ** ((bucket + 1) / self.STEPS))
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.quantile(0.50),
+            "p90": self.quantile(0.90),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+def observe(name, value):
+    # One value of a distribution, such as the bytes written by a save
+    if ENABLED:
+        with _lock:
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = _histograms[name] = Histogram()
+            histogram.observe(value)
+
+
+def add(name, amount=1):
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextmanager
+def span(name):
+    # Times a block as the histogram "name" (in seconds)
+    if not ENABLED:
+        yield
+        return
+    _timings.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def _timed(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            observe(name, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument(cls, prefix, extra=()):
+    # Public methods of cls, plus the ones named in extra, get timed while
+    # the instrumentation is enabled; nothing is wrapped otherwise
+    names = [name for name, value in vars(cls).items()
+             if callable(value) and not name.startswith("_") and not isinstance(value, (type, staticmethod, classmethod))]
+    _classes.append((cls, prefix, names + [n for n in extra if n in vars(cls)]))
+    if ENABLED:
+        _wrap(*_classes[-1])
+    return cls
+
+
+def _wrap(cls, prefix, names):
+    for name in names:
+        original = vars(cls)[name]
+        _originals[(cls, name)] = original
+        _timings.add(f"{prefix}.{name}")
+        setattr(cls, name, _timed(f"{prefix}.{name}", original))
+
+
+def enable():
+    global ENABLED
+    if not ENABLED:
+        ENABLED = True
+        for entry in _classes:
+            _wrap(*entry)
+
+
+def disable():
+    global ENABLED
+    if ENABLED:
+        ENABLED = False
+        for (cls, name), original in _originals.items():
+            setattr(cls, name, original)
+        _originals.clear()
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def snapshot():
+    with _lock:
+        return {
+            "enabled": ENABLED,
+            "time": time.time(),
+            "histograms": {name: dict(h.to_dict(), unit="s" if name in _timings else None)
+                           for name, h in sorted(_histograms.items())},
+            "counters": dict(sorted(_counters.items())),
+        }
+
+
+def export(path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f, indent=2)
+    return path
+
+
+# Capture mode: cProfile on every thread that runs model work, plus tracemalloc
+
+def capturing():
+    return _capture is not None
+
+
+def start_capture():
+    # Called from the Tk thread, worker threads join in through profiling()
+    global _capture
+    if _capture is not None:
+        return
+    main = cProfile.Profile()
+    _capture = {"thread": threading.get_ident(), "main": main, "profiles": {}}
+    tracemalloc.start()
+    main.enable()
+
+
+@contextmanager
+def profiling():
+    # Wraps work done on another thread so a capture covers it
+    capture = _capture
+    if capture is None or threading.get_ident() == capture["thread"]:
+        yield
+        return
+    with _lock:
+        profile = capture["profiles"].setdefault(threading.get_ident(), cProfile.Profile())
+    try:
+        profile.enable()
+        enabled = True
+    except ValueError:
+        # Python 3.12 and later: the main profile already sees every thread
+        enabled = False
+    try:
+        yield
+    finally:
+        if enabled:
+            profile.disable()
+
+
+def stop_capture(prefix):
+    # Writes prefix.prof (open with pstats or snakeviz) and prefix-memory.txt
+    global _capture
+    capture, _capture = _capture, None
+    if capture is None:
+        return []
+    capture["main"].disable()
+    memory = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = pstats.Stats(capture["main"])
+    with _lock:
+        profiles = list(capture["profiles"].values())
+    for profile in profiles:
+        try:
+            stats.add(profile)
+        except (TypeError, ValueError):
+            # Never enabled, nothing recorded
+            pass
+    profile_path = prefix + ".prof"
+    stats.dump_stats(profile_path)
+    memory_path = prefix + "-memory.txt"
+    with open(memory_path, "w", encoding="utf-8") as f:
+        for stat in memory.statistics("lineno")[:MEMORY_TOP]:
+            f.write(f"{stat}\n")
+    return [profile_path, memory_path]
+
+
+if os.environ.get("OMNA_INSTRUMENT"):
+    enable()
@@ -0,0 +1,131 @@
+import json
+import os
+
+from history import plain
+from instrumentation import add
+
+
+def _identity(stat):
+    return (stat.st_dev, stat.st_ino)
+
+
+class Journal:
+    """Append-only log of model mutations, one compact JSON record per line.
+
+    Several processes may append to the same journal, each under the model's
+    file lock. Every reader remembers which file it was reading and how far,
+    so it only reads what the others appended since.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rotated_path = path + ".old"
+        self.count = 0
+        # Bytes of the current journal already read or written, and which
+        # file they belong to, to notice when another process rotates it
+        self.offset = 0
+        self._identity = None
+
+    def _read(self, path, offset):
+        # Complete records of path from offset on, returns them with the new offset
+        records = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn write from a crash, nothing valid can follow it
+                    break
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+                offset += len(line)
+            identity = _identity(os.fstat(f.fileno()))
+        return records, offset, identity
+
+    def replay(self):
+        # Records left over from an interrupted compaction come first
+        self.offset = 0
+        self._identity = None
+        self.count = 0
+        if os.path.exists(self.rotated_path):
+            records, _, _ = self._read(self.rotated_path, 0)
+            self.count += len(records)
+            yield from records
+        yield from self.read_new()
+        if self._identity is not None and os.path.getsize(self.path) > self.offset:
+            # Drops a torn write, records appended after it could not be read
+            with open(self.path, "r+b") as f:
+                f.truncate(self.offset)
+
+    def rotated_records(self):
+        # Records of the rotated journal, read without touching this reader's position
+        if not os.path.exists(self.rotated_path):
+            return []
+        return self._read(self.rotated_path, 0)[0]
+
+    def records(self):
+        # Every complete record, the rotated ones first
+        records = self.rotated_records()
+        if os.path.exists(self.path):
+            records += self._read(self.path, 0)[0]
+        return records
+
+    def read_new(self):
+        # Records appended by other processes since the last read or write
+        records = []
+        try:
+            identity = _identity(os.stat(self.path))
+        except FileNotFoundError:
+            identity = None
+        if self._identity is not None and identity != self._identity:
+            # Rotated by another process: the rest of our file is now the
+            # rotated one, if that compaction is still running
+            try:
+                if _identity(os.stat(self.rotated_path)) == self._identity:
+                    records, _, _ = self._read(self.rotated_path, self.offset)
+            except FileNotFoundError:
+                pass
+            self.offset = 0
+            self.count = 0
+            self._identity = None
+        if identity is not None:
+            new, self.offset, self._identity = self._read(self.path, self.offset)
+            records += new
+        self.count += len(records)
+        return records
+
+    def append(self, record, weight=1):
+        # weight counts the changes a batch record stands for. The file is
+        # opened for each record so another process can rotate it meanwhile
+        # (an open file can't be renamed on Windows), and synced before
+        # returning so a change reported done survives a crash.
+        with open(self.path, "a", encoding="utf-8") as f:
+            line = json.dumps(record, separators=(",", ":"), default=plain) + "\n"
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            add("journal.bytes", len(line))
+            self.offset = f.tell()
+            self._identity = _identity(os.fstat(f.fileno()))
+        self.count += weight
+
+    def rotate(self):
+        # Called under the model lock: new records go to a fresh file while
+        # the snapshot covering the rotated one is being written
+        if os.path.exists(self.path):
+            if os.path.exists(self.rotated_path):
+                # A previous compaction never finished, keep its records too
+                with open(self.rotated_path, "a", encoding="utf-8") as dst, \
+                        open(self.path, "r", encoding="utf-8") as src:
+                    dst.write(src.read())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+        self.offset = 0
+        self._identity = None
+        self.count = 0
+
+    def discard_rotated(self):
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
@@ -0,0 +1,135 @@
+import re
+from bisect import bisect_left, insort
+
+from columnar import to_cents
+
+PERIOD_FORMAT = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+
+
+def check_period(period):
+    # Charges are posted per "YYYY-MM" month
+    if not isinstance(period, str) or not PERIOD_FORMAT.match(period):
+        raise ValueError(f"Invalid period '{period}', expected YYYY-MM")
+    return period
+
+
+class Ledger:
+    """Fee schedule, charges posted per period and every student's balance.
+
+    Amounts are integer cents. Each account is [charged, paid], changed in
+    place on every charge and payment, and the students who owe something
+    are kept sorted by amount owed, so the arrears report is a slice.
+    """
+
+    def __init__(self):
+        # level -> cents charged per period
+        self.fees = {}
+        # period -> the fees charged for it
+        self.periods = {}
+        self.accounts = {}
+        # (-owed, student id), largest debt first
+        self._arrears = []
+
+    def build(self, students):
+        for student in students:
+            self.add_student(student)
+        return self
+
+    def _owed_key(self, student_id, account):
+        owed = account[0] - account[1]
+        return (-owed, student_id) if owed > 0 else None
+
+    def _change(self, student_id, charged=0, paid=0):
+        # Moves the student within the arrears index, O(log n) plus the list shift
+        account = self.accounts[student_id]
+        old = self._owed_key(student_id, account)
+        account[0] += charged
+        account[1] += paid
+        new = self._owed_key(student_id, account)
+        if old != new:
+            if old is not None:
+                del self._arrears[bisect_left(self._arrears, old)]
+            if new is not None:
+                insort(self._arrears, new)
+
+    def _reindex(self):
+        self._arrears = sorted(key for key in (self._owed_key(i, a) for i, a in self.accounts.items())
+                               if key is not None)
+
+    def add_student(self, student):
+        self.accounts[student.get("id")] = [0, 0]
+        for record in student.get("payments", []):
+            self.add_payment(student.get("id"), record)
+
+    def remove_student(self, student_id):
+        if student_id in self.accounts:
+            self._change(student_id, *(-amount for amount in self.accounts[student_id]))
+            del self.accounts[student_id]
+
+    def rename_student(self, old_id, new_id):
+        if old_id != new_id and old_id in self.accounts:
+            charged, paid = self.accounts[old_id]
+            self.remove_student(old_id)
+            self.accounts[new_id] = [0, 0]
+            self._change(new_id, charged, paid)
+
+    def add_payment(self, student_id, record):
+        if student_id in self.accounts:
+            self._change(student_id, paid=to_cents(record.get("amount")))
+
+    def set_fees(self, fees):
+        # fees maps levels to cents, a level left out is no longer charged
+        self.fees = {level: cents for level, cents in fees.items() if cents}
+
+    def post(self, period, fees, students):
+        # Charges each of the (student id, level) pairs the fee of its level.
+        # The index is sorted once afterwards instead of per student.
+        self.periods[period] = dict(fees)
+        count = 0
+        for student_id, level in students:
+            cents = fees.get(level)
+            if cents and student_id in self.accounts:
+                self.accounts[student_id][0] += cents
+                count += 1
+        self._reindex()
+        return count
+
+    def balance(self, student_id):
+        account = self.accounts.get(student_id)
+        if account is None:
+            return None
+        return {"charged": account[0] / 100, "paid": account[1] / 100,
+                "owed": (account[0] - account[1]) / 100}
+
+    def arrears(self, limit=None):
+        # Students owing money, largest debt first, with the amount owed
+        keys = self._arrears if limit is None else self._arrears[:limit]
+        return [(student_id, -owed / 100) for owed, student_id in keys]
+
+    def arrears_count(self):
+        return len(self._arrears)
+
+    def to_dict(self):
+        return {"fees": self.fees, "periods": self.periods, "accounts": self.accounts}
+
+    @classmethod
+    def from_dict(cls, data):
+        ledger = cls()
+        ledger.fees = data.get("fees", {})
+        ledger.periods = data.get("periods", {})
+        ledger.accounts = data.get("accounts", {})
+        ledger._reindex()
+        return ledger
+
+    def verify(self, students):
+        # Names of the parts that disagree with a recompute, empty when all match.
+        # Charges can't be recomputed, only the payments and the index.
+        paid = {s.get("id"): sum(to_cents(r.get("amount")) for r in s.get("payments", [])) for s in students}
+        problems = []
+        if paid != {student_id: account[1] for student_id, account in self.accounts.items()}:
+            problems.append("ledger.paid")
+        expected = sorted(key for key in (self._owed_key(i, a) for i, a in self.accounts.items())
+                          if key is not None)
+        if expected != self._arrears:
+            problems.append("ledger.arrears")
+        return problems
@@ -1,104 +1,1047 @@
+import glob
+import hashlib
 import json
 import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+from backup import BackupError, BackupStore, default_directory
+from columnar import HistoryColumns, date_key
+from file_lock import FileLock, SharedCounter
+from history import HistoryFile, check_day, compact_student, intern_fields
+from instrumentation import instrument, observe, span
+from journal import Journal
+from ledger import Ledger, check_period
+from search_index import SearchIndex, normalize
+from stats import StatsCounters, current_month
+
 DATA_FILE = "students.json"
+SNAPSHOT_FORMAT = 6
+# Number of journal records after which the snapshot is rewritten
+COMPACT_EVERY = 1000
+# Seconds after which the journal records written since are backed up
+BACKUP_EVERY = 600
+# Out of date bytes tolerated in the history side file before a save
+# rewrites it instead of appending the changed histories
+HISTORY_SLACK = 1 << 20
+# Students added per journal record during an import
+IMPORT_BATCH = 1000
+
+ALLOWED_LEVELS = [
+    "1ere TSDI", "2eme TSDI",
+    "1ere TSGE", "2eme TSGE",
+    "1ere TGI", "2eme TGI",
+    "1ere OPS"
+]
+STUDENT_FIELDS = ("id", "first_name", "last_name", "dob", "gender", "address",
+                  "phone", "level", "reg_date")
+HISTORY_KINDS = ("attendance", "payments")
+
+
+def clean_student(row):
+    # Keeps the known profile fields of an imported row, raises ValueError if invalid
+    student = {field: str(row.get(field) or "").strip() for field in STUDENT_FIELDS}
+    if not student["id"]:
+        del student["id"]
+    if not student["first_name"] or not student["last_name"]:
+        raise ValueError("First Name and Last Name are required")
+    if student["level"] and student["level"] not in ALLOWED_LEVELS:
+        raise ValueError(f"Unknown level '{student['level']}'")
+    return student
+
+
+def clean_fees(fees):
+    # Fee schedule in cents by level, raises ValueError if invalid
+    cents = {}
+    for level, amount in fees.items():
+        if level not in ALLOWED_LEVELS:
+            raise ValueError(f"Unknown level '{level}'")
+        try:
+            cents[level] = round(float(amount) * 100)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid fee for '{level}'")
+        if cents[level] < 0:
+            raise ValueError(f"Negative fee for '{level}'")
+    return cents
+
+
+class ConflictError(Exception):
+    """An update was made from an old version of a student, and someone
+    else has since changed some of the same fields to other values."""
+
+    def __init__(self, student_id, fields, current):
+        super().__init__(f"Student {student_id} was changed meanwhile by someone else: "
+                         + ", ".join(fields))
+        self.student_id = student_id
+        self.fields = fields
+        # The student as it is now, without the histories
+        self.current = current
+
+
+def seal_snapshot(snapshot):
+    # Appends a checksum of the snapshot text as its last key
+    checksum = hashlib.blake2b(snapshot.encode("utf-8"), digest_size=16).hexdigest()
+    return (snapshot[:-1] + f',"checksum":"{checksum}"}}').encode("utf-8")
+
+
+def read_snapshot(raw):
+    # Parsed data file, raises ValueError if it was damaged
+    data = json.loads(raw)
+    if isinstance(data, dict) and "checksum" in data:
+        body = raw[:raw.rindex(b',"checksum":"')] + b"}"
+        if hashlib.blake2b(body, digest_size=16).hexdigest() != data["checksum"]:
+            raise ValueError("checksum mismatch")
+    return data
+
+
+def check_update(student, data, expected_version):
+    # Raises ConflictError if data would undo someone else's change made after expected_version
+    if expected_version is None or expected_version >= student.get("_version", 1):
+        return
+    changed = student.get("_field_versions", {})
+    fields = [key for key, value in data.items()
+              if changed.get(key, 0) > expected_version and student.get(key) != value]
+    if fields:
+        current = {k: v for k, v in student.items() if k != "attendance" and k != "payments"}
+        raise ConflictError(student.get("id"), fields, current)
+
+
+def check_new_id(student_id, data, exists):
+    # Raises ValueError if data renames the student to an empty or taken ID
+    new_id = data.get("id", student_id)
+    if new_id == student_id:
+        return
+    if not new_id:
+        raise ValueError("ID can't be empty")
+    if exists(new_id):
+        raise ValueError(f"ID {new_id} already exists")
+
+
+def stamp_update(student, data):
+    # Bumps the version of an updated student and remembers which fields it touched
+    version = student.get("_version", 1) + 1
+    student["_version"] = version
+    changed = dict(student.get("_field_versions", {}))
+    changed.update((key, version) for key in data)
+    student["_field_versions"] = changed
+
+
+def dedupe_key(student):
+    phone = "".join(c for c in str(student.get("phone") or "") if c.isdigit())
+    return (normalize(student.get("first_name") or ""), normalize(student.get("last_name") or ""),
+            str(student.get("dob") or "").strip(), phone)
+
 
 class StudentModel:
-    def __init__(self):
-        self.students = self.load_data()
+    def __init__(self, data_file=DATA_FILE):
+        self.data_file = data_file
+        self.lock = threading.RLock()
+        self.seq = 0
+        stem = os.path.splitext(data_file)[0]
+        self.journal = Journal(stem + ".journal")
+        # Other processes may use the same files: writes hold the write lock,
+        # compactions the compaction lock, and the last sequence number
+        # written by anyone tells whether there is anything new to read
+        self._write_lock = FileLock(stem + ".lock")
+        self._compact_lock = FileLock(stem + ".compact.lock")
+        self._last_seq = SharedCounter(stem + ".seq")
+        self._compactor = None
+        self._save_lock = threading.Lock()
+        # id -> student, kept in display (insertion) order
+        self.index = {}
+        self.next_id = 1
+        # Cached lists over the index, dropped whenever the roster changes
+        self._views = {}
+        self.search_index = SearchIndex()
+        # Built on the first report, then kept up to date. While it is being
+        # built the changes are queued in _columns_pending.
+        self._columns = None
+        self._columns_pending = None
+        self._columns_lock = threading.Lock()
+        self.stats = StatsCounters()
+        self.ledger = Ledger()
+        # Histories are read from the side file on first use, until then
+        # the student's offset in it is kept here by ID
+        self._histories = None
+        # Student id -> (offset, length) of an up to date history line in the
+        # side file, and the ids whose history changed since the last save began
+        self._history_refs = {}
+        self._changed = set()
+        # Deltas go to the backups at every compaction and every few minutes,
+        # full backups once a day. Set when the data had to be restored.
+        self.backups = BackupStore(default_directory(data_file))
+        self._backup_thread = None
+        self._backed_up_at = time.monotonic()
+        self.recovered = None
+        self._full_backup_due = False
+        self.load_data()
+
+    @property
+    def students(self):
+        with self.lock:
+            if "students" not in self._views:
+                self._views["students"] = list(self.index.values())
+            # Walks the cached list without copying it, it only grows in place
+            # as students are added. count_students() gives the number.
+            return iter(self._views["students"])
 
     def load_data(self):
-        if os.path.exists(DATA_FILE):
+        # Another process must not fold the journal in while it is being read,
+        # nor a save of this one swap the side file
+        with self._save_lock, self.lock, self._write_lock:
+            students = self._load()
+        if self._full_backup_due:
+            # The restored data starts a new line of backups
+            self.save_data(full_backup=True)
+        return students
+
+    def _load(self):
+        students = []
+        next_id = None
+        stats = None
+        ledger = None
+        history_file = None
+        if os.path.exists(self.data_file):
+            try:
+                data = self._read_snapshot()
+            except (OSError, ValueError) as e:
+                data = self._recover(e)
+            # Older files are a bare list of students
+            if isinstance(data, dict):
+                self.seq = data.get("seq", 0)
+                next_id = data.get("next_id")
+                stats = data.get("stats")
+                ledger = data.get("ledger")
+                history_file = data.get("history_file")
+                students = data.get("students", [])
+            else:
+                students = data
+        if self._histories is not None:
+            self._histories.close()
+        self._history_refs = {}
+        self._changed = set()
+        if history_file:
+            # Only the profiles are loaded now
+            self._histories = HistoryFile(os.path.join(os.path.dirname(self.data_file), history_file))
+            for student in students:
+                intern_fields(student)
+                self._history_refs[student.get("id")] = student.pop("history")
+            if self._history_refs and isinstance(next(iter(self._history_refs.values())), int):
+                # Older files only kept offsets, each line ends where the next one starts
+                offsets = sorted(set(self._history_refs.values()))
+                ends = dict(zip(offsets, offsets[1:] + [data.get("history_size")
+                                                        or os.path.getsize(self._histories.path)]))
+                self._history_refs = {i: (o, ends[o] - o) for i, o in self._history_refs.items()}
+            else:
+                self._history_refs = {i: tuple(ref) for i, ref in self._history_refs.items()}
+        else:
+            # Older files have the histories inline
+            self._histories = None
+            for student in students:
+                compact_student(student)
+        self.index = {s.get("id"): s for s in students}
+        self._views.clear()
+        self.search_index = SearchIndex()
+        self.search_index.build(self.index.values())
+        self._columns = None
+        self._columns_pending = None
+        # Counters are saved with the snapshot, older files get them computed once
+        if stats is not None:
+            self.stats = StatsCounters.from_dict(stats)
+        else:
+            self.stats = StatsCounters().build(self._full_students())
+        if ledger is not None:
+            self.ledger = Ledger.from_dict(ledger)
+        else:
+            # Files written before the ledger: payments only, nothing charged yet
+            self.ledger = Ledger().build(self._full_students())
+        # Files written before the sequence was persisted start after the roster size
+        self.next_id = next_id or len(self.index) + 1
+        for record in self.journal.replay():
+            if record.get("seq", 0) > self.seq:
+                self._apply(record)
+                self.seq = record["seq"]
+        if self._full_backup_due:
+            # After a partial restore the backups hold records past the
+            # restored ones, new records are numbered after them or the
+            # next delta would drop them
+            self.seq = max(self.seq, self.backups.last_seq())
+        if self._last_seq.read() != self.seq:
+            self._last_seq.write(self.seq)
+        return self.students
+
+    def _read_snapshot(self):
+        with open(self.data_file, "rb") as f:
+            data = read_snapshot(f.read())
+        if isinstance(data, dict) and data.get("history_file"):
+            path = os.path.join(os.path.dirname(self.data_file), data["history_file"])
+            # Later saves may have appended to it
+            if "history_size" in data and os.path.getsize(path) < data["history_size"]:
+                raise ValueError(f"{data['history_file']} is incomplete")
+        return data
+
+    def _recover(self, error):
+        # The data file is damaged: a copy is set aside with the journal,
+        # then it is rebuilt from the last good backup and the journal
+        # records since. Nothing is replaced unless the restore succeeds.
+        self.backups.reload()
+        if not any(entry["kind"] == "full" for entry in self.backups.entries()):
+            raise BackupError(f"{self.data_file} is damaged ({error}) and there is no full backup of it")
+        aside = f"{self.data_file}.damaged-{time.time_ns():x}"
+        journal = self.journal.records()
+        copies = []
+        try:
+            for path in (self.data_file, self.journal.rotated_path, self.journal.path):
+                if os.path.exists(path):
+                    copies.append(aside + ("" if path == self.data_file else os.path.splitext(path)[1]))
+                    shutil.copyfile(path, copies[-1])
+            summary = self.backups.restore(self.data_file, journal=journal)
+        except (OSError, BackupError) as e:
+            for path in copies:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise BackupError(f"{self.data_file} is damaged ({error}) and could not be restored: {e}") from e
+        self.recovered = dict(summary, error=str(error), damaged=aside)
+        self._full_backup_due = True
+        return self._read_snapshot()
+
+    def _pull(self):
+        # Applies what other processes wrote since we last read or wrote,
+        # called under both locks. Returns the number of records applied.
+        if self._last_seq.read() <= self.seq:
+            return 0
+        seq = self.seq
+        for record in self.journal.read_new():
+            if record.get("seq", 0) > self.seq + 1:
+                break
+            if record.get("seq", 0) == self.seq + 1:
+                self._apply(record)
+                self.seq = record["seq"]
+        if self.seq < self._last_seq.read():
+            # Some of it was folded into a snapshot before we read it
+            self._load()
+        return self.seq - seq
+
+    def refresh(self):
+        # Cheap when nothing changed: one small read, no lock taken
+        if self._last_seq.read() <= self.seq:
+            return 0
+        with self.lock, self._write_lock:
+            return self._pull()
+
+    @contextmanager
+    def _writing(self):
+        # Decisions made inside see the writes of every process
+        with self.lock, self._write_lock:
+            self._pull()
+            yield
+
+    def save_data(self, blocking=True, full_backup=False):
+        # Full rewrite of the snapshot, the journal is emptied afterwards.
+        # Only one process compacts at a time, returns False when another
+        # one is at it and blocking is false.
+        with self._save_lock:
+            if not self._compact_lock.acquire(blocking):
+                return False
+            try:
+                # Only the copies are taken under the lock, the files are
+                # written while the window and other threads keep reading
+                with self.lock, span("save.locked"):
+                    with self._write_lock:
+                        self._pull()
+                        self.journal.rotate()
+                    capture = self._capture()
+                history_path, size = self._write_histories(capture)
+                snapshot = self._write_snapshot(self._snapshot(capture, history_path, size))
+                with self.lock:
+                    self._install_histories(capture, history_path)
+                seq = capture["seq"]
+                # The rotated records are dropped only once they are backed up
+                backed_up = self._back_up(self.journal.rotated_records())
+                with self._write_lock:
+                    if backed_up:
+                        self.journal.discard_rotated()
+                    self._remove_old_histories()
+                if full_backup or self._full_backup_due or self.backups.full_due():
+                    try:
+                        self.backups.save_full(snapshot, history_path, seq)
+                        self._full_backup_due = False
+                    except OSError:
+                        # Tried again at the next compaction
+                        pass
+            finally:
+                self._compact_lock.release()
+        return True
+
+    def _back_up(self, records):
+        # Called under the compaction lock, False if the backup could not be written
+        self._backed_up_at = time.monotonic()
+        try:
+            self.backups.reload()
+            self.backups.save_delta(records)
+        except OSError:
+            return False
+        return True
+
+    def backup(self, full=False, blocking=True):
+        # Backs up the journal records written since the last backup, or
+        # with full=True compacts and backs up the whole data set
+        if full:
+            return self.save_data(blocking, full_backup=True)
+        with self._save_lock:
+            if not self._compact_lock.acquire(blocking):
+                return False
             try:
-                with open(DATA_FILE, "r") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                return []
-        return []
+                return self._back_up(self.journal.records())
+            finally:
+                self._compact_lock.release()
+
+    def backup_later(self):
+        # In the background, skipped if a compaction is running: it backs up too
+        if self._backup_thread is None or not self._backup_thread.is_alive():
+            self._backup_thread = threading.Thread(target=self.backup, kwargs={"blocking": False}, daemon=True)
+            self._backup_thread.start()
+
+    def _remove_old_histories(self):
+        # Processes still reading an old side file keep it open, so it can go
+        stem = os.path.splitext(self.data_file)[0]
+        for path in glob.glob(glob.escape(stem) + ".history-*.jsonl"):
+            if os.path.abspath(path) != os.path.abspath(self._histories.path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Still open on Windows, removed by a later save
+                    pass
+
+    def _capture(self):
+        # What the snapshot needs, taken under the lock: copies of the
+        # profiles, and for each history either its (offset, length) in the
+        # side file, a [attendance, payments] copy when it changed, or its
+        # line when the side file was replaced
+        histories = self._histories
+        source = histories.reader() if histories is not None else None
+        students = []
+        for student_id, student in self.index.items():
+            row = student.copy()
+            row.pop("attendance", None)
+            row.pop("payments", None)
+            ref = self._history_refs.get(student_id)
+            if ref is None:
+                # Encoded once the lock is released
+                history = [student["attendance"].copy(), student["payments"].copy()]
+            elif source is None:
+                # Another process's save replaced the side file, the lines are copied now
+                history = histories.read_line(ref[0])
+            else:
+                history = ref
+            students.append((row, history))
+        self._changed = set()
+        return {
+            "seq": self.seq,
+            "head": json.dumps({"format": SNAPSHOT_FORMAT, "seq": self.seq, "next_id": self.next_id,
+                                "stats": self.stats.to_dict(), "ledger": self.ledger.to_dict()},
+                               separators=(",", ":")),
+            "students": students,
+            "source": source,
+        }
+
+    def _write_histories(self, capture):
+        # Appends the changed histories to the side file, other processes
+        # keep reading the lines they know. The file is rewritten instead
+        # once it is mostly out of date lines, or when it was replaced.
+        # Returns its path and size, and sets each row's (offset, length).
+        source = capture["source"]
+        students = capture["students"]
+        live = sum(history[1] for _, history in students if isinstance(history, tuple))
+        size = os.fstat(source.fileno()).st_size if source is not None else 0
+        rewrite = source is None or size - live > max(live, HISTORY_SLACK)
+        if rewrite:
+            stem = os.path.splitext(self.data_file)[0]
+            path = f"{stem}.history-{time.time_ns():x}.jsonl"
+            mode = "wb"
+        else:
+            path = source.name
+            mode = "ab"
+        written = 0
+        try:
+            with open(path, mode) as f:
+                offset = f.seek(0, os.SEEK_END)
+                for row, history in students:
+                    if isinstance(history, list):
+                        history = HistoryFile.encode(*history)
+                    elif isinstance(history, tuple):
+                        if not rewrite:
+                            row["history"] = history
+                            continue
+                        source.seek(history[0])
+                        history = source.read(history[1])
+                    f.write(history)
+                    row["history"] = (offset, len(history))
+                    offset += len(history)
+                    written += len(history)
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            if source is not None:
+                source.close()
+        observe("save.history_bytes", written)
+        return path, offset
+
+    def _snapshot(self, capture, history_path, history_size):
+        rows = [row for row, _ in capture["students"]]
+        return (capture["head"][:-1]
+                + f',"history_file":{json.dumps(os.path.basename(history_path))},"history_size":{history_size},'
+                + '"students":' + json.dumps(rows, separators=(",", ":")) + "}")
+
+    def _install_histories(self, capture, history_path):
+        # Under the lock: the students whose history didn't change since the
+        # capture are pointed at their lines in the side file just written
+        if self._histories is None or self._histories.path != history_path:
+            if self._histories is not None:
+                self._histories.close()
+            self._histories = HistoryFile(history_path)
+        for row, _ in capture["students"]:
+            student_id = row.get("id")
+            if student_id in self.index and student_id not in self._changed:
+                self._history_refs[student_id] = row["history"]
 
-    def save_data(self):
-        with open(DATA_FILE, "w") as f:
-            json.dump(self.students, f, indent=4)
+    def _history_changed(self, student_id):
+        # Its line in the side file is out of date, the next save writes it again
+        self._history_refs.pop(student_id, None)
+        self._changed.add(student_id)
+
+    def _hydrate(self, student):
+        # Loads the history of a student that only has its profile so far
+        if "attendance" not in student:
+            offset, _ = self._history_refs[student.get("id")]
+            student["attendance"], student["payments"] = self._histories.read(offset)
+        return student
+
+    def _full_students(self):
+        # Every student with its history, the ones not loaded get a
+        # throwaway copy so reports don't keep all histories in memory
+        for student_id, student in self.index.items():
+            if "attendance" in student:
+                yield student
+            else:
+                attendance, payments = self._histories.read(self._history_refs[student_id][0])
+                yield dict(student, attendance=attendance, payments=payments)
+
+    def _write_snapshot(self, snapshot):
+        # Returns the bytes written, checksum included
+        snapshot = seal_snapshot(snapshot)
+        tmp_file = self.data_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+            observe("save.snapshot_bytes", f.tell())
+        os.replace(tmp_file, self.data_file)
+        return snapshot
+
+    def compact(self, wait=False):
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self.save_data, args=(False,), daemon=True)
+            self._compactor.start()
+        if wait:
+            self._compactor.join()
+
+    def close(self):
+        for thread in (self._compactor, self._backup_thread):
+            if thread is not None:
+                thread.join()
+        if self.journal.count:
+            self.save_data()
+        if self._histories is not None:
+            self._histories.close()
+        self._write_lock.close()
+        self._compact_lock.close()
+        self._last_seq.close()
+
+    def _commit(self, record, weight=1):
+        with self._writing():
+            self.seq += 1
+            record["seq"] = self.seq
+            # Point-in-time restores stop at the last record before a given time
+            record["time"] = round(time.time(), 3)
+            result = self._apply(record)
+            self.journal.append(record, weight)
+            self._last_seq.write(self.seq)
+        if self.journal.count >= COMPACT_EVERY:
+            self.compact()
+        elif time.monotonic() - self._backed_up_at >= BACKUP_EVERY:
+            self.backup_later()
+        return result
+
+    def _apply(self, record, bulk=False):
+        op = record["op"]
+        if op == "batch":
+            # Several changes saved as one journal record
+            return [self._apply(r, bulk=True) for r in record["records"]]
+        if op == "add":
+            student = compact_student(record["student"])
+            self.index[student["id"]] = student
+            self.search_index.add(student, bulk=bulk)
+            self.stats.add_student(student)
+            self.ledger.add_student(student)
+            self._columns_call("add_student", {"id": student["id"], "level": student.get("level")})
+            self.next_id = max(self.next_id, record.get("next_id", 0))
+            self._history_changed(student["id"])
+            self._views_add(student)
+            return student["id"]
+        if op == "delete":
+            student = self.index.pop(record["id"], None)
+            if student is None:
+                return False
+            self.stats.remove_student(self._hydrate(student))
+            self._history_changed(record["id"])
+            self.search_index.remove(record["id"])
+            self.ledger.remove_student(record["id"])
+            self._columns_call("remove_student", record["id"])
+            self._views.clear()
+            return True
+        if op == "fees":
+            self.ledger.set_fees(record["fees"])
+            return True
+        if op == "charge":
+            return self.ledger.post(record["period"], record["fees"],
+                                    ((i, s.get("level")) for i, s in self.index.items()))
+        student = self.index.get(record["id"])
+        if not student:
+            return False
+        self._hydrate(student)
+        if op == "update":
+            old_level = student.get("level")
+            student.update(record["data"])
+            stamp_update(student, record["data"])
+            compact_student(student)
+            new_id = student.get("id")
+            if new_id != record["id"]:
+                self._history_changed(record["id"])
+                self._history_changed(new_id)
+                # Re-key in place so the display order is kept
+                self.index = {(new_id if k == record["id"] else k): v for k, v in self.index.items()}
+                self._views.clear()
+            elif "level" in record["data"]:
+                self._views.clear()
+            self.search_index.update(record["id"], student)
+            self.stats.update_student(record["id"], old_level, student)
+            self.ledger.rename_student(record["id"], new_id)
+            self._columns_call("update_student", record["id"], {"id": new_id, "level": student.get("level")})
+        elif op == "attendance":
+            student["attendance"].append(record["record"])
+            self._history_changed(record["id"])
+            self.stats.add_attendance(record["record"])
+            self._columns_call("add_attendance", record["id"], record["record"])
+        elif op == "payment":
+            student["payments"].append(record["record"])
+            self._history_changed(record["id"])
+            self.stats.add_payment(record["id"], record["record"])
+            self.ledger.add_payment(record["id"], record["record"])
+            self._columns_call("add_payment", record["id"], record["record"])
+        return True
+
+    def _columns_call(self, method, *args):
+        # Keeps the report columns up to date, or queues the change for the
+        # columns being built
+        if self._columns is not None:
+            getattr(self._columns, method)(*args)
+        elif self._columns_pending is not None:
+            self._columns_pending.append((method, args))
+
+    def _views_add(self, student):
+        # New students come last, so the cached lists are extended instead of rebuilt
+        for key, view in self._views.items():
+            if key == "students":
+                view.append(student)
+            elif key == ("ids", None) or key == ("ids", student.get("level")):
+                view.append(student["id"])
 
     def get_all_students(self):
-        return self.students
+        with self.lock:
+            for student in self.index.values():
+                self._hydrate(student)
+            return list(self.students)
 
-    def add_student(self, student_data):
-        # Generate a simple ID if not provided
-        if "id" not in student_data or not student_data["id"]:
-            student_data["id"] = f"S{len(self.students) + 1:04d}"
-        
+    def count_students(self):
+        return len(self.index)
+
+    # Readers take the lock too, writes may come from a worker thread
+    def get_students_by_level(self, level):
+        with self.lock:
+            return [self._hydrate(s) for s in self.index.values() if s.get("level") == level]
+
+    def list_student_ids(self, level=None):
+        # Display-ordered IDs, what the student list pages through
+        key = ("ids", level)
+        with self.lock:
+            if key not in self._views:
+                if level is None:
+                    self._views[key] = list(self.index)
+                else:
+                    self._views[key] = [i for i, s in self.index.items() if s.get("level") == level]
+            # Frozen, the cached list grows in place as students are added
+            return tuple(self._views[key])
+
+    def get_student_summaries(self, student_ids):
+        return [self.index.get(i) for i in student_ids]
+
+    def filter_student_ids(self, query="", level=None):
+        # Search and level filter combined, best matches first, or in display
+        # order without a query
+        with self.lock:
+            if not query.strip():
+                return self.list_student_ids(level)
+            ids = self.search_index.search(query)
+            if level is None:
+                return tuple(ids)
+            wanted = set(self.list_student_ids(level))
+            return tuple(i for i in ids if i in wanted)
+
+    def search_student_ids(self, query, limit=None):
+        with self.lock:
+            return self.search_index.search(query, limit)
+
+    def _add_record(self, student_data):
         # Initialize empty trackers
         student_data["attendance"] = []
         student_data["payments"] = []
-        
-        self.students.append(student_data)
-        self.save_data()
-        return student_data["id"]
+
+        record = {"op": "add", "student": student_data}
+        # Generate a simple ID if not provided, the sequence never goes back
+        # so IDs of deleted students are not handed out again
+        if student_data.get("id") in self.index:
+            raise ValueError(f"ID {student_data['id']} already exists")
+        if "id" not in student_data or not student_data["id"]:
+            while f"S{self.next_id:04d}" in self.index:
+                self.next_id += 1
+            student_data["id"] = f"S{self.next_id:04d}"
+            self.next_id += 1
+            record["next_id"] = self.next_id
+        return record
+
+    def add_student(self, student_data):
+        with self._writing():
+            return self._commit(self._add_record(student_data))
+
+    def import_students(self, rows, batch_size=IMPORT_BATCH, progress=None):
+        # Rows are dicts keyed by field name, each batch is persisted with a single write
+        summary = {"imported": 0, "duplicates": 0, "errors": []}
+        with self.lock:
+            seen = {dedupe_key(s) for s in self.index.values()}
+        batch = []
+
+        def flush():
+            with self._writing():
+                records = []
+                ids = set()
+                for student in batch:
+                    # The ID check has to see the roster as it is now
+                    line = student.pop("_line")
+                    if student.get("id") in self.index or student.get("id") in ids:
+                        summary["errors"].append((line, f"ID {student['id']} already exists"))
+                        continue
+                    records.append(self._add_record(student))
+                    ids.add(student["id"])
+                if records:
+                    self._commit({"op": "batch", "records": records}, weight=len(records))
+                    summary["imported"] += len(records)
+            batch.clear()
+            if progress:
+                progress(summary)
+
+        for line, row in enumerate(rows, start=2):
+            try:
+                student = clean_student(row)
+            except ValueError as e:
+                summary["errors"].append((line, str(e)))
+                continue
+            key = dedupe_key(student)
+            if key in seen:
+                summary["duplicates"] += 1
+                continue
+            seen.add(key)
+            student["_line"] = line
+            batch.append(student)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+        return summary
 
     def delete_student(self, student_id):
-        initial_count = len(self.students)
-        self.students = [s for s in self.students if s.get("id") != student_id]
-        if len(self.students) < initial_count:
-            self.save_data()
-            return True
-        return False
-
-    def update_student(self, student_id, updated_data):
-        for student in self.students:
-            if student.get("id") == student_id:
-                student.update(updated_data)
-                self.save_data()
-                return True
-        return False
-
-    def search_students(self, query):
-        query = query.lower()
-        results = []
-        for student in self.students:
-            if (query in student.get("first_name", "").lower() or 
-                query in student.get("last_name", "").lower() or 
-                query in student.get("id", "").lower()):
-                results.append(student)
-        return results
+        with self._writing():
+            if student_id not in self.index:
+                return False
+            return self._commit({"op": "delete", "id": student_id})
+
+    def update_student(self, student_id, updated_data, expected_version=None):
+        # expected_version is the "_version" the change was made from, fields
+        # changed by others since are merged unless both sides changed them
+        updated_data = {k: v for k, v in updated_data.items() if not k.startswith("_")}
+        with self._writing():
+            student = self.index.get(student_id)
+            if not student:
+                return False
+            check_update(student, updated_data, expected_version)
+            check_new_id(student_id, updated_data, self.index.__contains__)
+            return self._commit({"op": "update", "id": student_id, "data": updated_data})
+
+    def search_students(self, query, limit=None):
+        # Best matches first: exact term, then prefix, then inside a name
+        with self.lock:
+            return [self._hydrate(self.index[i]) for i in self.search_student_ids(query, limit)]
 
     def get_student_by_id(self, student_id):
-        for student in self.students:
-            if student.get("id") == student_id:
-                return student
-        return None
+        with self.lock:
+            student = self.index.get(student_id)
+            return student and self._hydrate(student)
+
+    def get_student_profiles(self, student_ids):
+        # Copies of the profiles, without the histories, None for unknown IDs.
+        # For the threads that read while the model is being written to.
+        with self.lock:
+            return [student and {k: v for k, v in student.items() if k not in HISTORY_KINDS}
+                    for student in map(self.index.get, student_ids)]
+
+    def student_version(self, student_id):
+        # (profile version, attendance count, payment count), changes with
+        # every write to the student, None for an unknown student
+        with self.lock:
+            student = self.index.get(student_id)
+            if student is None:
+                return None
+            self._hydrate(student)
+            return student.get("_version", 1), len(student["attendance"]), len(student["payments"])
+
+    def get_history_page(self, student_id, kind, offset=0, limit=None):
+        # (total, copies of the records from offset) of a student's
+        # "attendance" or "payments" in the order added, None for an unknown student
+        if kind not in HISTORY_KINDS:
+            raise ValueError(f"Unknown history '{kind}'")
+        with self.lock:
+            student = self.index.get(student_id)
+            if student is None:
+                return None
+            records = self._hydrate(student)[kind]
+            end = len(records) if limit is None else offset + limit
+            return len(records), records[offset:end]
+
+    def get_history_window(self, student_id, kind, start=None, end=None):
+        # One page of a student's "attendance" or "payments" by date: the
+        # records dated start to end in date order, plus the dates of the
+        # first and last records and the total, None for an unknown student
+        if kind not in HISTORY_KINDS:
+            raise ValueError(f"Unknown history '{kind}'")
+        with self.lock:
+            student = self.index.get(student_id)
+            return student and self._hydrate(student)[kind].window(start, end)
+
+    def attendance_by_date(self, start, end=None, status=None):
+        # (date, student id, status) of everyone's attendance from start to
+        # end ("YYYY-MM-DD", end defaults to start), e.g. who was absent on a day
+        start, end = date_key(check_day(start)), date_key(check_day(end or start))
+        columns = self.columns
+        with self.lock:
+            return columns.attendance_between(start, end, status)
 
     def add_attendance(self, student_id, date, status, notes=""):
-        student = self.get_student_by_id(student_id)
-        if student:
-            if "attendance" not in student:
-                student["attendance"] = []
-            
-            record = {
-                "date": date,
-                "status": status,
-                "notes": notes,
-                "timestamp": datetime.now().isoformat()
-            }
-            student["attendance"].append(record)
-            self.save_data()
-            return True
-        return False
+        record = {
+            "date": date,
+            "status": status,
+            "notes": notes,
+            "timestamp": datetime.now().isoformat()
+        }
+        with self._writing():
+            if student_id not in self.index:
+                return False
+            return self._commit({"op": "attendance", "id": student_id, "record": record})
+
+    def add_attendance_bulk(self, date, marks):
+        # marks maps student IDs to (status, notes), all saved as one journal record
+        timestamp = datetime.now().isoformat()
+        with self._writing():
+            records = [
+                {"op": "attendance", "id": student_id,
+                 "record": {"date": date, "status": status, "notes": notes, "timestamp": timestamp}}
+                for student_id, (status, notes) in marks.items() if student_id in self.index
+            ]
+            if records:
+                self._commit({"op": "batch", "records": records}, weight=len(records))
+        return len(records)
 
     def add_payment(self, student_id, amount, date, description=""):
-        student = self.get_student_by_id(student_id)
-        if student:
-            if "payments" not in student:
-                student["payments"] = []
-            
-            record = {
-                "date": date,
-                "amount": amount,
-                "description": description,
-                "timestamp": datetime.now().isoformat()
-            }
-            student["payments"].append(record)
-            self.save_data()
-            return True
-        return False
+        record = {
+            "date": date,
+            "amount": amount,
+            "description": description,
+            "timestamp": datetime.now().isoformat()
+        }
+        with self._writing():
+            if student_id not in self.index:
+                return False
+            return self._commit({"op": "payment", "id": student_id, "record": record})
+
+    def dashboard_stats(self, today=None):
+        with self.lock:
+            return self.stats.summary(today)
+
+    def verify_stats(self):
+        with self.lock:
+            return self.stats.verify(self._full_students()) + self.ledger.verify(self._full_students())
+
+    def fee_schedule(self):
+        # Fee per period of each level, levels without a fee are left out
+        with self.lock:
+            return {level: cents / 100 for level, cents in self.ledger.fees.items()}
+
+    def set_fee_schedule(self, fees):
+        # Applies to the periods posted from now on, raises ValueError if invalid
+        return self._commit({"op": "fees", "fees": clean_fees(fees)})
+
+    def post_charges(self, period=None):
+        # Charges every student the fee of their level for the "YYYY-MM" period,
+        # once per period. Returns the number of students charged.
+        period = check_period(period or current_month())
+        with self._writing():
+            if period in self.ledger.periods:
+                raise ValueError(f"Charges for {period} were already posted")
+            return self._commit({"op": "charge", "period": period, "fees": dict(self.ledger.fees)},
+                                weight=len(self.index))
+
+    def posted_periods(self):
+        with self.lock:
+            return sorted(self.ledger.periods)
+
+    def period_fees(self, period):
+        # Fees charged for a posted period, None if it wasn't posted
+        with self.lock:
+            fees = self.ledger.periods.get(period)
+            return None if fees is None else {level: cents / 100 for level, cents in fees.items()}
+
+    def balance(self, student_id):
+        # Charged, paid and owed amounts of a student, None if unknown
+        with self.lock:
+            return self.ledger.balance(student_id)
+
+    def arrears(self, limit=None):
+        # (student id, amount owed) of everyone owing money, largest debt first
+        with self.lock:
+            return self.ledger.arrears(limit)
+
+    def arrears_count(self):
+        with self.lock:
+            return self.ledger.arrears_count()
+
+    def report_batches(self, size=IMPORT_BATCH, histories=True):
+        # Every student in batches of (profile, [charged, paid] cents, history)
+        # for the report workers. The history is its encoded line, so a batch
+        # pickles as a few strings and the workers do the parsing. None with
+        # histories=False, for the readers that only need the profiles.
+        with self.lock:
+            student_ids = list(self.index)
+        for start in range(0, len(student_ids), size):
+            batch = []
+            with self.lock:
+                for student_id in student_ids[start:start + size]:
+                    student = self.index.get(student_id)
+                    if student is None:
+                        continue
+                    ref = self._history_refs.get(student_id)
+                    if not histories:
+                        line = None
+                    elif ref is not None:
+                        line = self._histories.read_line(ref[0])
+                    else:
+                        line = HistoryFile.encode(student["attendance"], student["payments"])
+                    profile = {field: student.get(field, "") for field in STUDENT_FIELDS}
+                    batch.append((profile, list(self.ledger.accounts.get(student_id, (0, 0))), line))
+            yield batch
+
+    @property
+    def columns(self):
+        # Built without the model lock from copies of the histories, or where
+        # they are in the side file. The changes made meanwhile are applied
+        # before the columns are put in place. Not to be used under the lock.
+        with self._columns_lock:
+            while True:
+                with self.lock:
+                    if self._columns is not None:
+                        return self._columns
+                    pending = self._columns_pending = []
+                    students, source = self._column_sources()
+                columns = HistoryColumns()
+                try:
+                    columns.build(self._column_students(students, source))
+                finally:
+                    if source is not None:
+                        source.close()
+                with self.lock:
+                    # Unless the data was loaded again meanwhile
+                    if self._columns_pending is pending:
+                        for method, args in pending:
+                            getattr(columns, method)(*args)
+                        self._columns, self._columns_pending = columns, None
+
+    def _column_sources(self):
+        # Under the lock, as _capture: each student's id and level with its
+        # history's (offset, length), a copy of it when it changed, or its
+        # line when the side file was replaced
+        histories = self._histories
+        source = histories.reader() if histories is not None else None
+        students = []
+        for student_id, student in self.index.items():
+            ref = self._history_refs.get(student_id)
+            if ref is None:
+                history = [student["attendance"].copy(), student["payments"].copy()]
+            elif source is None:
+                history = histories.read_line(ref[0])
+            else:
+                history = ref
+            students.append(({"id": student_id, "level": student.get("level")}, history))
+        return students, source
+
+    @staticmethod
+    def _column_students(students, source):
+        for student, history in students:
+            if isinstance(history, tuple):
+                source.seek(history[0])
+                history = source.read(history[1])
+            if isinstance(history, bytes):
+                history = HistoryFile.decode(history)
+            student["attendance"], student["payments"] = history
+            yield student
+
+    def _report_columns(self):
+        # Copied under the lock, the reports then run without holding it
+        columns = self.columns
+        with self.lock:
+            return columns.copy()
+
+    def attendance_by_level(self):
+        return self._report_columns().attendance_by_level()
+
+    def attendance_by_month(self):
+        return self._report_columns().attendance_by_month()
+
+    def absentee_leaderboard(self, limit=10):
+        return self._report_columns().absentee_leaderboard(limit)
+
+    def revenue_by_month(self):
+        return self._report_columns().revenue_by_month()
+
+    def outstanding_balances(self, monthly_fees, months):
+        return self._report_columns().outstanding_balances(monthly_fees, months)
+
+
+instrument(StudentModel, "model", extra=("_load", "_pull", "_commit", "_capture", "_write_histories",
+                                        "_snapshot", "_write_snapshot"))
+
+
+def open_model(backend="json", path=None):
+    if backend == "sqlite":
+        from sqlite_model import SQLiteStudentModel
+        return SQLiteStudentModel(path) if path else SQLiteStudentModel()
+    return StudentModel(path or DATA_FILE)
@@ -0,0 +1,273 @@
+import argparse
+import calendar
+import csv
+import multiprocessing
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date
+
+from columnar import STATUSES, to_cents
+from history import AttendanceHistory, HistoryFile, PaymentHistory
+from ledger import check_period
+from stats import current_month
+
+FORMATS = ("csv", "pdf")
+# Students per task, each task is one batch read from the model
+REPORT_BATCH = 500
+# Tasks queued per worker, so only a few batches are in memory at a time
+QUEUED_PER_WORKER = 2
+PAGE_LINES = 64
+LINE_WIDTH = 95
+
+# Set in each worker process by _start_worker
+_job = None
+
+
+def slug(value):
+    # File name part made of a level or a student id
+    return re.sub(r"[^\w\-]+", "_", str(value or "")).strip("_") or "none"
+
+
+def money(cents):
+    return f"{cents / 100:.2f}"
+
+
+def month_bounds(period):
+    year, month = map(int, period.split("-"))
+    return f"{period}-01", f"{period}-{calendar.monthrange(year, month)[1]:02d}"
+
+
+def _pdf_text(line):
+    text = line[:LINE_WIDTH].encode("cp1252", "replace")
+    return text.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def write_pdf(path, lines):
+    # Text-only PDF, Courier 9pt on A4 pages, no library needed
+    pages = [lines[i:i + PAGE_LINES] for i in range(0, len(lines), PAGE_LINES)] or [[]]
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>"]
+    kids = []
+    for page in pages:
+        stream = b"BT /F1 9 Tf 11 TL 40 810 Td\n" + b"".join(
+            b"(" + _pdf_text(line) + b") '\n" for line in page) + b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def write_csv(path, rows):
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+def _histories(history):
+    # Encoded line from the JSON backend, record lists from SQLite
+    if isinstance(history, bytes):
+        return HistoryFile.decode(history)
+    return AttendanceHistory(history[0]), PaymentHistory(history[1])
+
+
+def statement(profile, account, history, period, fee):
+    # Attendance and payments of a student over the period, with the balance
+    start, end = month_bounds(period)
+    attendance, payments = _histories(history)
+    days = attendance.between(start, end)
+    paid = payments.between(start, end)
+    counts = dict.fromkeys(STATUSES, 0)
+    for record in days:
+        status = record.get("status")
+        counts[status] = counts.get(status, 0) + 1
+    return {
+        "profile": profile,
+        "name": f"{profile.get('first_name', '')} {profile.get('last_name', '')}".strip(),
+        "attendance": days,
+        "counts": counts,
+        "payments": paid,
+        "paid_cents": sum(to_cents(record.get("amount")) for record in paid),
+        "fee_cents": to_cents(fee),
+        "charged": account[0],
+        "paid": account[1],
+    }
+
+
+def statement_rows(st, period):
+    profile = st["profile"]
+    rows = [["Statement", period], ["Student", profile.get("id"), st["name"], profile.get("level")], [],
+            ["Date", "Attendance", "Notes"]]
+    rows += [[r.get("date"), r.get("status"), r.get("notes", "")] for r in st["attendance"]]
+    rows += [[], ["Date", "Payment", "Description"]]
+    rows += [[r.get("date"), money(to_cents(r.get("amount"))), r.get("description", "")] for r in st["payments"]]
+    rows.append([])
+    rows += [[status, count] for status, count in st["counts"].items()]
+    rows += [["Paid this month", money(st["paid_cents"])], ["Monthly fee", money(st["fee_cents"])],
+             ["Charged to date", money(st["charged"])], ["Paid to date", money(st["paid"])],
+             ["Owed", money(st["charged"] - st["paid"])]]
+    return rows
+
+
+def statement_lines(st, period, generated):
+    profile = st["profile"]
+    counts = ", ".join(f"{count} {status.lower()}" for status, count in st["counts"].items())
+    lines = [f"OMNA Center - Statement for {period}", "",
+             f"Student  {profile.get('id')}  {st['name']}", f"Level    {profile.get('level')}", "",
+             f"Attendance: {counts}"]
+    lines += [f"  {r.get('date', ''):<12}{r.get('status', ''):<10}{r.get('notes', '')}" for r in st["attendance"]]
+    lines += ["", f"Payments this month: {money(st['paid_cents'])}"]
+    lines += [f"  {r.get('date', ''):<12}{money(to_cents(r.get('amount'))):>10}  {r.get('description', '')}"
+              for r in st["payments"]]
+    lines += ["",
+              f"Monthly fee      {money(st['fee_cents']):>10}",
+              f"Charged to date  {money(st['charged']):>10}",
+              f"Paid to date     {money(st['paid']):>10}",
+              f"Owed             {money(st['charged'] - st['paid']):>10}",
+              "", f"Generated on {generated}"]
+    return lines
+
+
+def _start_worker(job):
+    global _job
+    _job = job
+
+
+def _write_batch(batch):
+    # Runs in a worker: writes the statements of a batch, returns one
+    # class report row per student
+    period, directory = _job["period"], _job["directory"]
+    rows = []
+    for profile, account, history in batch:
+        level = profile.get("level", "")
+        st = statement(profile, account, history, period, _job["fees"].get(level, 0))
+        folder = os.path.join(directory, "statements", slug(level))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, slug(profile.get("id")))
+        if "csv" in _job["formats"]:
+            write_csv(path + ".csv", statement_rows(st, period))
+        if "pdf" in _job["formats"]:
+            write_pdf(path + ".pdf", statement_lines(st, period, _job["generated"]))
+        counts = st["counts"]
+        rows.append((level, profile.get("id"), st["name"], counts["Present"], counts["Absent"], counts["Late"],
+                     st["paid_cents"], st["charged"] - st["paid"]))
+    return rows
+
+
+CLASS_HEADER = ("ID", "Name", "Present", "Absent", "Late", "Rate", "Paid", "Owed")
+
+
+def _class_rows(rows):
+    # Late students were there, only absences count against the rate
+    for _, student_id, name, present, absent, late, paid, owed in rows:
+        total = present + absent + late
+        rate = f"{(total - absent) / total:.0%}" if total else "-"
+        yield [student_id, name, present, absent, late, rate, money(paid), money(owed)]
+
+
+def _write_class(level, rows):
+    # Runs in a worker: the report of one level from its students' rows
+    period, directory = _job["period"], _job["directory"]
+    rows = sorted(rows, key=lambda row: str(row[1]))
+    table = list(_class_rows(rows))
+    totals = [sum(row[i] for row in rows) for i in (3, 4, 5, 6, 7)]
+    folder = os.path.join(directory, "classes")
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, slug(level))
+    if "csv" in _job["formats"]:
+        write_csv(path + ".csv", [["Class report", level, period], list(CLASS_HEADER)] + table +
+                  [["Total", len(rows)] + totals[:3] + ["", money(totals[3]), money(totals[4])]])
+    if "pdf" in _job["formats"]:
+        line = "{:<10}{:<30}{:>8}{:>8}{:>6}{:>6}{:>11}{:>11}"
+        lines = [f"OMNA Center - {level or 'No level'} - {period}", "", line.format(*CLASS_HEADER)]
+        lines += [line.format(row[0], row[1][:29], *row[2:]) for row in table]
+        lines += ["", line.format("Total", f"{len(rows)} students", *totals[:3], "",
+                                  money(totals[3]), money(totals[4])),
+                  "", f"Generated on {_job['generated']}"]
+        write_pdf(path + ".pdf", lines)
+    return level
+
+
+def generate_reports(model, directory, period=None, formats=FORMATS, workers=None, progress=None):
+    """Writes the statement of every student and the report of every level
+    for a "YYYY-MM" period under directory/period.
+
+    Students are read from the model one batch at a time and spread over a
+    pool of worker processes, which parse the histories and write the files.
+    progress(done, total) is called in this thread after each batch.
+    """
+    period = check_period(period or current_month())
+    formats = tuple(f for f in FORMATS if f in formats)
+    if not formats:
+        raise ValueError(f"No report format chosen, expected one of {', '.join(FORMATS)}")
+    directory = os.path.join(directory, period)
+    os.makedirs(directory, exist_ok=True)
+    # The fees charged for the period, the current ones if it wasn't posted
+    fees = model.period_fees(period) or model.fee_schedule()
+    job = {"period": period, "directory": directory, "formats": formats, "fees": fees,
+           "generated": date.today().isoformat()}
+    total = model.count_students()
+    workers = workers or os.cpu_count() or 1
+    levels = {}
+    done = 0
+
+    def collect(futures):
+        nonlocal done
+        for future in futures:
+            rows = future.result()
+            for row in rows:
+                levels.setdefault(row[0], []).append(row)
+            done += len(rows)
+        if progress:
+            progress(done, total)
+
+    # Spawned rather than forked: the window and the model have threads running
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_start_worker, initargs=(job,)) as pool:
+        pending = set()
+        for batch in model.report_batches(REPORT_BATCH):
+            if len(pending) >= workers * QUEUED_PER_WORKER:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            pending.add(pool.submit(_write_batch, batch))
+        collect(wait(pending).done)
+        list(pool.map(_write_class, levels, levels.values()))
+    return {"directory": directory, "statements": done, "classes": len(levels), "formats": formats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly student statements and class reports")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json",
+                        help="storage backend (default: json)")
+    parser.add_argument("--data", help="data file (default: students.json or students.db)")
+    parser.add_argument("--month", help="YYYY-MM (default: this month)")
+    parser.add_argument("--output", default="reports", help="directory (default: reports)")
+    parser.add_argument("--formats", default="csv,pdf", help="csv, pdf or both (default: csv,pdf)")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    from model import open_model
+    model = open_model(args.backend, args.data)
+    try:
+        summary = generate_reports(model, args.output, args.month, args.formats.split(","), args.workers,
+                                   progress=lambda done, total: print(f"{done}/{total} statements...", end="\r"))
+        print(f"Wrote {summary['statements']} statements and {summary['classes']} class reports "
+              f"to {summary['directory']}")
+    finally:
+        model.close()
+
+
+if __name__ == "__main__":
+    main()
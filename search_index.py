@@ -0,0 +1,235 @@
+import bisect
+import functools
+import heapq
+import itertools
+import re
+import unicodedata
+
+NAME_FIELDS = ("first_name", "last_name")
+WORD_SPLIT = re.compile(r"[\s\-']+")
+NON_DIGITS = re.compile(r"\D")
+ID_PREFIX = "abcdefghijklmnopqrstuvwxyz"
+# Above this many matching terms, merging them one by one costs more than sorting
+MERGE_LIMIT = 64
+# Ranks, lower is better
+EXACT, PREFIX, SUBSTRING = 0, 1, 2
+# Sorts after every term starting with a given prefix
+LAST_CHAR = chr(0x10FFFF)
+
+
+def normalize(text):
+    # "Hélène" -> "helene", "François" -> "francois"
+    text = str(text)
+    if text.isascii():
+        return text.lower().strip()
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c)).lower().strip()
+
+
+@functools.lru_cache(maxsize=65536)
+def name_words(name):
+    # Cached, the same names come back over and over in a roster
+    return tuple(w for w in WORD_SPLIT.split(normalize(name)) if w)
+
+
+def trigrams(term):
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+def student_terms(student):
+    terms = set()
+    for field in NAME_FIELDS:
+        terms.update(name_words(student.get(field) or ""))
+    student_id = normalize(student.get("id") or "")
+    if student_id:
+        terms.add(student_id)
+        # "S0012" can also be found as "12"
+        digits = student_id.lstrip(ID_PREFIX).lstrip("0")
+        if digits:
+            terms.add(digits)
+    phone = NON_DIGITS.sub("", str(student.get("phone") or ""))
+    if phone:
+        terms.add(phone)
+    return terms
+
+
+class SearchIndex:
+    """Inverted index over student names, IDs and phone numbers.
+
+    Terms are kept sorted for prefix lookups, and also indexed by trigram so
+    a query can match inside a term ("dris" finds "El Idrissi", "345" a
+    phone number).
+    Each term lists the roster positions of its students in ascending order,
+    so the first results of a query come out of a merge without a full sort.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.sorted_terms = []
+        self.grams = {}
+        self.terms_of = {}
+        self.position = {}
+        self.id_at = {}
+        self._counter = 0
+        self._pending_terms = []
+
+    def build(self, students):
+        for student in students:
+            self.add(student, bulk=True)
+        self.flush()
+
+    def add(self, student, position=None, bulk=False):
+        # In bulk mode new terms are only sorted in by the next flush(), which
+        # lookups and removals run first, so an import merges them once
+        if position is None:
+            self._counter += 1
+            position = self._counter
+        self._add(student, position, bulk)
+
+    def flush(self):
+        if self._pending_terms:
+            self._pending_terms.sort()
+            self.sorted_terms = list(heapq.merge(self.sorted_terms, self._pending_terms))
+            self._pending_terms = []
+
+    def _add(self, student, position, bulk=False):
+        student_id = student.get("id")
+        terms = student_terms(student)
+        self.terms_of[student_id] = terms
+        self.position[student_id] = position
+        self.id_at[position] = student_id
+        for term in terms:
+            positions = self.postings.get(term)
+            if positions is None:
+                positions = self.postings[term] = []
+                if bulk:
+                    self._pending_terms.append(term)
+                else:
+                    bisect.insort(self.sorted_terms, term)
+                for gram in trigrams(term):
+                    self.grams.setdefault(gram, set()).add(term)
+            if not positions or positions[-1] < position:
+                positions.append(position)
+            else:
+                bisect.insort(positions, position)
+
+    def remove(self, student_id):
+        position = self.position.pop(student_id, None)
+        if position is None:
+            return
+        del self.id_at[position]
+        for term in self.terms_of.pop(student_id):
+            positions = self.postings[term]
+            del positions[bisect.bisect_left(positions, position)]
+            if not positions:
+                del self.postings[term]
+                self.flush()
+                del self.sorted_terms[bisect.bisect_left(self.sorted_terms, term)]
+                for gram in trigrams(term):
+                    terms = self.grams.get(gram)
+                    if terms is not None:
+                        terms.discard(term)
+                        if not terms:
+                            del self.grams[gram]
+
+    def update(self, old_id, student):
+        # Keeps the original position so results stay in roster order
+        position = self.position.get(old_id)
+        self.remove(old_id)
+        self.add(student, position)
+
+    def _match_word(self, word):
+        groups = {EXACT: [], PREFIX: [], SUBSTRING: []}
+        self.flush()
+        start = bisect.bisect_left(self.sorted_terms, word)
+        terms = self.sorted_terms[start:bisect.bisect_left(self.sorted_terms, word + LAST_CHAR, start)]
+        if terms and terms[0] == word:
+            groups[EXACT].append(self.postings[word])
+            terms = terms[1:]
+        if word.isalpha():
+            # "s" is the start of every ID ("s0012"), the IDs rank after the names
+            low = bisect.bisect_left(terms, word + "0")
+            high = bisect.bisect_left(terms, word + ":", low)
+            groups[SUBSTRING] = list(map(self.postings.__getitem__, terms[low:high]))
+            terms = terms[:low] + terms[high:]
+        groups[PREFIX] = list(map(self.postings.__getitem__, terms))
+        if len(word) >= 3:
+            candidates = None
+            for gram in sorted(trigrams(word), key=lambda g: len(self.grams.get(g, ()))):
+                terms = self.grams.get(gram)
+                if not terms:
+                    return groups
+                candidates = set(terms) if candidates is None else candidates & terms
+            for term in candidates:
+                if word in term and not term.startswith(word):
+                    groups[SUBSTRING].append(self.postings[term])
+        elif not word.isalpha():
+            # Too short for trigrams, "01" is looked for in every ID and phone
+            for term in self.sorted_terms:
+                if word in term and not term.startswith(word):
+                    groups[SUBSTRING].append(self.postings[term])
+        return groups
+
+    def search(self, query, limit=None):
+        words = [w for w in WORD_SPLIT.split(normalize(query)) if w]
+        if not words:
+            positions = sorted(self.id_at)
+            return [self.id_at[p] for p in positions[:limit]]
+
+        # The word with the fewest matches drives, the others only filter its matches
+        groups = {}
+        for word in words:
+            groups[word] = self._match_word(word)
+        if len(words) > 1:
+            words.sort(key=lambda w: sum(map(len, itertools.chain.from_iterable(groups[w].values()))))
+        seen = set()
+        if len(words) == 1:
+            results = []
+            for rank in (EXACT, PREFIX, SUBSTRING):
+                lists = groups[words[0]][rank]
+                if limit is None:
+                    # Everything is wanted, one sort beats a merge
+                    positions = sorted(itertools.chain.from_iterable(lists)) if len(lists) > 1 else \
+                        (lists[0] if lists else [])
+                    new = [p for p in dict.fromkeys(positions) if p not in seen]
+                    seen.update(new)
+                    results += map(self.id_at.__getitem__, new)
+                    continue
+                if len(lists) > MERGE_LIMIT:
+                    lists = [sorted(p for positions in lists for p in positions)]
+                for position in heapq.merge(*lists):
+                    if position in seen:
+                        continue
+                    seen.add(position)
+                    results.append(self.id_at[position])
+                    if len(results) >= limit:
+                        return results
+            return results
+
+        filters = []
+        for word in words[1:]:
+            best = {}
+            for rank in (SUBSTRING, PREFIX, EXACT):
+                for positions in groups[word][rank]:
+                    best.update(dict.fromkeys(positions, rank))
+            filters.append(best)
+        ranked = []
+        for rank in (EXACT, PREFIX, SUBSTRING):
+            for positions in groups[words[0]][rank]:
+                for position in positions:
+                    if position in seen:
+                        continue
+                    seen.add(position)
+                    total = rank
+                    for best in filters:
+                        word_rank = best.get(position)
+                        if word_rank is None:
+                            break
+                        total += word_rank
+                    else:
+                        ranked.append((total, position, self.id_at[position]))
+        if limit is not None and limit < len(ranked):
+            ranked = heapq.nsmallest(limit, ranked)
+        else:
+            ranked.sort()
+        return [student_id for _, _, student_id in ranked]
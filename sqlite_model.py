@@ -0,0 +1,629 @@
+import json
+import sqlite3
+import sys
+import threading
+from datetime import date, datetime
+
+from columnar import STATUSES, status_table, to_cents
+from history import check_day
+from model import (DATA_FILE, HISTORY_KINDS, IMPORT_BATCH, STUDENT_FIELDS, StudentModel, check_new_id,
+                   check_update, clean_fees, clean_student, dedupe_key, stamp_update)
+from instrumentation import instrument
+from ledger import check_period
+from stats import current_month
+
+DB_FILE = "students.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS students (
+    pk INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    first_name TEXT NOT NULL DEFAULT '',
+    last_name TEXT NOT NULL DEFAULT '',
+    dob TEXT NOT NULL DEFAULT '',
+    gender TEXT NOT NULL DEFAULT '',
+    address TEXT NOT NULL DEFAULT '',
+    phone TEXT NOT NULL DEFAULT '',
+    level TEXT NOT NULL DEFAULT '',
+    reg_date TEXT NOT NULL DEFAULT '',
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_students_level ON students(level);
+CREATE INDEX IF NOT EXISTS idx_students_last_name ON students(last_name COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS attendance (
+    pk INTEGER PRIMARY KEY,
+    student_pk INTEGER NOT NULL REFERENCES students(pk) ON DELETE CASCADE,
+    date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    notes TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_attendance_student_date ON attendance(student_pk, date);
+CREATE INDEX IF NOT EXISTS idx_attendance_date ON attendance(date);
+
+CREATE TABLE IF NOT EXISTS payments (
+    pk INTEGER PRIMARY KEY,
+    student_pk INTEGER NOT NULL REFERENCES students(pk) ON DELETE CASCADE,
+    date TEXT NOT NULL,
+    amount REAL NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payments_student_date ON payments(student_pk, date);
+CREATE INDEX IF NOT EXISTS idx_payments_date ON payments(date);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+-- Ledger: amounts in cents, each account kept up to date by the triggers
+CREATE TABLE IF NOT EXISTS fees (
+    level TEXT PRIMARY KEY,
+    cents INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS periods (
+    period TEXT PRIMARY KEY,
+    fees TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    student_pk INTEGER PRIMARY KEY REFERENCES students(pk) ON DELETE CASCADE,
+    charged INTEGER NOT NULL DEFAULT 0,
+    paid INTEGER NOT NULL DEFAULT 0,
+    owed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_accounts_owed ON accounts(owed);
+
+CREATE TRIGGER IF NOT EXISTS open_account AFTER INSERT ON students BEGIN
+    INSERT INTO accounts (student_pk) VALUES (NEW.pk);
+END;
+CREATE TRIGGER IF NOT EXISTS credit_account AFTER INSERT ON payments BEGIN
+    UPDATE accounts SET paid = paid + CAST(ROUND(NEW.amount * 100) AS INTEGER),
+                        owed = owed - CAST(ROUND(NEW.amount * 100) AS INTEGER)
+    WHERE student_pk = NEW.student_pk;
+END;
+"""
+
+# Accounts of students saved before the ledger existed, with what they paid
+OPEN_MISSING_ACCOUNTS = """
+INSERT INTO accounts (student_pk, paid, owed)
+SELECT pk, paid, -paid FROM (
+    SELECT s.pk, COALESCE(SUM(CAST(ROUND(p.amount * 100) AS INTEGER)), 0) AS paid
+    FROM students s LEFT JOIN payments p ON p.student_pk = s.pk
+    WHERE s.pk NOT IN (SELECT student_pk FROM accounts)
+    GROUP BY s.pk)
+"""
+
+MONTH_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]"
+DAY_GLOB = MONTH_GLOB + "-[0-9][0-9]"
+
+INSERT_STUDENT = ("INSERT INTO students (id, first_name, last_name, dob, gender, address, "
+                  "phone, level, reg_date, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+INSERT_ATTENDANCE = ("INSERT INTO attendance (student_pk, date, status, notes, timestamp) "
+                     "VALUES (?, ?, ?, ?, ?)")
+INSERT_PAYMENT = ("INSERT INTO payments (student_pk, date, amount, description, timestamp) "
+                  "VALUES (?, ?, ?, ?, ?)")
+
+
+def _student_row(student):
+    extra = {k: v for k, v in student.items()
+             if k not in STUDENT_FIELDS and k not in ("attendance", "payments")}
+    return tuple(student.get(field) or "" for field in STUDENT_FIELDS) + (
+        json.dumps(extra) if extra else None,)
+
+
+class SQLiteStudentModel:
+    """StudentModel backed by a local SQLite database instead of students.json."""
+
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript(SCHEMA)
+        with self.conn:
+            self.conn.execute(OPEN_MISSING_ACCOUNTS)
+        # Read-only connections, one per thread reading, see _reader
+        self._local = threading.local()
+        self._readers = []
+
+    @property
+    def students(self):
+        return iter(self.get_all_students())
+
+    def close(self):
+        with self.lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+            self.conn.close()
+
+    def _reader(self):
+        # Lookups go through a connection of their own per thread, so with WAL
+        # they run alongside each other and alongside the writes
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only = ON")
+            self._local.conn = conn
+            with self.lock:
+                self._readers.append(conn)
+        return conn
+
+    def refresh(self):
+        # Every read goes to the database, other processes' writes are already seen
+        return 0
+
+    def _to_dict(self, row):
+        student = {field: row[field] for field in STUDENT_FIELDS}
+        if row["extra"]:
+            student.update(json.loads(row["extra"]))
+        return student
+
+    def _history(self, conn, student_pk):
+        attendance = [dict(r) for r in conn.execute(
+            "SELECT date, status, notes, timestamp FROM attendance "
+            "WHERE student_pk = ? ORDER BY pk", (student_pk,))]
+        payments = [dict(r) for r in conn.execute(
+            "SELECT date, amount, description, timestamp FROM payments "
+            "WHERE student_pk = ? ORDER BY pk", (student_pk,))]
+        return attendance, payments
+
+    def _pk(self, student_id):
+        row = self.conn.execute("SELECT pk FROM students WHERE id = ?", (student_id,)).fetchone()
+        return row["pk"] if row else None
+
+    def count_students(self):
+        return self._reader().execute("SELECT COUNT(*) FROM students").fetchone()[0]
+
+    def get_all_students(self):
+        with self.lock:
+            students = {}
+            for row in self.conn.execute("SELECT * FROM students ORDER BY pk"):
+                student = self._to_dict(row)
+                student["attendance"] = []
+                student["payments"] = []
+                students[row["pk"]] = student
+            for row in self.conn.execute(
+                    "SELECT student_pk, date, status, notes, timestamp FROM attendance ORDER BY pk"):
+                students[row["student_pk"]]["attendance"].append(
+                    {"date": row["date"], "status": row["status"],
+                     "notes": row["notes"], "timestamp": row["timestamp"]})
+            for row in self.conn.execute(
+                    "SELECT student_pk, date, amount, description, timestamp FROM payments ORDER BY pk"):
+                students[row["student_pk"]]["payments"].append(
+                    {"date": row["date"], "amount": row["amount"],
+                     "description": row["description"], "timestamp": row["timestamp"]})
+            return list(students.values())
+
+    def get_students_by_level(self, level):
+        with self.lock:
+            return [self._to_dict(row) for row in self.conn.execute(
+                "SELECT * FROM students WHERE level = ? ORDER BY pk", (level,))]
+
+    def list_student_ids(self, level=None):
+        conn = self._reader()
+        if level is None:
+            rows = conn.execute("SELECT id FROM students ORDER BY pk")
+        else:
+            rows = conn.execute("SELECT id FROM students WHERE level = ? ORDER BY pk", (level,))
+        return tuple(row[0] for row in rows)
+
+    def get_student_summaries(self, student_ids):
+        # Profile fields only, in the order asked, None for unknown IDs
+        found = {}
+        conn = self._reader()
+        for i in range(0, len(student_ids), 500):
+            chunk = student_ids[i:i + 500]
+            for row in conn.execute(
+                    f"SELECT * FROM students WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                found[row["id"]] = self._to_dict(row)
+        return [found.get(i) for i in student_ids]
+
+    def report_batches(self, size=IMPORT_BATCH, histories=True):
+        # Same batches as StudentModel.report_batches, the histories as record lists
+        conn = self._reader()
+        pks = [row[0] for row in conn.execute("SELECT pk FROM students ORDER BY pk")]
+        for start in range(0, len(pks), size):
+            chunk = pks[start:start + size]
+            marks = ",".join("?" * len(chunk))
+            students = {}
+            for row in conn.execute(
+                    f"SELECT s.*, a.charged, a.paid FROM students s LEFT JOIN accounts a ON a.student_pk = s.pk "
+                    f"WHERE s.pk IN ({marks}) ORDER BY s.pk", chunk):
+                students[row["pk"]] = ({field: row[field] or "" for field in STUDENT_FIELDS},
+                                       [row["charged"] or 0, row["paid"] or 0], ([], []) if histories else None)
+            if not histories:
+                yield list(students.values())
+                continue
+            for kind, (table, fields) in enumerate((("attendance", ("date", "status", "notes", "timestamp")),
+                                                    ("payments", ("date", "amount", "description", "timestamp")))):
+                for row in conn.execute(
+                        f"SELECT student_pk, {', '.join(fields)} FROM {table} "
+                        f"WHERE student_pk IN ({marks}) ORDER BY pk", chunk):
+                    # Students deleted between the queries are left out
+                    if row[0] in students:
+                        students[row[0]][2][kind].append(dict(zip(fields, row[1:])))
+            yield list(students.values())
+
+    def search_student_ids(self, query, limit=None):
+        pattern = f"%{query}%"
+        return [row[0] for row in self._reader().execute(
+            "SELECT id FROM students WHERE first_name LIKE ? OR last_name LIKE ? OR id LIKE ? "
+            "ORDER BY pk LIMIT ?", (pattern, pattern, pattern, -1 if limit is None else limit))]
+
+    def filter_student_ids(self, query="", level=None):
+        if not query.strip():
+            return self.list_student_ids(level)
+        pattern = f"%{query.strip()}%"
+        sql = "SELECT id FROM students WHERE (first_name LIKE ? OR last_name LIKE ? OR id LIKE ?)"
+        params = [pattern, pattern, pattern]
+        if level is not None:
+            sql += " AND level = ?"
+            params.append(level)
+        return tuple(row[0] for row in self._reader().execute(sql + " ORDER BY pk", params))
+
+    def _allocate_id(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        next_id = row["value"] if row else self.conn.execute(
+            "SELECT COUNT(*) FROM students").fetchone()[0] + 1
+        while self._pk(f"S{next_id:04d}") is not None:
+            next_id += 1
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)",
+                          (next_id + 1,))
+        return f"S{next_id:04d}"
+
+    def add_student(self, student_data):
+        with self.lock, self.conn:
+            # Generate a simple ID if not provided, from a sequence that never goes back
+            if "id" not in student_data or not student_data["id"]:
+                student_data["id"] = self._allocate_id()
+            elif self._pk(student_data["id"]) is not None:
+                raise ValueError(f"ID {student_data['id']} already exists")
+            self.conn.execute(INSERT_STUDENT, _student_row(student_data))
+        student_data["attendance"] = []
+        student_data["payments"] = []
+        return student_data["id"]
+
+    def import_students(self, rows, batch_size=IMPORT_BATCH, progress=None):
+        # Same rules as StudentModel.import_students, one transaction per batch
+        summary = {"imported": 0, "duplicates": 0, "errors": []}
+        with self.lock:
+            seen = {dedupe_key(dict(row)) for row in self.conn.execute(
+                "SELECT first_name, last_name, dob, phone FROM students")}
+        batch = []
+
+        def flush():
+            with self.lock, self.conn:
+                for line, student in batch:
+                    if not student.get("id"):
+                        student["id"] = self._allocate_id()
+                    try:
+                        self.conn.execute(INSERT_STUDENT, _student_row(student))
+                    except sqlite3.IntegrityError:
+                        summary["errors"].append((line, f"ID {student['id']} already exists"))
+                        continue
+                    summary["imported"] += 1
+            batch.clear()
+            if progress:
+                progress(summary)
+
+        for line, row in enumerate(rows, start=2):
+            try:
+                student = clean_student(row)
+            except ValueError as e:
+                summary["errors"].append((line, str(e)))
+                continue
+            key = dedupe_key(student)
+            if key in seen:
+                summary["duplicates"] += 1
+                continue
+            seen.add(key)
+            batch.append((line, student))
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+        return summary
+
+    def delete_student(self, student_id):
+        with self.lock, self.conn:
+            cursor = self.conn.execute("DELETE FROM students WHERE id = ?", (student_id,))
+        return cursor.rowcount > 0
+
+    def update_student(self, student_id, updated_data, expected_version=None):
+        updated_data = {k: v for k, v in updated_data.items() if not k.startswith("_")}
+        with self.lock, self.conn:
+            # Takes the write lock before reading, so the version check and
+            # the update can't be split by another process
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT * FROM students WHERE id = ?", (student_id,)).fetchone()
+            if not row:
+                return False
+            student = self._to_dict(row)
+            check_update(student, updated_data, expected_version)
+            check_new_id(student_id, updated_data, lambda new_id: self._pk(new_id) is not None)
+            student.update(updated_data)
+            stamp_update(student, updated_data)
+            self.conn.execute(
+                "UPDATE students SET id = ?, first_name = ?, last_name = ?, dob = ?, gender = ?, "
+                "address = ?, phone = ?, level = ?, reg_date = ?, extra = ? WHERE pk = ?",
+                _student_row(student) + (row["pk"],))
+        return True
+
+    def search_students(self, query, limit=None):
+        pattern = f"%{query}%"
+        return [self._to_dict(row) for row in self._reader().execute(
+            "SELECT * FROM students WHERE first_name LIKE ? OR last_name LIKE ? OR id LIKE ? "
+            "ORDER BY pk LIMIT ?", (pattern, pattern, pattern, -1 if limit is None else limit))]
+
+    def get_student_by_id(self, student_id):
+        conn = self._reader()
+        row = conn.execute("SELECT * FROM students WHERE id = ?", (student_id,)).fetchone()
+        if not row:
+            return None
+        student = self._to_dict(row)
+        student["attendance"], student["payments"] = self._history(conn, row["pk"])
+        return student
+
+    def get_student_profiles(self, student_ids):
+        # The summaries are read into new dicts already
+        return self.get_student_summaries(student_ids)
+
+    def student_version(self, student_id):
+        # Same as StudentModel.student_version, counted on the student_pk indexes
+        conn = self._reader()
+        row = conn.execute("SELECT * FROM students WHERE id = ?", (student_id,)).fetchone()
+        if not row:
+            return None
+        counts = [conn.execute(f"SELECT COUNT(*) FROM {kind} WHERE student_pk = ?", (row["pk"],)).fetchone()[0]
+                  for kind in HISTORY_KINDS]
+        return (self._to_dict(row).get("_version", 1), *counts)
+
+    def get_history_page(self, student_id, kind, offset=0, limit=None):
+        if kind not in HISTORY_KINDS:
+            raise ValueError(f"Unknown history '{kind}'")
+        conn = self._reader()
+        row = conn.execute("SELECT pk FROM students WHERE id = ?", (student_id,)).fetchone()
+        if not row:
+            return None
+        columns = "date, status, notes, timestamp" if kind == "attendance" else "date, amount, description, timestamp"
+        total = conn.execute(f"SELECT COUNT(*) FROM {kind} WHERE student_pk = ?", (row["pk"],)).fetchone()[0]
+        records = [dict(r) for r in conn.execute(
+            f"SELECT {columns} FROM {kind} WHERE student_pk = ? ORDER BY pk LIMIT ? OFFSET ?",
+            (row["pk"], -1 if limit is None else limit, offset))]
+        return total, records
+
+    def get_history_window(self, student_id, kind, start=None, end=None):
+        # Served by the (student_pk, date) indexes
+        if kind not in HISTORY_KINDS:
+            raise ValueError(f"Unknown history '{kind}'")
+        conn = self._reader()
+        row = conn.execute("SELECT pk FROM students WHERE id = ?", (student_id,)).fetchone()
+        if not row:
+            return None
+        columns = "date, status, notes, timestamp" if kind == "attendance" else "date, amount, description, timestamp"
+        # Unreadable dates come first, as in StudentModel, and only with an open start
+        first, last, total = conn.execute(
+            f"SELECT MIN(CASE WHEN date GLOB '{DAY_GLOB}' THEN date END), "
+            f"MAX(CASE WHEN date GLOB '{DAY_GLOB}' THEN date END), COUNT(*) FROM {kind} WHERE student_pk = ?",
+            (row["pk"],)).fetchone()
+        records = [dict(r) for r in conn.execute(
+            f"SELECT {columns} FROM {kind} WHERE student_pk = ? AND date >= ? AND date <= ? "
+            f"ORDER BY date GLOB '{DAY_GLOB}', date, pk",
+            (row["pk"], check_day(start) if start else "", check_day(end) if end else "\uffff"))]
+        return {"records": records, "first": first, "last": last, "total": total}
+
+    def attendance_by_date(self, start, end=None, status=None):
+        sql = ("SELECT a.date, s.id, a.status FROM attendance a JOIN students s ON s.pk = a.student_pk "
+               "WHERE a.date >= ? AND a.date <= ?")
+        params = [check_day(start), check_day(end or start)]
+        if status is not None:
+            sql += " AND a.status = ?"
+            params.append(status)
+        return [tuple(row) for row in self._reader().execute(sql + " ORDER BY a.date, a.pk", params)]
+
+    def add_attendance(self, student_id, date, status, notes=""):
+        with self.lock, self.conn:
+            student_pk = self._pk(student_id)
+            if student_pk is None:
+                return False
+            self.conn.execute(INSERT_ATTENDANCE,
+                              (student_pk, date, status, notes, datetime.now().isoformat()))
+        return True
+
+    def add_attendance_bulk(self, date, marks):
+        timestamp = datetime.now().isoformat()
+        with self.lock, self.conn:
+            cursor = self.conn.executemany(
+                "INSERT INTO attendance (student_pk, date, status, notes, timestamp) "
+                "SELECT pk, ?, ?, ?, ? FROM students WHERE id = ?",
+                [(date, status, notes, timestamp, student_id)
+                 for student_id, (status, notes) in marks.items()])
+        return cursor.rowcount
+
+    def add_payment(self, student_id, amount, date, description=""):
+        with self.lock, self.conn:
+            student_pk = self._pk(student_id)
+            if student_pk is None:
+                return False
+            self.conn.execute(INSERT_PAYMENT,
+                              (student_pk, date, amount, description, datetime.now().isoformat()))
+        return True
+
+    def dashboard_stats(self, today=None):
+        today = today or date.today()
+        month = current_month(today)
+        with self.lock:
+            levels = dict(self.conn.execute("SELECT level, COUNT(*) FROM students GROUP BY level"))
+            attendance = dict(self.conn.execute(
+                "SELECT status, COUNT(*) FROM attendance WHERE date = ? GROUP BY status",
+                (today.isoformat(),)))
+            count, total, payers = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(amount), 0), COUNT(DISTINCT student_pk) "
+                "FROM payments WHERE date >= ? AND date < ?", (month, month + "~")).fetchone()
+        students = sum(levels.values())
+        return {
+            "total": students,
+            "levels": levels,
+            "today": attendance,
+            "month": month,
+            "payments_count": count,
+            "payments_amount": round(total * 100) / 100,
+            "unpaid": students - payers,
+        }
+
+    def _status_report(self, group_sql, where_sql=""):
+        groups = {}
+        status_names = list(STATUSES)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {group_sql} AS label, a.status, COUNT(*) FROM attendance a "
+                f"JOIN students s ON s.pk = a.student_pk {where_sql} "
+                f"GROUP BY label, a.status ORDER BY label").fetchall()
+        for label, status, count in rows:
+            if status not in status_names:
+                status_names.append(status)
+            counts = groups.setdefault(label, [])
+            counts.extend([0] * (len(status_names) - len(counts)))
+            counts[status_names.index(status)] += count
+        for counts in groups.values():
+            counts.extend([0] * (len(status_names) - len(counts)))
+        return status_table(list(groups), list(groups.values()), status_names)
+
+    def attendance_by_level(self):
+        return self._status_report("s.level")
+
+    def attendance_by_month(self):
+        return self._status_report("substr(a.date, 1, 7)", f"WHERE a.date GLOB '{MONTH_GLOB}*'")
+
+    def absentee_leaderboard(self, limit=10):
+        with self.lock:
+            return [tuple(row) for row in self.conn.execute(
+                "SELECT s.id, COUNT(*) AS absences FROM attendance a "
+                "JOIN students s ON s.pk = a.student_pk WHERE a.status = 'Absent' "
+                "GROUP BY a.student_pk ORDER BY absences DESC, a.student_pk LIMIT ?", (limit,))]
+
+    def revenue_by_month(self):
+        with self.lock:
+            return {month: round(total * 100) / 100 for month, total in self.conn.execute(
+                f"SELECT substr(date, 1, 7) AS month, SUM(amount) FROM payments "
+                f"WHERE date GLOB '{MONTH_GLOB}*' GROUP BY month ORDER BY month")}
+
+    def outstanding_balances(self, monthly_fees, months):
+        months = sorted(set(months))
+        placeholders = ",".join("?" * len(months))
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT s.id, s.level, COALESCE(SUM(p.amount), 0) FROM students s "
+                f"LEFT JOIN payments p ON p.student_pk = s.pk "
+                f"AND substr(p.date, 1, 7) IN ({placeholders}) "
+                f"GROUP BY s.pk ORDER BY s.pk", months).fetchall()
+        owed = [(student_id, to_cents(monthly_fees.get(level, 0)) * len(months) - to_cents(paid))
+                for student_id, level, paid in rows]
+        owed.sort(key=lambda item: -item[1])
+        return [(student_id, cents / 100) for student_id, cents in owed if cents > 0]
+
+    def verify_stats(self):
+        # The counters are computed by queries, only the accounts can drift
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT COUNT(*) FROM accounts a WHERE a.owed != a.charged - a.paid OR a.paid != "
+                "(SELECT COALESCE(SUM(CAST(ROUND(p.amount * 100) AS INTEGER)), 0) FROM payments p "
+                "WHERE p.student_pk = a.student_pk)").fetchone()
+        return ["ledger.paid"] if row[0] else []
+
+    def fee_schedule(self):
+        return {level: cents / 100 for level, cents in self._reader().execute(
+            "SELECT level, cents FROM fees ORDER BY level")}
+
+    def set_fee_schedule(self, fees):
+        cents = clean_fees(fees)
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM fees")
+            self.conn.executemany("INSERT INTO fees (level, cents) VALUES (?, ?)",
+                                  [(level, amount) for level, amount in cents.items() if amount])
+        return True
+
+    def post_charges(self, period=None):
+        period = check_period(period or current_month())
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if self.conn.execute("SELECT 1 FROM periods WHERE period = ?", (period,)).fetchone():
+                raise ValueError(f"Charges for {period} were already posted")
+            fees = dict(self.conn.execute("SELECT level, cents FROM fees"))
+            self.conn.execute("INSERT INTO periods (period, fees) VALUES (?, ?)", (period, json.dumps(fees)))
+            # Correlated rather than UPDATE ... FROM, which needs SQLite 3.33
+            fee = "(SELECT f.cents FROM students s JOIN fees f ON f.level = s.level WHERE s.pk = accounts.student_pk)"
+            cursor = self.conn.execute(
+                f"UPDATE accounts SET charged = charged + {fee}, owed = owed + {fee} "
+                f"WHERE student_pk IN (SELECT s.pk FROM students s JOIN fees f ON f.level = s.level)")
+        return cursor.rowcount
+
+    def posted_periods(self):
+        return [row[0] for row in self._reader().execute("SELECT period FROM periods ORDER BY period")]
+
+    def period_fees(self, period):
+        row = self._reader().execute("SELECT fees FROM periods WHERE period = ?", (period,)).fetchone()
+        return None if row is None else {level: cents / 100 for level, cents in json.loads(row[0]).items()}
+
+    def balance(self, student_id):
+        row = self._reader().execute(
+            "SELECT a.charged, a.paid, a.owed FROM accounts a JOIN students s ON s.pk = a.student_pk "
+            "WHERE s.id = ?", (student_id,)).fetchone()
+        if not row:
+            return None
+        return {"charged": row[0] / 100, "paid": row[1] / 100, "owed": row[2] / 100}
+
+    def arrears(self, limit=None):
+        # Read from the index on owed, no scan of the payments
+        return [(student_id, owed / 100) for student_id, owed in self._reader().execute(
+            "SELECT s.id, a.owed FROM accounts a JOIN students s ON s.pk = a.student_pk "
+            "WHERE a.owed > 0 ORDER BY a.owed DESC, s.id LIMIT ?", (-1 if limit is None else limit,))]
+
+    def arrears_count(self):
+        return self._reader().execute("SELECT COUNT(*) FROM accounts WHERE owed > 0").fetchone()[0]
+
+
+instrument(SQLiteStudentModel, "sqlite")
+
+
+def migrate_json_to_sqlite(json_file=DATA_FILE, db_file=DB_FILE):
+    source = StudentModel(json_file)
+    target = SQLiteStudentModel(db_file)
+    with target.lock, target.conn:
+        for student in source.get_all_students():
+            cursor = target.conn.execute(INSERT_STUDENT, _student_row(student))
+            student_pk = cursor.lastrowid
+            target.conn.executemany(INSERT_ATTENDANCE, [
+                (student_pk, r.get("date", ""), r.get("status", ""), r.get("notes", ""),
+                 r.get("timestamp", "")) for r in student.get("attendance", [])])
+            target.conn.executemany(INSERT_PAYMENT, [
+                (student_pk, r.get("date", ""), r.get("amount", 0), r.get("description", ""),
+                 r.get("timestamp", "")) for r in student.get("payments", [])])
+            charged = source.ledger.accounts.get(student.get("id"), [0, 0])[0]
+            if charged:
+                target.conn.execute("UPDATE accounts SET charged = ?, owed = owed + ? WHERE student_pk = ?",
+                                    (charged, charged, student_pk))
+        target.conn.executemany("INSERT INTO fees (level, cents) VALUES (?, ?)", source.ledger.fees.items())
+        target.conn.executemany("INSERT INTO periods (period, fees) VALUES (?, ?)",
+                                [(period, json.dumps(fees)) for period, fees in source.ledger.periods.items()])
+        # The IDs of deleted students stay used
+        target.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (source.next_id,))
+    count = target.count_students()
+    target.close()
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Usage: python sqlite_model.py migrate [students.json] [students.db]")
+        sys.exit(1)
+    json_file = sys.argv[2] if len(sys.argv) > 2 else DATA_FILE
+    db_file = sys.argv[3] if len(sys.argv) > 3 else DB_FILE
+    count = migrate_json_to_sqlite(json_file, db_file)
+    print(f"Migrated {count} students from {json_file} to {db_file}")
@@ -0,0 +1,129 @@
+from datetime import date
+
+from columnar import to_cents
+
+# Months for which the set of paying students is kept, the current one included
+PAYER_MONTHS = 3
+
+
+def current_month(today=None):
+    return (today or date.today()).strftime("%Y-%m")
+
+
+def recent_months(today=None, count=PAYER_MONTHS):
+    today = today or date.today()
+    year, month = today.year, today.month
+    months = []
+    for _ in range(count):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months
+
+
+class StatsCounters:
+    """Dashboard counters kept up to date on every change instead of rescanned.
+
+    Holds students per level, attendance totals per date and status, payment
+    count and amount per month, and which students paid in the recent months.
+    """
+
+    def __init__(self):
+        self.levels = {}
+        self.attendance = {}
+        self.payments = {}
+        self.payers = {}
+
+    def build(self, students):
+        for student in students:
+            self.add_student(student)
+        return self
+
+    def _bump(self, counts, key, amount):
+        counts[key] = counts.get(key, 0) + amount
+        if not counts[key]:
+            del counts[key]
+
+    def add_student(self, student, sign=1):
+        self._bump(self.levels, student.get("level") or "", sign)
+        for record in student.get("attendance", []):
+            self.add_attendance(record, sign)
+        for record in student.get("payments", []):
+            self.add_payment(student.get("id"), record, sign)
+
+    def remove_student(self, student):
+        self.add_student(student, -1)
+
+    def update_student(self, old_id, old_level, student):
+        if old_level != student.get("level"):
+            self._bump(self.levels, old_level or "", -1)
+            self._bump(self.levels, student.get("level") or "", 1)
+        new_id = student.get("id")
+        if old_id != new_id:
+            for paid in self.payers.values():
+                if old_id in paid:
+                    paid[new_id] = paid.pop(old_id)
+
+    def add_attendance(self, record, sign=1):
+        counts = self.attendance.setdefault(record.get("date") or "", {})
+        self._bump(counts, record.get("status") or "", sign)
+        if not counts:
+            del self.attendance[record.get("date") or ""]
+
+    def add_payment(self, student_id, record, sign=1):
+        month = (record.get("date") or "")[:7]
+        totals = self.payments.setdefault(month, {"count": 0, "cents": 0})
+        totals["count"] += sign
+        totals["cents"] += sign * to_cents(record.get("amount"))
+        if not totals["count"]:
+            del self.payments[month]
+        paid = self.payers.setdefault(month, {})
+        # Payers of pruned months are gone, there is nothing to take back
+        if sign > 0 or student_id in paid:
+            self._bump(paid, student_id, sign)
+        if not paid:
+            del self.payers[month]
+
+    def prune(self, today=None):
+        # Older months only keep their totals
+        oldest = recent_months(today)[-1]
+        for month in [m for m in self.payers if m < oldest]:
+            del self.payers[month]
+
+    def summary(self, today=None):
+        today = today or date.today()
+        month = current_month(today)
+        total = sum(self.levels.values())
+        totals = self.payments.get(month, {"count": 0, "cents": 0})
+        return {
+            "total": total,
+            "levels": dict(self.levels),
+            "today": dict(self.attendance.get(today.isoformat(), {})),
+            "month": month,
+            "payments_count": totals["count"],
+            "payments_amount": totals["cents"] / 100,
+            "unpaid": total - len(self.payers.get(month, ())),
+        }
+
+    def to_dict(self, today=None):
+        self.prune(today)
+        return {
+            "levels": self.levels,
+            "attendance": self.attendance,
+            "payments": self.payments,
+            "payers": self.payers,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.levels = data.get("levels", {})
+        stats.attendance = data.get("attendance", {})
+        stats.payments = data.get("payments", {})
+        stats.payers = data.get("payers", {})
+        return stats
+
+    def verify(self, students, today=None):
+        # Names of the counters that disagree with a full recompute, empty when all match
+        expected = StatsCounters().build(students).to_dict(today)
+        actual = self.to_dict(today)
+        return [name for name in expected if expected[name] != actual[name]]
@@ -1,18 +1,39 @@
+import argparse
+import calendar
+import threading
 import tkinter as tk
-from tkinter import messagebox, ttk
-from model import StudentModel
-from datetime import datetime
+from datetime import date, datetime
+from tkinter import filedialog, messagebox, ttk
+import instrumentation
+from async_model import AsyncModel
+from bulk_io import export_data, import_file
+from model import ALLOWED_LEVELS, open_model
+from reports import FORMATS, generate_reports
+from widgets import VirtualList
+
+# How often changes saved by other desks are looked for
+REFRESH_MS = 3000
+# Pause in typing after which the student list is filtered
+SEARCH_DELAY_MS = 150
+# Months of history shown per page of the student details tabs
+ATTENDANCE_PAGE_MONTHS = 1
+PAYMENT_PAGE_MONTHS = 12
 
 class StudentManagerApp:
-    def __init__(self, root):
+    def __init__(self, root, backend="json", profile=None):
         self.root = root
         self.root.title("Student Management System")
         self.root.geometry("1100x750")
         self.root.configure(bg="#f0f0f0")
         
-        # Initialize Model
-        self.model = StudentModel()
+        # The model is loaded on a worker thread, the window shows up right away
+        self.model = None
         self.current_student = None
+        # Pending debounced filter, the latest filter sent to the model, and
+        # the count line of the list screen
+        self._filter_job = None
+        self._filter_request = 0
+        self.results_label = None
         
         self.style = ttk.Style()
         self.style.theme_use("clam")
@@ -20,14 +41,74 @@ class StudentManagerApp:
         self.style.configure("Treeview", font=("Helvetica", 10), rowheight=25)
         self.style.configure("Treeview.Heading", font=("Helvetica", 11, "bold"))
         
-        self.allowed_levels = [
-            "1ere TSDI", "2eme TSDI",
-            "1ere TSGE", "2eme TSGE",
-            "1ere TGI", "2eme TGI",
-            "1ere OPS"
-        ]
+        self.allowed_levels = ALLOWED_LEVELS
         
+        # Capture of the whole session written on close, and the hidden diagnostics window
+        self.profile = profile
+        self.diagnostics = None
+        if profile:
+            instrumentation.start_capture()
+
         self.setup_ui()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.bind_all("<Control-Shift-KeyPress-D>", lambda e: self.show_diagnostics())
+        self.tasks = AsyncModel(self.root, lambda: open_model(backend),
+                                on_load=self.on_model_loaded,
+                                on_error=self.on_task_error,
+                                on_busy=self.set_busy)
+
+    def on_model_loaded(self, model):
+        self.model = model
+        for widget in self.menu_widgets:
+            widget.configure(state="normal")
+        self.level_combo.configure(state="readonly")
+        self.show_dashboard()
+        self.root.after(REFRESH_MS, self.poll_changes)
+        if getattr(model, "recovered", None):
+            recovered = model.recovered
+            messagebox.showwarning(
+                "Data Restored",
+                f"The data file was damaged ({recovered['error']}) and was restored from "
+                f"the backup {recovered['full']} and {recovered['records']} later changes.\n"
+                f"The damaged file was kept as {recovered['damaged']}."
+                + ("" if recovered["complete"] else "\nSome changes could not be recovered."))
+
+    def poll_changes(self):
+        # Other desks may write to the same files, their changes are pulled
+        # in the background and the rows on screen drawn again
+        if self.tasks.pending == 0:
+            self.tasks.call("refresh", callback=self.on_changes_pulled, quiet=True)
+        self.root.after(REFRESH_MS, self.poll_changes)
+
+    def on_changes_pulled(self, count):
+        if not count:
+            return
+        if self.results_label is not None and self.results_label.winfo_exists():
+            self.apply_filters(keep_position=True)
+        elif self.student_list.winfo_ismapped():
+            self.student_list.refresh()
+
+    def on_task_error(self, error):
+        messagebox.showerror("Error", str(error))
+
+    def set_busy(self, busy):
+        if busy:
+            self.status_label.configure(text="Working...")
+            self.progress.pack(side="right", padx=10)
+            self.progress.start(10)
+        else:
+            self.status_label.configure(text="")
+            self.progress.stop()
+            self.progress.pack_forget()
+
+    def on_close(self):
+        # Fold the journal into the snapshot before exiting, after any queued writes
+        self.tasks.close(callback=self.on_closed)
+
+    def on_closed(self, result):
+        if self.profile and instrumentation.capturing():
+            instrumentation.stop_capture(self.profile)
+        self.root.destroy()
 
     def setup_ui(self):
         # Sidebar
@@ -39,19 +120,29 @@ class StudentManagerApp:
                  font=("Helvetica", 16, "bold")).pack(pady=20)
         
         menu_items = [
-            ("🏠 Dashboard", self.show_dashboard),
-            ("👥 All Students", self.show_all_students),
-            ("➕ Add Student", self.add_student_form),
-            ("🔍 Search Student", self.search_student_form),
-            ("📅 Attendance", self.attendance_tracker),
-            ("💰 Payments", self.payment_tracker)
+            ("🏠 Dashboard", "show_dashboard"),
+            ("👥 All Students", "show_all_students"),
+            ("➕ Add Student", "add_student_form"),
+            ("🔍 Search Student", "search_student_form"),
+            ("📅 Attendance", "attendance_tracker"),
+            ("✅ Roll Call", "roll_call"),
+            ("💰 Payments", "payment_tracker"),
+            ("🧾 Arrears", "arrears_report"),
+            ("📑 Reports", "reports_screen"),
+            ("📥 Import", "import_students"),
+            ("📤 Export", "export_dialog")
         ]
         
-        for text, command in menu_items:
-            btn = tk.Button(self.sidebar, text=text, command=command, 
+        # Disabled until the model has been loaded. The screens are looked up
+        # on each click, so they are timed once instrumentation is switched on.
+        self.menu_widgets = []
+        for text, name in menu_items:
+            btn = tk.Button(self.sidebar, text=text, command=lambda name=name: getattr(self, name)(), 
                            bg="#34495e", fg="white", activebackground="#2980b9", 
-                           activeforeground="white", relief="flat", anchor="w", padx=20)
+                           activeforeground="white", relief="flat", anchor="w", padx=20,
+                           state="disabled")
             btn.pack(fill="x", pady=2)
+            self.menu_widgets.append(btn)
             
         tk.Label(self.sidebar, text="Filter by Level", bg="#2c3e50", fg="#bdc3c7", 
                  font=("Helvetica", 10, "bold")).pack(pady=(20, 10), padx=10, anchor="w")
@@ -60,96 +151,183 @@ class StudentManagerApp:
         level_frame.pack(fill="x", padx=10)
         
         self.level_var = tk.StringVar(value="All")
-        level_combo = ttk.Combobox(level_frame, textvariable=self.level_var, values=["All"] + self.allowed_levels, state="readonly")
-        level_combo.pack(fill="x")
-        level_combo.bind("<<ComboboxSelected>>", self.filter_students)
+        self.level_combo = ttk.Combobox(level_frame, textvariable=self.level_var, values=["All"] + self.allowed_levels, state="disabled")
+        self.level_combo.pack(fill="x")
+        self.level_combo.bind("<<ComboboxSelected>>", self.filter_students)
+
+        # Status bar with a progress indicator for background work
+        status_bar = tk.Frame(self.root, bg="#ecf0f1")
+        status_bar.pack(side="bottom", fill="x")
+        self.status_label = tk.Label(status_bar, text="", bg="#ecf0f1", fg="#7f8c8d")
+        self.status_label.pack(side="left", padx=20)
+        self.progress = ttk.Progressbar(status_bar, mode="indeterminate", length=150)
 
         # Main Content Area
         self.main_frame = tk.Frame(self.root, bg="#ecf0f1")
         self.main_frame.pack(side="right", expand=True, fill="both", padx=20, pady=20)
+
+        # Shared by every screen that lists students, only hidden between screens
+        self.student_list = VirtualList(
+            self.main_frame, columns=("id", "first_name", "last_name", "level", "phone"),
+            headings={"id": "ID"},
+            widths={"id": 80, "first_name": 120, "last_name": 120, "level": 100, "phone": 100},
+            name="students")
         
         self.show_dashboard()
 
     def clear_main_frame(self):
         for widget in self.main_frame.winfo_children():
-            widget.destroy()
+            if widget is self.student_list:
+                widget.pack_forget()
+            else:
+                widget.destroy()
+
+    def student_rows(self, student_ids):
+        return [(
+            student.get("id", ""),
+            student.get("first_name", ""),
+            student.get("last_name", ""),
+            student.get("level", ""),
+            student.get("phone", "")
+        ) if student else None for student in self.model.get_student_summaries(student_ids)]
 
     def show_dashboard(self):
         self.clear_main_frame()
         tk.Label(self.main_frame, text="Welcome to OMNA Management System", 
-                 font=("Helvetica", 24, "bold"), bg="#ecf0f1", fg="#2c3e50").pack(pady=50)
+                 font=("Helvetica", 24, "bold"), bg="#ecf0f1", fg="#2c3e50").pack(pady=(30, 10))
         
         stats_frame = tk.Frame(self.main_frame, bg="#ecf0f1")
         stats_frame.pack(pady=20)
+
+        if self.model is None:
+            tk.Label(stats_frame, text="Loading student data...", font=("Helvetica", 14),
+                     bg="#ecf0f1", fg="#7f8c8d").pack()
+            return
         
-        total_students = len(self.model.students)
-        tk.Label(stats_frame, text=f"Total Students: {total_students}", 
-                 font=("Helvetica", 18), bg="white", padx=20, pady=20, relief="raised").pack(side="left", padx=20)
+        # Materialized counters, no rescan of the roster
+        levels_label = tk.Label(self.main_frame, text="", font=("Helvetica", 10), bg="#ecf0f1", fg="#2c3e50")
+        levels_label.pack(pady=(0, 10))
+        self.tasks.read("dashboard_stats",
+                        callback=lambda stats: self.show_dashboard_stats(stats_frame, levels_label, stats))
+
+        # Reports are aggregated on the worker thread and filled in when ready
+        reports_frame = tk.Frame(self.main_frame, bg="#ecf0f1")
+        reports_frame.pack(fill="both", expand=True, pady=10)
+        tk.Label(reports_frame, text="Loading reports...", bg="#ecf0f1", fg="#7f8c8d").pack()
+        self.tasks.submit(self.dashboard_reports,
+                          callback=lambda reports: self.show_dashboard_reports(reports_frame, reports))
+
+    def show_dashboard_stats(self, frame, levels_label, stats):
+        if not frame.winfo_exists():
+            return
+        today = stats["today"]
+        cards = [
+            f"Total Students: {stats['total']}",
+            f"Today: {today.get('Present', 0)} present, {today.get('Absent', 0)} absent, {today.get('Late', 0)} late",
+            f"Payments in {stats['month']}: {stats['payments_count']} ({stats['payments_amount']:.2f})",
+            f"Not paid this month: {stats['unpaid']}",
+        ]
+        for text in cards:
+            tk.Label(frame, text=text, font=("Helvetica", 12), bg="white",
+                     padx=15, pady=15, relief="raised").pack(side="left", padx=10)
+        levels_label.configure(
+            text="   ".join(f"{level}: {stats['levels'].get(level, 0)}" for level in self.allowed_levels))
+
+    def dashboard_reports(self):
+        absentees = self.model.absentee_leaderboard(10)
+        return {
+            "levels": self.model.attendance_by_level(),
+            "revenue": self.model.revenue_by_month(),
+            "absentees": [(self.model.get_student_by_id(student_id), count)
+                          for student_id, count in absentees]
+        }
+
+    def show_dashboard_reports(self, frame, reports):
+        if not frame.winfo_exists():
+            return
+        for widget in frame.winfo_children():
+            widget.destroy()
 
-    def show_all_students(self, students=None, title="Student List", on_click=None):
+        self.report_table(frame, "Attendance by Level", ("Level", "Rate", "Absent", "Records"), [
+            (level, f"{row['rate']:.0%}", row["Absent"], row["total"])
+            for level, row in sorted(reports["levels"].items())])
+        self.report_table(frame, "Revenue by Month", ("Month", "Amount"), [
+            (month, f"{amount:.2f}") for month, amount in reversed(list(reports["revenue"].items()))])
+        self.report_table(frame, "Most Absences", ("Student", "Absences"), [
+            (f"{student.get('first_name')} {student.get('last_name')}" if student else "", count)
+            for student, count in reports["absentees"]])
+
+    def report_table(self, parent, title, columns, rows):
+        box = tk.Frame(parent, bg="white", padx=10, pady=10, relief="raised", bd=1)
+        box.pack(side="left", fill="both", expand=True, padx=10)
+        tk.Label(box, text=title, font=("Helvetica", 12, "bold"), bg="white").pack(anchor="w")
+        tree = ttk.Treeview(box, columns=columns, show="headings", height=10)
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=90)
+        tree.pack(fill="both", expand=True, pady=(5, 0))
+        for row in rows:
+            tree.insert("", "end", values=row)
+        instrumentation.observe("widget.report_table.rows", len(rows))
+
+    def show_all_students(self, title="Student List", on_click=None):
+        # The list is filtered as you type, together with the sidebar level filter
         self.clear_main_frame()
-        tk.Label(self.main_frame, text=title, font=("Helvetica", 18, "bold"), bg="#ecf0f1").pack(pady=(0, 20), anchor="w")
-        
-        # Table
-        columns = ("id", "first_name", "last_name", "level", "phone")
-        tree = ttk.Treeview(self.main_frame, columns=columns, show="headings")
-        
-        tree.heading("id", text="ID")
-        tree.heading("first_name", text="First Name")
-        tree.heading("last_name", text="Last Name")
-        tree.heading("level", text="Level")
-        tree.heading("phone", text="Phone")
-        
-        tree.column("id", width=80)
-        tree.column("first_name", width=120)
-        tree.column("last_name", width=120)
-        tree.column("level", width=100)
-        tree.column("phone", width=100)
-        
-        tree.pack(fill="both", expand=True)
-        
-        # Scrollbar
-        scrollbar = ttk.Scrollbar(self.main_frame, orient="vertical", command=tree.yview)
-        tree.configure(yscroll=scrollbar.set)
-        scrollbar.pack(side="right", fill="y")
-        
-        data = students if students else self.model.students
-        for student in data:
-            tree.insert("", "end", values=(
-                student.get("id", ""),
-                student.get("first_name", ""),
-                student.get("last_name", ""),
-                student.get("level", ""),
-                student.get("phone", "")
-            ))
-            
-        def default_click(event):
-            selection = tree.selection()
-            if not selection: return
-            item = selection[0]
-            values = tree.item(item, "values")
-            student_id = values[0]
-            self.show_student_details(student_id)
-            
-        # If a custom handler is provided, we wrap it to pass the tree so it can get selection
-        if on_click:
-            def wrapped_click(event):
-                selection = tree.selection()
-                if not selection: return
-                item = selection[0]
-                values = tree.item(item, "values")
-                on_click(values[0])
-            tree.bind("<Double-1>", wrapped_click)
+        tk.Label(self.main_frame, text=title, font=("Helvetica", 18, "bold"), bg="#ecf0f1").pack(pady=(0, 10), anchor="w")
+
+        search_frame = tk.Frame(self.main_frame, bg="#ecf0f1")
+        search_frame.pack(fill="x", pady=(0, 10))
+        tk.Label(search_frame, text="Search by Name or ID:", bg="#ecf0f1").pack(side="left", padx=(0, 10))
+        self.search_var = tk.StringVar()
+        self.search_entry = ttk.Entry(search_frame, textvariable=self.search_var, width=40)
+        self.search_entry.pack(side="left")
+        self.search_entry.bind("<Return>", lambda e: self.apply_filters())
+        self.search_entry.bind("<Escape>", lambda e: self.search_var.set(""))
+        self.results_label = tk.Label(search_frame, text="", bg="#ecf0f1", fg="#7f8c8d")
+        self.results_label.pack(side="left", padx=10)
+        self.search_var.trace_add("write", lambda *args: self.schedule_filter())
+
+        self.student_list.on_activate = on_click or self.show_student_details
+        self.student_list.pack(fill="both", expand=True)
+        self.apply_filters()
+
+    def schedule_filter(self):
+        # Each keystroke restarts the delay, so only the last query of a burst runs
+        if self._filter_job is not None:
+            self.root.after_cancel(self._filter_job)
+        self._filter_job = self.root.after(SEARCH_DELAY_MS, self.apply_filters)
+
+    def apply_filters(self, keep_position=False):
+        if self._filter_job is not None:
+            self.root.after_cancel(self._filter_job)
+            self._filter_job = None
+        if self.results_label is None or not self.results_label.winfo_exists():
+            return
+        query = self.search_var.get()
+        level = self.level_var.get()
+        self._filter_request += 1
+        request = self._filter_request
+        self.tasks.read("filter_student_ids", query, None if level == "All" else level,
+                        callback=lambda student_ids: self.show_filtered(request, student_ids, level, keep_position))
+
+    def show_filtered(self, request, student_ids, level, keep_position):
+        # Answers to older filters, or for a list screen since left, are dropped
+        if request != self._filter_request or not self.results_label.winfo_exists():
+            return
+        # Only the rows on screen are fetched, whatever the number of matches
+        self.student_list.set_rows(student_ids, self.student_rows, keep_position)
+        if not student_ids:
+            self.results_label.configure(text="No students found.", fg="red")
         else:
-            tree.bind("<Double-1>", default_click)
+            where = "" if level == "All" else f" in {level}"
+            self.results_label.configure(text=f"{len(student_ids)} students{where}", fg="#7f8c8d")
 
     def filter_students(self, event=None):
-        level = self.level_var.get()
-        if level == "All":
-            self.show_all_students()
+        # Changing the level refilters the list on screen, or opens it
+        if self.results_label is not None and self.results_label.winfo_exists():
+            self.apply_filters()
         else:
-            filtered = [s for s in self.model.students if s.get("level") == level]
-            self.show_all_students(filtered, title=f"Students in {level}")
+            self.show_all_students()
 
     def add_student_form(self):
         self.clear_main_frame()
@@ -182,60 +360,19 @@ class StudentManagerApp:
             messagebox.showerror("Error", "First Name and Last Name are required!")
             return
             
-        self.model.add_student(data)
-        messagebox.showinfo("Success", "Student added successfully!")
-        self.show_all_students()
+        def done(student_id):
+            messagebox.showinfo("Success", "Student added successfully!")
+            self.show_all_students()
 
-    def search_student_form(self):
-        self.clear_main_frame()
-        tk.Label(self.main_frame, text="Search Student", font=("Helvetica", 18, "bold"), bg="#ecf0f1").pack(pady=(0, 20), anchor="w")
-        
-        search_frame = tk.Frame(self.main_frame, bg="#ecf0f1")
-        search_frame.pack(fill="x", pady=10)
-        
-        tk.Label(search_frame, text="Search by Name or ID:", bg="#ecf0f1").pack(side="left", padx=10)
-        self.search_var = tk.StringVar()
-        entry = ttk.Entry(search_frame, textvariable=self.search_var, width=40)
-        entry.pack(side="left", padx=10)
-        
-        tk.Button(search_frame, text="Search", command=self.perform_search, bg="#3498db", fg="white").pack(side="left", padx=10)
-        
-        self.results_frame = tk.Frame(self.main_frame, bg="#ecf0f1")
-        self.results_frame.pack(fill="both", expand=True)
+        self.tasks.call("add_student", data, callback=done)
 
-    def perform_search(self):
-        query = self.search_var.get()
-        results = self.model.search_students(query)
-        
-        for widget in self.results_frame.winfo_children():
-            widget.destroy()
-            
-        if not results:
-            tk.Label(self.results_frame, text="No students found.", bg="#ecf0f1", fg="red").pack(pady=20)
-            return
-            
-        columns = ("id", "first_name", "last_name", "level", "phone")
-        tree = ttk.Treeview(self.results_frame, columns=columns, show="headings", height=10)
-        
-        for col in columns:
-            tree.heading(col, text=col.replace("_", " ").title())
-            tree.column(col, width=120)
-            
-        tree.pack(fill="both", expand=True)
-        
-        for student in results:
-            tree.insert("", "end", values=(
-                student.get("id", ""),
-                student.get("first_name", ""),
-                student.get("last_name", ""),
-                student.get("level", ""),
-                student.get("phone", "")
-            ))
-            
-        tree.bind("<Double-1>", lambda e: self.show_student_details(tree.item(tree.selection()[0], "values")[0]))
+    def search_student_form(self):
+        self.show_all_students(title="Search Student")
+        self.search_entry.focus_set()
 
     def show_student_details(self, student_id, active_tab=0):
-        student = self.model.get_student_by_id(student_id)
+        # The profile only, the history tabs load one page of dates at a time
+        student = self.model.get_student_summaries([student_id])[0]
         if not student:
             return
             
@@ -264,7 +401,7 @@ class StudentManagerApp:
         row = 0
         col = 0
         for key, value in student.items():
-            if key in ["attendance", "payments"]: continue
+            if key in ["attendance", "payments"] or key.startswith("_"): continue
             tk.Label(details_frame, text=key.replace("_", " ").title() + ":", 
                      font=("Helvetica", 10, "bold"), bg="white").grid(row=row, column=col, sticky="e", padx=5, pady=5)
             tk.Label(details_frame, text=str(value), bg="white").grid(row=row, column=col+1, sticky="w", padx=5, pady=5)
@@ -290,22 +427,9 @@ class StudentManagerApp:
         attendance_tab = tk.Frame(notebook, bg="white")
         notebook.add(attendance_tab, text="Attendance History")
         
-        att_columns = ("date", "status", "notes")
-        att_tree = ttk.Treeview(attendance_tab, columns=att_columns, show="headings")
-        att_tree.heading("date", text="Date")
-        att_tree.heading("status", text="Status")
-        att_tree.heading("notes", text="Notes")
-        att_tree.column("date", width=100)
-        att_tree.column("status", width=100)
-        att_tree.column("notes", width=300)
-        att_tree.pack(fill="both", expand=True, padx=10, pady=10)
-        
-        for record in student.get("attendance", []):
-            att_tree.insert("", "end", values=(
-                record.get("date", ""),
-                record.get("status", ""),
-                record.get("notes", "")
-            ))
+        self.history_pages(attendance_tab, student_id, "attendance", ("date", "status", "notes"),
+                           lambda record: (record.get("date", ""), record.get("status", ""), record.get("notes", "")),
+                           ATTENDANCE_PAGE_MONTHS)
             
         tk.Button(attendance_tab, text="Add New Record", 
                  command=lambda: self.record_attendance_dialog(student),
@@ -315,22 +439,20 @@ class StudentManagerApp:
         payment_tab = tk.Frame(notebook, bg="white")
         notebook.add(payment_tab, text="Payment History")
         
-        pay_columns = ("date", "amount", "description")
-        pay_tree = ttk.Treeview(payment_tab, columns=pay_columns, show="headings")
-        pay_tree.heading("date", text="Date")
-        pay_tree.heading("amount", text="Amount")
-        pay_tree.heading("description", text="Description")
-        pay_tree.column("date", width=100)
-        pay_tree.column("amount", width=100)
-        pay_tree.column("description", width=300)
-        pay_tree.pack(fill="both", expand=True, padx=10, pady=10)
-        
-        for record in student.get("payments", []):
-            pay_tree.insert("", "end", values=(
-                record.get("date", ""),
-                f"{record.get('amount', 0):.2f}",
-                record.get("description", "")
-            ))
+        balance_label = tk.Label(payment_tab, text="", font=("Helvetica", 11, "bold"), bg="white")
+        balance_label.pack(anchor="w", padx=10, pady=(10, 0))
+
+        def show_balance(balance):
+            if balance and balance_label.winfo_exists():
+                balance_label.configure(text=f"Charged: {balance['charged']:.2f}    Paid: {balance['paid']:.2f}    "
+                                             f"Owed: {balance['owed']:.2f}",
+                                        fg="#c0392b" if balance["owed"] > 0 else "#27ae60")
+
+        self.tasks.read("balance", student_id, callback=show_balance)
+        self.history_pages(payment_tab, student_id, "payments", ("date", "amount", "description"),
+                           lambda record: (record.get("date", ""), f"{record.get('amount', 0):.2f}",
+                                           record.get("description", "")),
+                           PAYMENT_PAGE_MONTHS)
 
         tk.Button(payment_tab, text="Add New Payment", 
                  command=lambda: self.record_payment_dialog(student),
@@ -343,26 +465,218 @@ class StudentManagerApp:
                 pass
 
 
+    def history_pages(self, parent, student_id, kind, columns, row_values, months):
+        # A history shown a few months at a time, starting with the latest
+        # records, so students with years of them open at once
+        nav = tk.Frame(parent, bg="white")
+        nav.pack(fill="x", padx=10, pady=(10, 0))
+        tree = ttk.Treeview(parent, columns=columns, show="headings")
+        for col in columns:
+            tree.heading(col, text=col.title())
+            tree.column(col, width=300 if col in ("notes", "description") else 100)
+        tree.pack(fill="both", expand=True, padx=10, pady=10)
+        page = {}
+
+        def show(year, month, latest=False):
+            # The page ends with the given month. With latest, a page without
+            # records is followed by the page with the latest ones.
+            first_year, first_month = divmod(year * 12 + month - 1 - (months - 1), 12)
+            start = date(first_year, first_month + 1, 1)
+            end = date(year, month, calendar.monthrange(year, month)[1])
+            self.tasks.read("get_history_window", student_id, kind, start.isoformat(), end.isoformat(),
+                            callback=lambda window: fill(window, year, month, start, end, latest))
+
+        def fill(window, year, month, start, end, latest):
+            if window is None or not tree.winfo_exists():
+                return
+            if latest and not window["records"] and window["last"] and window["last"] < end.isoformat():
+                show(int(window["last"][:4]), int(window["last"][5:7]))
+                return
+            page.update(year=year, month=month, first=window["first"], last=window["last"])
+            # Paging isn't a method call, so the rebuild is timed here
+            with instrumentation.span(f"widget.{kind}_history.build"):
+                tree.delete(*tree.get_children())
+                for record in window["records"]:
+                    tree.insert("", "end", values=row_values(record))
+            instrumentation.observe(f"widget.{kind}_history.rows", len(window["records"]))
+            shown = f"{start:%B %Y}" if months == 1 else f"{start:%b %Y} to {end:%b %Y}"
+            label.configure(text=f"{shown}: {len(window['records'])} of {window['total']} records")
+            prev_btn.configure(state="normal" if window["first"] and window["first"] < start.isoformat() else "disabled")
+            next_btn.configure(state="normal" if window["last"] and window["last"] > end.isoformat() else "disabled")
+
+        def step(amount):
+            year, month = divmod(page["year"] * 12 + page["month"] - 1 + amount * months, 12)
+            show(year, month + 1)
+
+        # Enabled once the first page is in
+        prev_btn = ttk.Button(nav, text="◀ Older", command=lambda: step(-1), state="disabled")
+        prev_btn.pack(side="left")
+        label = tk.Label(nav, text="", bg="white")
+        label.pack(side="left", padx=10)
+        next_btn = ttk.Button(nav, text="Newer ▶", command=lambda: step(1), state="disabled")
+        next_btn.pack(side="left")
+
+        today = date.today()
+        show(today.year, today.month, latest=True)
+
     def delete_student(self, student_id):
-        if messagebox.askyesno("Confirm", "Are you sure you want to delete this student?"):
-            if self.model.delete_student(student_id):
+        def done(deleted):
+            if deleted:
                 messagebox.showinfo("Success", "Student deleted.")
                 self.show_all_students()
             else:
                 messagebox.showerror("Error", "Could not delete student.")
 
+        if messagebox.askyesno("Confirm", "Are you sure you want to delete this student?"):
+            self.tasks.call("delete_student", student_id, callback=done)
+
     def attendance_tracker(self):
         self.show_all_students(
             title="Attendance: Select Student",
             on_click=lambda student_id: self.show_student_details(student_id, active_tab=1)
         )
 
+    def roll_call(self):
+        # Whole-class attendance for one date, saved with a single write
+        self.clear_main_frame()
+        tk.Label(self.main_frame, text="Roll Call", font=("Helvetica", 18, "bold"), bg="#ecf0f1").pack(pady=(0, 20), anchor="w")
+
+        statuses = ["Present", "Absent", "Late"]
+        marks = {}
+        default = tk.StringVar(value="Present")
+
+        top = tk.Frame(self.main_frame, bg="#ecf0f1")
+        top.pack(fill="x", pady=(0, 10))
+        tk.Label(top, text="Level:", bg="#ecf0f1").pack(side="left")
+        level = self.level_var.get() if self.level_var.get() in self.allowed_levels else "All"
+        level_combo = ttk.Combobox(top, values=["All"] + self.allowed_levels, state="readonly", width=12)
+        level_combo.set(level)
+        level_combo.pack(side="left", padx=(5, 15))
+        tk.Label(top, text="Date (YYYY-MM-DD):", bg="#ecf0f1").pack(side="left")
+        date_entry = ttk.Entry(top, width=12)
+        date_entry.insert(0, datetime.now().strftime("%Y-%m-%d"))
+        date_entry.pack(side="left", padx=5)
+
+        tk.Label(self.main_frame, text="Double-click a student, or press P, A or L, to change their status.",
+                 bg="#ecf0f1", fg="#7f8c8d").pack(anchor="w")
+
+        grid = VirtualList(
+            self.main_frame, columns=("id", "first_name", "last_name", "status"),
+            headings={"id": "ID"}, widths={"id": 80, "first_name": 150, "last_name": 150, "status": 100},
+            name="roll_call")
+
+        def rows(student_ids):
+            return [(
+                student.get("id", ""),
+                student.get("first_name", ""),
+                student.get("last_name", ""),
+                marks.get(student.get("id"), default.get())
+            ) if student else None for student in self.model.get_student_summaries(student_ids)]
+
+        def load(event=None):
+            marks.clear()
+            level = level_combo.get()
+            self.tasks.read("list_student_ids", None if level == "All" else level,
+                            callback=lambda student_ids: grid.winfo_exists() and grid.set_rows(student_ids, rows))
+
+        def mark(student_id, status=None):
+            if status is None:
+                current = marks.get(student_id, default.get())
+                status = statuses[(statuses.index(current) + 1) % len(statuses)]
+            marks[student_id] = status
+            grid.refresh()
+
+        def mark_selected(status):
+            if grid.selected() is not None:
+                mark(grid.selected(), status)
+                grid.move_selection(1)
+
+        def mark_all(status):
+            marks.clear()
+            default.set(status)
+            grid.refresh()
+
+        def done(count):
+            messagebox.showinfo("Saved", f"Attendance recorded for {count} students.")
+            load()
+
+        def save():
+            if not grid.keys:
+                return
+            day = date_entry.get()
+            self.tasks.call("add_attendance_bulk", day,
+                            {sid: (marks.get(sid, default.get()), "") for sid in grid.keys},
+                            callback=done)
+
+        level_combo.bind("<<ComboboxSelected>>", load)
+        grid.on_activate = mark
+        for key, status in (("p", "Present"), ("a", "Absent"), ("l", "Late")):
+            grid.tree.bind(f"<KeyPress-{key}>", lambda e, s=status: mark_selected(s))
+        grid.pack(fill="both", expand=True)
+
+        actions = tk.Frame(self.main_frame, bg="#ecf0f1")
+        actions.pack(fill="x", pady=10)
+        for status in statuses:
+            ttk.Button(actions, text=f"All {status}", command=lambda s=status: mark_all(s)).pack(side="left", padx=(0, 5))
+        tk.Button(actions, text="Save Roll Call", command=save, bg="#27ae60", fg="white").pack(side="right")
+        load()
+
     def payment_tracker(self):
         self.show_all_students(
             title="Payments: Select Student",
             on_click=lambda student_id: self.show_student_details(student_id, active_tab=2)
         )
 
+    def import_students(self):
+        path = filedialog.askopenfilename(
+            title="Import Students",
+            filetypes=[("Spreadsheets", "*.csv *.xlsx"), ("All files", "*.*")])
+        if not path:
+            return
+
+        def show_progress(summary):
+            self.status_label.configure(text=f"Importing... {summary['imported']} students")
+
+        def progress(summary):
+            # Runs on the worker thread, the label is updated by the Tk thread
+            self.tasks.post(show_progress, summary)
+
+        def done(summary):
+            message = (f"Imported {summary['imported']} students.\n"
+                       f"Skipped {summary['duplicates']} duplicates.")
+            errors = summary["errors"]
+            if errors:
+                message += f"\n\n{len(errors)} rows rejected:\n"
+                message += "\n".join(f"Line {line}: {msg}" for line, msg in errors[:10])
+                if len(errors) > 10:
+                    message += f"\n... and {len(errors) - 10} more"
+            messagebox.showinfo("Import", message)
+            self.show_all_students()
+
+        self.tasks.submit(lambda: import_file(self.model, path, progress=progress), callback=done)
+
+    def export_dialog(self):
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Export Data")
+        dialog.geometry("300x220")
+        tk.Label(dialog, text="What would you like to export?",
+                 font=("Helvetica", 11, "bold")).pack(pady=15)
+
+        def export(kind):
+            path = filedialog.asksaveasfilename(
+                parent=dialog, title=f"Export {kind.title()}", initialfile=f"{kind}.csv",
+                defaultextension=".csv",
+                filetypes=[("CSV", "*.csv"), ("Excel workbook", "*.xlsx")])
+            if not path:
+                return
+            dialog.destroy()
+            self.tasks.submit(export_data, self.model, kind, path,
+                              callback=lambda count: messagebox.showinfo(
+                                  "Export", f"Exported {count} rows to {path}"))
+
+        for kind in ("students", "attendance", "payments"):
+            ttk.Button(dialog, text=kind.title(), command=lambda k=kind: export(k)).pack(fill="x", padx=40, pady=4)
+
     def record_attendance_dialog(self, student):
         dialog = tk.Toplevel(self.root)
         dialog.title(f"Attendance for {student.get('first_name')}")
@@ -382,12 +696,178 @@ class StudentManagerApp:
         notes_entry = ttk.Entry(dialog)
         notes_entry.pack(pady=5)
         
-        def save():
-            self.model.add_attendance(student["id"], date_entry.get(), status_combo.get(), notes_entry.get())
+        def done(result):
             messagebox.showinfo("Saved", "Attendance recorded.")
             dialog.destroy()
+
+        def save():
+            save_btn.configure(state="disabled")
+            self.tasks.call("add_attendance", student["id"], date_entry.get(), status_combo.get(),
+                            notes_entry.get(), callback=done)
             
-        tk.Button(dialog, text="Save", command=save, bg="#27ae60", fg="white").pack(pady=20)
+        save_btn = tk.Button(dialog, text="Save", command=save, bg="#27ae60", fg="white")
+        save_btn.pack(pady=20)
+
+    def arrears_report(self):
+        # Who owes what, read from the ledger's index sorted by amount owed
+        self.clear_main_frame()
+        tk.Label(self.main_frame, text="Arrears", font=("Helvetica", 18, "bold"), bg="#ecf0f1").pack(pady=(0, 10), anchor="w")
+
+        top = tk.Frame(self.main_frame, bg="#ecf0f1")
+        top.pack(fill="x", pady=(0, 10))
+        tk.Label(top, text="Month (YYYY-MM):", bg="#ecf0f1").pack(side="left")
+        period_entry = ttk.Entry(top, width=10)
+        period_entry.insert(0, datetime.now().strftime("%Y-%m"))
+        period_entry.pack(side="left", padx=5)
+
+        def done(count):
+            messagebox.showinfo("Charges Posted", f"{count} students charged.")
+            self.arrears_report()
+
+        def post():
+            period = period_entry.get().strip()
+            if messagebox.askyesno("Confirm", f"Charge every student the fee of their level for {period}?"):
+                self.tasks.call("post_charges", period, callback=done)
+
+        ttk.Button(top, text="Post Charges", command=post).pack(side="left", padx=5)
+        ttk.Button(top, text="Fee Schedule...", command=self.fee_schedule_dialog).pack(side="left", padx=5)
+        posted_label = tk.Label(top, text="", bg="#ecf0f1", fg="#7f8c8d")
+        posted_label.pack(side="left", padx=10)
+        summary_label = tk.Label(self.main_frame, text="", bg="#ecf0f1", fg="#7f8c8d")
+        summary_label.pack(anchor="w")
+        owed = {}
+
+        def rows(student_ids):
+            return [(student.get("id", ""), student.get("first_name", ""), student.get("last_name", ""),
+                     student.get("level", ""), f"{owed.get(student['id'], 0):.2f}") if student else None
+                    for student in self.model.get_student_summaries(student_ids)]
+
+        table = VirtualList(
+            self.main_frame, columns=("id", "first_name", "last_name", "level", "owed"),
+            headings={"id": "ID"}, widths={"id": 80, "first_name": 120, "last_name": 120, "level": 100, "owed": 100},
+            name="arrears")
+        table.on_activate = lambda student_id: self.show_student_details(student_id, active_tab=2)
+        table.pack(fill="both", expand=True, pady=(10, 0))
+
+        def show_posted(posted):
+            if posted_label.winfo_exists():
+                posted_label.configure(text=f"Last posted: {posted[-1]}" if posted else "No charges posted yet")
+
+        def show_arrears(arrears):
+            if not table.winfo_exists():
+                return
+            owed.update(arrears)
+            summary_label.configure(text=f"{len(owed)} students owe {sum(owed.values()):.2f} in total. "
+                                         "Double-click one to see their payments.")
+            table.set_rows(list(owed), rows)
+
+        self.tasks.read("posted_periods", callback=show_posted)
+        self.tasks.read("arrears", callback=show_arrears)
+
+    def fee_schedule_dialog(self):
+        self.tasks.read("fee_schedule", callback=self.show_fee_schedule)
+
+    def show_fee_schedule(self, fees):
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Fee Schedule")
+
+        tk.Label(dialog, text="Monthly fee per level, empty for none:").grid(row=0, column=0, columnspan=2, padx=10, pady=10)
+        entries = {}
+        for row, level in enumerate(self.allowed_levels, start=1):
+            tk.Label(dialog, text=level).grid(row=row, column=0, sticky="e", padx=10, pady=2)
+            entries[level] = ttk.Entry(dialog, width=12)
+            if level in fees:
+                entries[level].insert(0, f"{fees[level]:.2f}")
+            entries[level].grid(row=row, column=1, sticky="w", padx=10, pady=2)
+
+        def done(result):
+            messagebox.showinfo("Saved", "Fee schedule saved, it applies from the next charges posted.")
+            dialog.destroy()
+
+        def save():
+            schedule = {level: entry.get().strip() for level, entry in entries.items() if entry.get().strip()}
+            self.tasks.call("set_fee_schedule", schedule, callback=done)
+
+        tk.Button(dialog, text="Save", command=save, bg="#27ae60", fg="white").grid(
+            row=len(self.allowed_levels) + 1, column=0, columnspan=2, pady=15)
+
+    def reports_screen(self):
+        # Statements and class reports are written by worker processes
+        self.clear_main_frame()
+        tk.Label(self.main_frame, text="Monthly Reports", font=("Helvetica", 18, "bold"), bg="#ecf0f1").pack(pady=(0, 10), anchor="w")
+        tk.Label(self.main_frame, text="A statement per student (attendance, payments and balance) "
+                                       "and a report per level, for one month.",
+                 bg="#ecf0f1", fg="#7f8c8d").pack(anchor="w", pady=(0, 10))
+
+        form = tk.Frame(self.main_frame, bg="#ecf0f1")
+        form.pack(fill="x")
+        tk.Label(form, text="Month (YYYY-MM):", bg="#ecf0f1").grid(row=0, column=0, sticky="e", pady=5)
+        period_entry = ttk.Entry(form, width=10)
+        period_entry.insert(0, datetime.now().strftime("%Y-%m"))
+        period_entry.grid(row=0, column=1, sticky="w", padx=5)
+
+        tk.Label(form, text="Formats:", bg="#ecf0f1").grid(row=1, column=0, sticky="e", pady=5)
+        formats = {name: tk.BooleanVar(value=True) for name in FORMATS}
+        format_frame = tk.Frame(form, bg="#ecf0f1")
+        format_frame.grid(row=1, column=1, sticky="w", padx=5)
+        for name, var in formats.items():
+            ttk.Checkbutton(format_frame, text=name.upper(), variable=var).pack(side="left", padx=(0, 10))
+
+        tk.Label(form, text="Folder:", bg="#ecf0f1").grid(row=2, column=0, sticky="e", pady=5)
+        folder_entry = ttk.Entry(form, width=50)
+        folder_entry.insert(0, "reports")
+        folder_entry.grid(row=2, column=1, sticky="w", padx=5)
+
+        def browse():
+            folder = filedialog.askdirectory(title="Reports Folder")
+            if folder:
+                folder_entry.delete(0, "end")
+                folder_entry.insert(0, folder)
+
+        ttk.Button(form, text="Browse...", command=browse).grid(row=2, column=2, padx=5)
+
+        bar = ttk.Progressbar(self.main_frame, mode="determinate", length=400)
+        status = tk.Label(self.main_frame, text="", bg="#ecf0f1", fg="#7f8c8d")
+
+        def show_progress(done, total):
+            # The screen may have been left meanwhile
+            if bar.winfo_exists():
+                bar.configure(maximum=max(total, 1), value=done)
+                status.configure(text=f"{done} of {total} statements written")
+
+        def progress(done, total):
+            # Runs on the report thread, the bar is updated by the Tk thread
+            self.tasks.post(show_progress, done, total)
+
+        def finished(summary, error):
+            if button.winfo_exists():
+                button.configure(state="normal")
+            if error is not None:
+                self.on_task_error(error)
+                return
+            messagebox.showinfo("Reports", f"Wrote {summary['statements']} statements and "
+                                           f"{summary['classes']} class reports to {summary['directory']}.")
+
+        def run(period, folder, chosen):
+            try:
+                summary, error = generate_reports(self.model, folder, period, chosen, progress=progress), None
+            except Exception as e:
+                summary, error = None, e
+            self.tasks.post(finished, summary, error)
+
+        def generate():
+            chosen = [name for name, var in formats.items() if var.get()]
+            button.configure(state="disabled")
+            bar.pack(anchor="w", pady=(15, 5))
+            status.pack(anchor="w")
+            status.configure(text="Starting...")
+            # Not on the model's worker thread: the reports only read, and
+            # saving changes meanwhile must not wait for them
+            threading.Thread(target=run, args=(period_entry.get().strip(), folder_entry.get().strip(), chosen),
+                             daemon=True).start()
+
+        button = tk.Button(form, text="Generate", command=generate, bg="#27ae60", fg="white")
+        button.grid(row=3, column=1, sticky="w", padx=5, pady=10)
 
     def record_payment_dialog(self, student):
         dialog = tk.Toplevel(self.root)
@@ -407,18 +887,108 @@ class StudentManagerApp:
         desc_entry = ttk.Entry(dialog)
         desc_entry.pack(pady=5)
         
+        def done(result):
+            messagebox.showinfo("Saved", "Payment recorded.")
+            dialog.destroy()
+
         def save():
             try:
                 amount = float(amount_entry.get())
-                self.model.add_payment(student["id"], amount, date_entry.get(), desc_entry.get())
-                messagebox.showinfo("Saved", "Payment recorded.")
-                dialog.destroy()
             except ValueError:
                 messagebox.showerror("Error", "Invalid amount")
+                return
+            save_btn.configure(state="disabled")
+            self.tasks.call("add_payment", student["id"], amount, date_entry.get(), desc_entry.get(),
+                            callback=done)
             
-        tk.Button(dialog, text="Save", command=save, bg="#27ae60", fg="white").pack(pady=20)
+        save_btn = tk.Button(dialog, text="Save", command=save, bg="#27ae60", fg="white")
+        save_btn.pack(pady=20)
+
+    def show_diagnostics(self):
+        # Hidden window (Ctrl+Shift+D) with the timings and counters collected so far
+        if self.diagnostics is not None and self.diagnostics.winfo_exists():
+            self.diagnostics.lift()
+            return
+        window = self.diagnostics = tk.Toplevel(self.root)
+        window.title("Diagnostics")
+        window.geometry("760x480")
+
+        controls = tk.Frame(window)
+        controls.pack(fill="x", padx=10, pady=10)
+        enabled = tk.BooleanVar(value=instrumentation.ENABLED)
+
+        def toggle():
+            if enabled.get():
+                instrumentation.enable()
+            else:
+                instrumentation.disable()
+            refresh()
+
+        tk.Checkbutton(controls, text="Collect timings", variable=enabled, command=toggle).pack(side="left")
+
+        columns = ("name", "count", "mean", "p50", "p99", "max")
+        tree = ttk.Treeview(window, columns=columns, show="headings")
+        for col in columns:
+            tree.heading(col, text=col.upper() if col.startswith("p") else col.title())
+            tree.column(col, width=260 if col == "name" else 90, anchor="w" if col == "name" else "e")
+        tree.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+
+        def refresh():
+            tree.delete(*tree.get_children())
+            data = instrumentation.snapshot()
+            for name, h in data["histograms"].items():
+                # Durations are shown in milliseconds, sizes as they are
+                scale, unit = (1000, " ms") if h["unit"] == "s" else (1, "")
+                tree.insert("", "end", values=(name, h["count"], *(
+                    f"{h[key] * scale:.2f}{unit}" if h[key] is not None else ""
+                    for key in ("mean", "p50", "p99", "max"))))
+            for name, value in data["counters"].items():
+                tree.insert("", "end", values=(name, value, "", "", "", ""))
+
+        def reset():
+            instrumentation.reset()
+            refresh()
+
+        def capture():
+            if instrumentation.capturing():
+                prefix = filedialog.asksaveasfilename(parent=window, title="Save capture as",
+                                                      defaultextension="")
+                if prefix:
+                    paths = instrumentation.stop_capture(prefix)
+                    capture_btn.configure(text="Start Capture")
+                    messagebox.showinfo("Capture", "Written:\n" + "\n".join(paths), parent=window)
+            else:
+                instrumentation.start_capture()
+                capture_btn.configure(text="Stop Capture")
+
+        def export():
+            path = filedialog.asksaveasfilename(parent=window, title="Export diagnostics",
+                                                defaultextension=".json", filetypes=[("JSON", "*.json")])
+            if path:
+                instrumentation.export(path)
+
+        tk.Button(controls, text="Refresh", command=refresh).pack(side="left", padx=5)
+        tk.Button(controls, text="Reset", command=reset).pack(side="left", padx=5)
+        capture_btn = tk.Button(controls, text="Stop Capture" if instrumentation.capturing() else "Start Capture",
+                                command=capture)
+        capture_btn.pack(side="left", padx=5)
+        tk.Button(controls, text="Export JSON", command=export).pack(side="left", padx=5)
+        refresh()
+
+
+instrumentation.instrument(StudentManagerApp, "ui")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OMNA Student Management System")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json",
+                        help="storage backend (default: json)")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time the model calls and screens (see Ctrl+Shift+D)")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="profile the whole session into PREFIX.prof and PREFIX-memory.txt")
+    args = parser.parse_args()
+    if args.instrument:
+        instrumentation.enable()
     root = tk.Tk()
-    app = StudentManagerApp(root)
+    app = StudentManagerApp(root, backend=args.backend, profile=args.profile)
     root.mainloop()
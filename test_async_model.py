@@ -0,0 +1,52 @@
+import threading
+import time
+import unittest
+
+from async_model import AsyncModel
+
+
+class FakeRoot:
+    # Runs the polls by hand instead of a Tk event loop
+    def __init__(self):
+        self.jobs = []
+
+    def after(self, ms, fn):
+        self.jobs.append(fn)
+
+    def run(self, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            jobs, self.jobs = self.jobs, []
+            for job in jobs:
+                job()
+            time.sleep(0.01)
+
+
+class Model:
+    def __init__(self):
+        self.count = 3
+
+    def count_students(self):
+        return self.count
+
+
+class AsyncModelTest(unittest.TestCase):
+    def test_reads_not_queued_behind_writes(self):
+        root = FakeRoot()
+        tasks = AsyncModel(root, Model)
+        root.run(0.1)
+        release = threading.Event()
+        results = []
+        tasks.submit(release.wait, 5, callback=results.append)
+        tasks.read("count_students", callback=results.append)
+        root.run(0.2)
+        # The read came back on the polling thread while the write still runs
+        self.assertEqual(results, [3])
+        release.set()
+        root.run(0.2)
+        self.assertEqual(results, [3, True])
+        tasks.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
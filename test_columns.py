@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from columnar import HistoryColumns
+from model import StudentModel
+
+
+class ColumnsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data_file = os.path.join(self.directory, "students.json")
+        model = StudentModel(self.data_file)
+        for i in range(5):
+            student_id = model.add_student({"first_name": f"F{i}", "last_name": "L", "level": "1ere TSDI"})
+            model.add_attendance(student_id, "2024-11-04", "Absent")
+        model.close()
+        # Loaded again so the histories are read from the side file
+        self.model = StudentModel(self.data_file)
+
+    def tearDown(self):
+        self.model.close()
+        shutil.rmtree(self.directory)
+
+    def test_reads_not_blocked_by_build(self):
+        started, release = threading.Event(), threading.Event()
+        build = HistoryColumns.build
+
+        def slow_build(columns, students):
+            started.set()
+            release.wait(5)
+            build(columns, students)
+
+        reports = []
+        with mock.patch.object(HistoryColumns, "build", slow_build):
+            builder = threading.Thread(target=lambda: reports.append(self.model.attendance_by_level()))
+            builder.start()
+            self.assertTrue(started.wait(5))
+            # The build is stuck, the model still answers
+            reader = threading.Thread(target=lambda: (self.model.filter_student_ids("F1"),
+                                                      self.model.get_student_by_id("S0002")))
+            reader.start()
+            reader.join(2)
+            self.assertFalse(reader.is_alive())
+            # Changes made during the build are in the finished columns
+            self.model.add_attendance("S0003", "2024-11-05", "Absent")
+            new_id = self.model.add_student({"first_name": "New", "level": "2eme TSDI"})
+            self.model.add_attendance(new_id, "2024-11-05", "Present")
+            release.set()
+            builder.join(5)
+        self.assertEqual(reports[0]["1ere TSDI"]["Absent"], 6)
+        self.assertEqual(self.model.attendance_by_level()["1ere TSDI"]["Absent"], 6)
+        self.assertEqual(self.model.attendance_by_level()["2eme TSDI"]["Present"], 1)
+        self.assertEqual(self.model.absentee_leaderboard(1), [("S0003", 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from history import AttendanceHistory, HistoryFile, PaymentHistory
+
+
+def payment(amount):
+    return {"date": "2024-11-05", "amount": amount, "description": "", "timestamp": "2024-11-05T10:00:00"}
+
+
+class PaymentHistoryTest(unittest.TestCase):
+    def read_back(self, amount):
+        history = PaymentHistory([payment(amount)])
+        attendance, payments = HistoryFile.decode(HistoryFile.encode(AttendanceHistory(), history))
+        return history[0]["amount"], payments[0]["amount"]
+
+    def test_amounts_in_cents_kept_in_the_column(self):
+        history = PaymentHistory([payment(19.99), payment(-5.0)])
+        self.assertIsNone(history.odd)
+        self.assertEqual([r["amount"] for r in history], [19.99, -5.0])
+
+    def test_fractions_of_a_cent_read_back_exactly(self):
+        for amount in self.read_back(99.999):
+            self.assertEqual(amount, 99.999)
+
+    def test_int_amounts_stay_ints(self):
+        for amount in self.read_back(100):
+            self.assertEqual(amount, 100)
+            self.assertIs(type(amount), int)
+
+    def test_set_aside_amounts_in_reports(self):
+        history = PaymentHistory([payment(100), payment(19.99), payment(99.999)])
+        self.assertEqual(history.report_columns()[1], [10000, 1999, 10000])
+
+
+if __name__ == "__main__":
+    unittest.main()
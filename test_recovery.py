@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from backup import BackupError
+from model import StudentModel
+
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data_file = os.path.join(self.directory, "students.json")
+        model = StudentModel(self.data_file)
+        for i in range(6):
+            model.add_student({"first_name": f"F{i}", "last_name": "L", "level": "1ere TSDI"})
+        model.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def damage(self):
+        with open(self.data_file, "rb") as f:
+            raw = f.read()
+        with open(self.data_file, "wb") as f:
+            f.write(raw[:len(raw) // 2])
+        return raw[:len(raw) // 2]
+
+    def files(self):
+        contents = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path) and not name.endswith(".lock"):
+                with open(path, "rb") as f:
+                    contents[name] = f.read()
+        return contents
+
+    def assert_untouched_on_failure(self):
+        before = self.files()
+        with self.assertRaises(BackupError):
+            StudentModel(self.data_file)
+        self.assertEqual(self.files(), before)
+
+    def test_no_backups(self):
+        shutil.rmtree(os.path.join(self.directory, "students.backups"))
+        self.damage()
+        self.assert_untouched_on_failure()
+
+    def test_deltas_only(self):
+        model = StudentModel(self.data_file)
+        model.add_student({"first_name": "G", "last_name": "L", "level": "1ere TSDI"})
+        model.backup()
+        model.close()
+        # Keeps only the deltas, as before the first daily full backup
+        directory = os.path.join(self.directory, "students.backups")
+        manifest = os.path.join(directory, "manifest.jsonl")
+        with open(manifest, "rb") as f:
+            lines = [line for line in f if b'"kind":"delta"' in line]
+        with open(manifest, "wb") as f:
+            f.writelines(lines)
+        self.damage()
+        self.assert_untouched_on_failure()
+
+    def test_restores_from_full_backup(self):
+        model = StudentModel(self.data_file)
+        model.add_student({"first_name": "G", "last_name": "L", "level": "1ere TSDI"})
+        model.close()
+        self.damage()
+        model = StudentModel(self.data_file)
+        self.assertEqual(model.count_students(), 7)
+        self.assertTrue(model.recovered["complete"])
+        self.assertTrue(os.path.exists(model.recovered["damaged"]))
+        model.close()
+
+    def test_records_after_partial_restore_backed_up(self):
+        for name in ("G", "H"):
+            model = StudentModel(self.data_file)
+            model.add_student({"first_name": name, "last_name": "L", "level": "1ere TSDI"})
+            model.close()
+        # The delta of G is lost, the restore stops before it
+        directory = os.path.join(self.directory, "students.backups")
+        with open(os.path.join(directory, "manifest.jsonl"), "rb") as f:
+            delta = next(e for e in map(json.loads, f) if e["kind"] == "delta" and e["first_seq"] == 7)
+        with open(os.path.join(directory, delta["file"]), "wb") as f:
+            f.write(b"damaged")
+        self.damage()
+        model = StudentModel(self.data_file)
+        self.assertFalse(model.recovered["complete"])
+        self.assertEqual(model.count_students(), 6)
+        self.assertEqual(model.seq, 8)
+        model.add_student({"first_name": "I", "last_name": "L", "level": "1ere TSDI"})
+        model.close()
+        # Restored again, from the backups written since the first restore
+        self.damage()
+        model = StudentModel(self.data_file)
+        self.assertTrue(model.recovered["complete"])
+        self.assertEqual([s["first_name"] for s in model.students][-1], "I")
+        self.assertEqual(model.count_students(), 7)
+        model.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
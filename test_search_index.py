@@ -0,0 +1,41 @@
+import unittest
+
+from search_index import SearchIndex
+
+
+def student(i, first_name, last_name="Alaoui", phone=""):
+    return {"id": f"S{i:04d}", "first_name": first_name, "last_name": last_name, "phone": phone}
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test_bulk_terms_merged_once(self):
+        index = SearchIndex()
+        for i, name in enumerate(["Yassine", "Amine", "Hamza"], start=1):
+            index.add(student(i, name), bulk=True)
+        index.add(student(4, "Zineb"), bulk=True)
+        # Nothing sorted in yet, the first lookup does it
+        self.assertEqual(index.sorted_terms, [])
+        self.assertEqual(index.search("amine"), ["S0002"])
+        self.assertIn("zineb", index.sorted_terms)
+        self.assertEqual(index._pending_terms, [])
+
+    def test_remove_with_pending_terms(self):
+        index = SearchIndex()
+        index.add(student(1, "Yassine"), bulk=True)
+        index.add(student(2, "Amine"), bulk=True)
+        index.remove("S0001")
+        self.assertEqual(index.search("yassine"), [])
+        self.assertEqual(index.search("amine"), ["S0002"])
+
+    def test_ids_and_phones_match_inside(self):
+        index = SearchIndex()
+        index.build([student(1, "Sara", phone="06 12 34 56 78"), student(12, "Omar"), student(1001, "Salma")])
+        self.assertEqual(index.search("001"), ["S0001", "S0012", "S1001"])
+        self.assertEqual(index.search("3456"), ["S0001"])
+        self.assertEqual(index.search("12"), ["S0012", "S0001"])
+        # Letters alone find the IDs too, after the names
+        self.assertEqual(index.search("s"), ["S0001", "S1001", "S0012"])
+
+
+if __name__ == "__main__":
+    unittest.main()
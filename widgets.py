@@ -0,0 +1,162 @@
+import tkinter as tk
+from tkinter import ttk
+
+from instrumentation import observe
+
+
+class VirtualList(tk.Frame):
+    """Treeview that only holds the rows currently on screen.
+
+    The rows are given as a sequence of keys plus a fetch function turning a
+    list of keys into their row values, called one page at a time. Scrolling
+    rewrites the values of a fixed pool of items, so showing or scrolling a
+    list costs the same for 100 keys or 100,000.
+    """
+
+    def __init__(self, parent, columns, headings=None, widths=None, buffer=50, name="list", **kwargs):
+        super().__init__(parent, **kwargs)
+        # Histogram of the rows painted by each repaint
+        self.metric = f"widget.{name}.rows"
+        self.keys = []
+        self.fetch = None
+        self.on_activate = None
+        self.offset = 0
+        self.visible = 1
+        self.buffer = buffer
+        self.selected_key = None
+        self._cache = {}
+        self._items = []
+
+        self.tree = ttk.Treeview(self, columns=columns, show="headings", selectmode="browse")
+        headings = headings or {}
+        widths = widths or {}
+        for col in columns:
+            self.tree.heading(col, text=headings.get(col, col.replace("_", " ").title()))
+            self.tree.column(col, width=widths.get(col, 120))
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        self.tree.pack(side="left", fill="both", expand=True)
+
+        self.row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        self.tree.bind("<Configure>", self._on_resize)
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        self.tree.bind("<Double-1>", self._on_activate)
+        self.tree.bind("<Return>", self._on_activate)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1, "units", 3))
+        self.tree.bind("<Button-4>", lambda e: self.scroll(-1, "units", 3))
+        self.tree.bind("<Button-5>", lambda e: self.scroll(1, "units", 3))
+        self.tree.bind("<Up>", lambda e: self.move_selection(-1))
+        self.tree.bind("<Down>", lambda e: self.move_selection(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll(-1, "pages"))
+        self.tree.bind("<Next>", lambda e: self.scroll(1, "pages"))
+
+    def set_rows(self, keys, fetch, keep_position=False):
+        self.keys = keys
+        self.fetch = fetch
+        self._cache = {}
+        if not keep_position:
+            self.offset = 0
+            self.selected_key = None
+        self.refresh()
+
+    def refresh(self):
+        # Drops rendered rows so changed records are fetched again
+        self._cache = {}
+        self._clamp()
+        self._repaint()
+
+    def selected(self):
+        return self.selected_key
+
+    def scroll(self, amount, what="units", step=1):
+        if what == "pages":
+            step = self.visible
+        self.offset += amount * step
+        self._clamp()
+        self._repaint()
+        return "break"
+
+    def _clamp(self):
+        self.offset = max(0, min(self.offset, len(self.keys) - self.visible))
+
+    def _on_scrollbar(self, *args):
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.keys))
+            self._clamp()
+            self._repaint()
+        elif args[0] == "scroll":
+            self.scroll(int(args[1]), args[2])
+
+    def _on_resize(self, event):
+        # The heading takes about one row
+        visible = max(1, event.height // self.row_height - 1)
+        if visible != self.visible:
+            self.visible = visible
+            self._clamp()
+            self._repaint()
+
+    def _fetch(self, start, stop):
+        # Loads the window plus a buffer on each side as a single page
+        if all(self.keys[i] in self._cache for i in range(start, stop)):
+            return
+        if len(self._cache) > 4 * (self.visible + 2 * self.buffer):
+            self._cache = {}
+        page = [key for key in self.keys[max(0, start - self.buffer):stop + self.buffer]
+                if key not in self._cache]
+        self._cache.update(zip(page, self.fetch(page)))
+
+    def _repaint(self):
+        start = self.offset
+        stop = min(len(self.keys), start + self.visible)
+        self._fetch(start, stop)
+        count = stop - start
+        while len(self._items) < count:
+            self._items.append(self.tree.insert("", "end"))
+        while len(self._items) > count:
+            self.tree.delete(self._items.pop())
+
+        selected_item = None
+        for item, i in zip(self._items, range(start, stop)):
+            key = self.keys[i]
+            self.tree.item(item, values=self._cache[key] or ())
+            if key == self.selected_key:
+                selected_item = item
+        observe(self.metric, count)
+        if selected_item:
+            self.tree.selection_set(selected_item)
+        elif self.tree.selection():
+            self.tree.selection_remove(self.tree.selection())
+
+        if self.keys:
+            self.scrollbar.set(start / len(self.keys), stop / len(self.keys))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def _index_of(self, item):
+        return self.offset + self._items.index(item)
+
+    def _on_select(self, event):
+        selection = self.tree.selection()
+        if selection:
+            self.selected_key = self.keys[self._index_of(selection[0])]
+
+    def move_selection(self, step):
+        if not self.keys:
+            return "break"
+        if self.selected_key is None:
+            index = self.offset
+        else:
+            selection = self.tree.selection()
+            index = self._index_of(selection[0]) + step if selection else self.offset
+        index = max(0, min(index, len(self.keys) - 1))
+        self.selected_key = self.keys[index]
+        if index < self.offset:
+            self.offset = index
+        elif index >= self.offset + self.visible:
+            self.offset = index - self.visible + 1
+        self._repaint()
+        return "break"
+
+    def _on_activate(self, event):
+        if self.selected_key is not None and self.on_activate:
+            self.on_activate(self.selected_key)